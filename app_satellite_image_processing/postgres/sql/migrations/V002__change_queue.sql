@@ -0,0 +1,50 @@
+-- Every insert and update of a source row queues its key in etl_changes, so the micro-batch ETL daemon also picks
+-- up changes to rows it merged before, not only rows with a key above the largest one it has seen.
+--
+-- The daemon reads the queue in change_id order and deletes the entries it merged once history is committed. A
+-- transaction that took a lower change_id but commits later simply shows up in the next batch. Full loads that
+-- read the source (1_Stage, the fused orchestrator) delete the entries of the transactions that had ended before
+-- they started (xact_id below the xmin of their snapshot), so the queue only holds what the last full run missed.
+
+CREATE TABLE IF NOT EXISTS satellite_image_processing.etl_changes (
+    change_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    row_key BIGINT NOT NULL,
+    xact_id XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS etl_changes_xact_id_idx ON satellite_image_processing.etl_changes (xact_id);
+
+-- Statement-level, so a bulk insert of detections adds its keys with one INSERT ... SELECT. TG_ARGV[0] is the key.
+CREATE OR REPLACE FUNCTION satellite_image_processing.queue_changes() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    EXECUTE format('INSERT INTO satellite_image_processing.etl_changes (table_name, row_key) '
+                   'SELECT %L, %I FROM changed_rows', TG_TABLE_NAME, TG_ARGV[0]);
+    RETURN NULL;
+END
+$$;
+
+-- A trigger with a transition table handles one event, hence one trigger for inserts and one for updates.
+DO $$
+DECLARE
+    source_table TEXT;
+    key_column TEXT;
+    operation TEXT;
+BEGIN
+    FOR source_table, key_column IN
+        VALUES ('images', 'image_id'), ('coordinates', 'coordinates_id'),
+               ('predictions_roof_type', 'prediction_id'), ('detection_solar_panel', 'detection_id')
+    LOOP
+        FOREACH operation IN ARRAY ARRAY['insert', 'update'] LOOP
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON satellite_image_processing.%I',
+                           source_table || '_queue_' || operation, source_table);
+            EXECUTE format('CREATE TRIGGER %I AFTER %s ON satellite_image_processing.%I '
+                           'REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT '
+                           'EXECUTE FUNCTION satellite_image_processing.queue_changes(%L)',
+                           source_table || '_queue_' || operation, upper(operation), source_table, key_column);
+        END LOOP;
+    END LOOP;
+END
+$$;
@@ -0,0 +1,36 @@
+-- Every detection of an image used to carry its own copy of the annotated image, although all detections of an
+-- image share the same one. The annotated images now live once each in annotated_images, keyed by their sha256,
+-- and detections reference them. detection_solar_panel_full puts the image back on every row, in the columns of the
+-- table, for readers such as the ETL; rows written with image_data (e.g. by older clients) still read as before.
+
+CREATE TABLE IF NOT EXISTS satellite_image_processing.annotated_images (
+    sha256 TEXT PRIMARY KEY,
+    image_data BYTEA NOT NULL
+);
+
+ALTER TABLE satellite_image_processing.detection_solar_panel
+    ADD COLUMN IF NOT EXISTS image_sha256 TEXT NULL REFERENCES satellite_image_processing.annotated_images (sha256);
+
+-- Move the copies already stored. What the ETL reads does not change, so the change queue stays out of it.
+ALTER TABLE satellite_image_processing.detection_solar_panel DISABLE TRIGGER detection_solar_panel_queue_update;
+
+INSERT INTO satellite_image_processing.annotated_images (sha256, image_data)
+SELECT DISTINCT ON (hash) hash, image_data
+FROM (
+    SELECT encode(sha256(image_data), 'hex') AS hash, image_data
+    FROM satellite_image_processing.detection_solar_panel
+    WHERE image_data IS NOT NULL
+) AS blobs
+ON CONFLICT (sha256) DO NOTHING;
+
+UPDATE satellite_image_processing.detection_solar_panel
+SET image_sha256 = encode(sha256(image_data), 'hex'), image_data = NULL
+WHERE image_data IS NOT NULL;
+
+ALTER TABLE satellite_image_processing.detection_solar_panel ENABLE TRIGGER detection_solar_panel_queue_update;
+
+CREATE OR REPLACE VIEW satellite_image_processing.detection_solar_panel_full AS
+SELECT d.detection_id, d.image_id, d.class_name, d.confidence, d.x, d.y, d.width, d.height,
+       COALESCE(d.image_data, a.image_data) AS image_data, d.date_processed
+FROM satellite_image_processing.detection_solar_panel AS d
+LEFT JOIN satellite_image_processing.annotated_images AS a ON a.sha256 = d.image_sha256;
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from common.memory import RssSampler
+from extract_image_data_service import ImageProcessService, ROOF_TYPE_PROJECT
+from model_client import ModelClientConfig, ResilientModelClient
+from roboflow_model import RoboflowModelFactory, RoboflowModelParams
+
+# Offline throughput benchmark of ImageProcessService: synthetic tiles, a deterministic fake model
+# backend and an in-memory repository, so only this code is measured and nothing leaves the machine.
+
+ROOF_CLASSES = ["flat", "gable", "hip", "complex"]
+
+
+@dataclass
+class TileConfig:
+    count: int = 50
+    width: int = 640
+    height: int = 640
+    seed: int = 0
+
+
+@dataclass
+class FakeModelConfig:
+    latency_seconds: float = 0.05
+    latency_jitter_seconds: float = 0.02
+    detections_per_image: int = 4
+
+
+def generate_tiles(folder: str, config: TileConfig, prefix: str = "tile") -> List[str]:
+    """Write `count` JPEG tiles that look vaguely like roofs seen from above; returns their paths."""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(config.seed)
+    paths = []
+    for index in range(config.count):
+        tile = rng.normal(110, 25, (config.height, config.width, 3)).clip(0, 255).astype(np.uint8)
+        for _ in range(rng.integers(3, 9)):
+            roof_width = int(rng.integers(config.width // 10, config.width // 3))
+            roof_height = int(rng.integers(config.height // 10, config.height // 3))
+            x = int(rng.integers(0, config.width - roof_width))
+            y = int(rng.integers(0, config.height - roof_height))
+            tile[y:y + roof_height, x:x + roof_width] = rng.integers(60, 220, 3)
+            if rng.random() < 0.5:
+                # dark stripes standing in for a row of solar panels
+                tile[y + roof_height // 4:y + roof_height // 2, x + 2:x + roof_width - 2:6] = (25, 30, 60)
+        path = os.path.join(folder, f"{prefix}_{index:05d}.jpg")
+        Image.fromarray(tile).save(path, format="JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+class FakeRoboflowModel:
+    """Stands in for RoboflowModel: same `params` and `predict`, answers shaped like Roboflow's JSON.
+
+    Results and latencies are derived from the file name, so every run of the
+    same tiles sees the same predictions.
+    """
+
+    def __init__(self, params: RoboflowModelParams, config: FakeModelConfig):
+        self.params = params
+        self.config = config
+
+    def predict(self, image_path: str) -> dict:
+        rng = np.random.default_rng(zlib.crc32(f"{self.params.project_name}/{os.path.basename(image_path)}".encode()))
+        time.sleep(max(0.0, self.config.latency_seconds
+                       + rng.uniform(-self.config.latency_jitter_seconds, self.config.latency_jitter_seconds)))
+        with Image.open(image_path) as image:
+            width, height = image.size
+
+        if self.params.project_name == ROOF_TYPE_PROJECT:
+            confidences = rng.dirichlet(np.ones(len(ROOF_CLASSES)))
+            return {"predictions": [{
+                "time": float(rng.uniform(0.02, 0.2)),
+                "predictions": {name: {"confidence": float(confidence)}
+                                for name, confidence in zip(ROOF_CLASSES, confidences)},
+            }]}
+
+        predictions = []
+        for index in range(self.config.detections_per_image):
+            box_width = float(rng.uniform(width / 20, width / 5))
+            box_height = float(rng.uniform(height / 20, height / 5))
+            predictions.append({
+                "x": float(rng.uniform(box_width / 2, width - box_width / 2)),
+                "y": float(rng.uniform(box_height / 2, height - box_height / 2)),
+                "width": box_width,
+                "height": box_height,
+                "confidence": float(rng.uniform(0.3, 0.99)),
+                "class": "solar-panel",
+                "class_id": 0,
+                "detection_id": f"{os.path.basename(image_path)}-{index}",
+            })
+        return {"predictions": predictions, "image": {"width": width, "height": height}}
+
+
+class FakeModelFactory(RoboflowModelFactory):
+    """Builds fake models behind the real ResilientModelClient, so its limiter and breaker are measured too."""
+
+    def __init__(self, fake_config: FakeModelConfig, client_config: Optional[ModelClientConfig] = None):
+        super().__init__(client_config)
+        self.fake_config = fake_config
+
+    def create_model(self, api_key: str, project_name: str, version_number: int) -> ResilientModelClient:
+        params = RoboflowModelParams(api_key, project_name, version_number)
+        return ResilientModelClient(FakeRoboflowModel(params, self.fake_config), self.client_config)
+
+
+class InMemoryImageRepository:
+    """The part of ImageRepository that ImageProcessService uses, kept in dictionaries."""
+
+    def __init__(self):
+        self.images = {}
+        self.coordinates = {}
+        self.predictions = []
+        self.detections = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get_processing_state(self) -> dict:
+        with self._lock:
+            predicted = {row[0] for row in self.predictions}
+            detected = {row[0] for row in self.detections}
+            return {image["filename"]: (image_id, image_id in predicted, image_id in detected)
+                    for image_id, image in self.images.items()}
+
+    def insert_image(self, width: int, height: int, filename: str, image_data: bytes):
+        with self._lock:
+            image_id = next(self._ids)
+            self.images[image_id] = {"width": width, "height": height, "filename": filename,
+                                     "bytes": len(image_data)}
+            return image_id
+
+    def get_first_coordinate_by_image_id(self, image_id: int):
+        with self._lock:
+            return self.coordinates.get(image_id)
+
+    def insert_coordinate(self, image_id: int, latitude: float, longitude: float):
+        with self._lock:
+            self.coordinates[image_id] = (latitude, longitude)
+            return image_id
+
+    def insert_predictions_roof_type_bulk(self, image_id: int, class_names: list, confidences: list,
+                                          time_taken: float, prediction_type: str):
+        with self._lock:
+            self.predictions.extend((image_id, name, confidence) for name, confidence in zip(class_names, confidences))
+            return list(range(len(class_names)))
+
+    def insert_detections_solar_panel_bulk(self, image_id: int, class_names: list, confidences: list, xs: list,
+                                           ys: list, widths: list, heights: list, image_data: bytes):
+        with self._lock:
+            self.detections.extend((image_id, name, confidence) for name, confidence in zip(class_names, confidences))
+            return list(range(len(class_names)))
+
+    def insert_no_predictions(self, image_id: int):
+        with self._lock:
+            self.detections.append((image_id, "No predictions", 0.0))
+
+    def notify_image_processed(self, image_id: int):
+        pass
+
+    def close_connection(self):
+        pass
+
+
+def create_repository(use_database: bool):
+    """The in-memory repository, or the real one on the PG_* database for end-to-end numbers."""
+    if not use_database:
+        return InMemoryImageRepository()
+    from common.db import PoolConfig
+    from image_repository import ImageRepository, PostgresConfig
+    return ImageRepository(PostgresConfig.from_env("PG"), PoolConfig.from_env("image_processing_benchmark"))
+
+
+def run_benchmark(tiles_folder: str, config: dict, fake_config: FakeModelConfig, repository) -> dict:
+    """Process every tile in `tiles_folder` once and return throughput, stage latencies and peak RSS."""
+    models_config = [dict(model, api_key="benchmark") for model in config["models_config"]]
+    service = ImageProcessService(
+        roboflow_model_factory=FakeModelFactory(fake_config, ModelClientConfig(**config.get("model_client", {}))),
+        models_config=models_config,
+        repository=repository,
+        image_folder_path=tiles_folder,
+        pipeline_config=config.get("pipeline", {}),
+        detection_config=config.get("detections", {})
+    )
+
+    sampler = RssSampler()
+    sampler.start()
+    try:
+        pipeline = asyncio.run(service.process_images_async())
+    finally:
+        sampler.stop()
+    if pipeline is None:
+        raise RuntimeError(f"No unprocessed tiles found in {tiles_folder}.")
+
+    snapshot = pipeline.snapshot()
+    processed = snapshot[list(snapshot)[-1]]["processed"]
+    return {
+        "images": processed,
+        "elapsed_seconds": round(pipeline.elapsed_seconds, 3),
+        "images_per_second": round(processed / pipeline.elapsed_seconds, 3) if pipeline.elapsed_seconds else 0.0,
+        "peak_rss_mib": round(sampler.peak_bytes / 2 ** 20, 1),
+        "start_rss_mib": round(sampler.start_bytes / 2 ** 20, 1),
+        "stages": {name: {key: stats[key] for key in ("processed", "failed", "p50_seconds", "p95_seconds",
+                                                        "utilization", "max_queue_depth")}
+                   for name, stats in snapshot.items()},
+        "model_clients": {name: client.stats() for name, client in service.roboflow_models.items()},
+    }
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> bool:
+    """Print the change against a baseline report; False if throughput fell by more than `max_regression` %."""
+    current, previous = report["results"], baseline["results"]
+    change = (current["images_per_second"] / previous["images_per_second"] - 1) * 100 \
+        if previous["images_per_second"] else 0.0
+    print(f"images/s: {previous['images_per_second']} -> {current['images_per_second']} ({change:+.1f}%) "
+          f"against {baseline.get('commit') or 'baseline'}")
+    print(f"peak RSS: {previous['peak_rss_mib']} -> {current['peak_rss_mib']} MiB")
+    for name, stats in current["stages"].items():
+        before = previous["stages"].get(name)
+        if before:
+            print(f"  {name}: p95 {before['p95_seconds']}s -> {stats['p95_seconds']}s")
+    return change >= -max_regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of the image processing pipeline.")
+    parser.add_argument("--config", default="config.json", help="pipeline, client and model settings to benchmark")
+    parser.add_argument("--images", type=int, default=TileConfig.count)
+    parser.add_argument("--width", type=int, default=TileConfig.width)
+    parser.add_argument("--height", type=int, default=TileConfig.height)
+    parser.add_argument("--seed", type=int, default=TileConfig.seed)
+    parser.add_argument("--latency", type=float, default=FakeModelConfig.latency_seconds,
+                        help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=FakeModelConfig.latency_jitter_seconds)
+    parser.add_argument("--detections", type=int, default=FakeModelConfig.detections_per_image,
+                        help="solar panels found per image")
+    parser.add_argument("--database", action="store_true", help="store results in the PG_* database")
+    parser.add_argument("--output", help="result file (default: benchmark_results/<time>-<commit>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare with")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="with --baseline, exit 1 when images/s drops by more than this many percent")
+    parser.add_argument("--verbose", action="store_true", help="keep the service's info logging")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    with open(args.config, "r") as file:
+        config = json.load(file)
+
+    tile_config = TileConfig(args.images, args.width, args.height, args.seed)
+    fake_config = FakeModelConfig(args.latency, args.jitter, args.detections)
+    started_at = datetime.now(timezone.utc)
+    repository = create_repository(args.database)
+    try:
+        with tempfile.TemporaryDirectory(prefix="ip_benchmark_") as tiles_folder:
+            # A run-specific prefix keeps a database run from skipping tiles stored by an earlier one.
+            generate_tiles(tiles_folder, tile_config, prefix=f"tile_{started_at:%Y%m%dT%H%M%S}")
+            results = run_benchmark(tiles_folder, config, fake_config, repository)
+    finally:
+        repository.close_connection()
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "created_at": started_at.isoformat(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "repository": "database" if args.database else "memory",
+        "tiles": asdict(tile_config),
+        "fake_model": asdict(fake_config),
+        "pipeline": config.get("pipeline", {}),
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmark_results", f"{started_at:%Y%m%dT%H%M%S}-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{results['images']} images in {results['elapsed_seconds']}s: {results['images_per_second']} images/s, "
+          f"peak RSS {results['peak_rss_mib']} MiB")
+    for name, stats in results["stages"].items():
+        print(f"  {name}: p50 {stats['p50_seconds']}s, p95 {stats['p95_seconds']}s, "
+              f"utilization {stats['utilization']}")
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            if not compare(report, json.load(file), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
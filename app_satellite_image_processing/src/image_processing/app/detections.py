@@ -0,0 +1,96 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BOX_KEYS = ("class", "confidence", "x", "y", "width", "height")
+
+
+@dataclass
+class DetectionColumns:
+    """Detections of one image stored column-wise; x and y are box centres in pixels."""
+    class_names: np.ndarray
+    confidence: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    width: np.ndarray
+    height: np.ndarray
+
+    def __len__(self):
+        return len(self.confidence)
+
+    def take(self, index: np.ndarray) -> "DetectionColumns":
+        """Return the rows selected by a boolean mask or an index array."""
+        return DetectionColumns(
+            class_names=self.class_names[index],
+            confidence=self.confidence[index],
+            x=self.x[index],
+            y=self.y[index],
+            width=self.width[index],
+            height=self.height[index]
+        )
+
+
+@dataclass
+class ClassificationColumns:
+    """Per-class confidences of one multi-class classification result."""
+    class_names: np.ndarray
+    confidence: np.ndarray
+
+    def __len__(self):
+        return len(self.confidence)
+
+
+def detections_from_predictions(predictions: list) -> DetectionColumns:
+    """Convert a Roboflow predictions list into columns, skipping entries without a complete box."""
+    boxes = [p for p in predictions if all(key in p for key in BOX_KEYS)]
+    if len(boxes) < len(predictions):
+        logger.warning(f"Skipped {len(predictions) - len(boxes)} predictions without a complete box.")
+
+    numeric = np.array(
+        [(p["confidence"], p["x"], p["y"], p["width"], p["height"]) for p in boxes],
+        dtype=np.float64
+    ).reshape(-1, 5)
+    return DetectionColumns(
+        class_names=np.array([p["class"] for p in boxes], dtype=object),
+        confidence=numeric[:, 0],
+        x=numeric[:, 1],
+        y=numeric[:, 2],
+        width=numeric[:, 3],
+        height=numeric[:, 4]
+    )
+
+
+def select_valid_detections(columns: DetectionColumns, image_width: Optional[int], image_height: Optional[int],
+                            min_confidence: float = 0.0) -> DetectionColumns:
+    """Keep confident, well-formed boxes that lie inside the image, highest confidence first."""
+    finite = np.isfinite(columns.confidence) & np.isfinite(columns.x) & np.isfinite(columns.y) \
+        & np.isfinite(columns.width) & np.isfinite(columns.height)
+    mask = finite & (columns.confidence >= min_confidence) & (columns.confidence <= 1.0) \
+        & (columns.width > 0) & (columns.height > 0)
+
+    if image_width is not None and image_height is not None:
+        half_width = columns.width / 2
+        half_height = columns.height / 2
+        mask &= (columns.x - half_width >= 0) & (columns.x + half_width <= image_width) \
+            & (columns.y - half_height >= 0) & (columns.y + half_height <= image_height)
+
+    rejected = len(columns) - int(mask.sum())
+    if rejected:
+        logger.info(f"Rejected {rejected} of {len(columns)} detections below confidence or outside the image.")
+
+    selected = columns.take(mask)
+    return selected.take(np.argsort(-selected.confidence, kind="stable"))
+
+
+def classes_from_prediction(prediction: dict, min_confidence: float = 0.0) -> ClassificationColumns:
+    """Convert the class -> details dictionary of a classification prediction into filtered columns."""
+    classes = prediction.get("predictions", {})
+    class_names = np.array(list(classes.keys()), dtype=object)
+    confidence = np.array([details.get("confidence", np.nan) for details in classes.values()], dtype=np.float64)
+
+    mask = np.isfinite(confidence) & (confidence >= min_confidence) & (confidence <= 1.0)
+    return ClassificationColumns(class_names=class_names[mask], confidence=confidence[mask])
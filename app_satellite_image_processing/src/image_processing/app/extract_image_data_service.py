@@ -1,15 +1,43 @@
+import asyncio
 import logging
 import os
-from typing import Tuple, Optional
+from dataclasses import dataclass, field
+from typing import Tuple, Optional, Dict, List
 
 import numpy as np
 from PIL import Image
 from io import BytesIO
 import random
 
-from roboflow_model import RoboflowModelFactory
+from common.metrics import RunMetrics, write_textfile
+from common.profiling import profiled
+from detections import classes_from_prediction, detections_from_predictions, select_valid_detections
+from pipeline import Pipeline, Stage
+from roboflow_model import RoboflowModelFactory, RoboflowModel
 from image_repository import ImageRepository
 
+logger = logging.getLogger(__name__)
+
+ROOF_TYPE_PROJECT = "roof-type-classifier-bafod"
+SOLAR_PANEL_PROJECT = "solar-panels-81zxz"
+
+PIPELINE_STAGES = ["discover", "load", "infer", "annotate", "encode", "persist"]
+
+
+@dataclass
+class ImageWorkItem:
+    """State of one image as it moves through the processing pipeline."""
+    filename: str
+    path: str
+    image_id: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    image_data: Optional[bytes] = field(default=None, repr=False)
+    model_names: List[str] = field(default_factory=list)
+    results: Dict[str, dict] = field(default_factory=dict, repr=False)
+    annotated_images: Dict[str, np.ndarray] = field(default_factory=dict, repr=False)
+    encoded_images: Dict[str, bytes] = field(default_factory=dict, repr=False)
+
 
 class ImageProcessService:
     def __init__(
@@ -17,12 +45,18 @@ class ImageProcessService:
             roboflow_model_factory: RoboflowModelFactory,
             models_config: list,
             repository: ImageRepository,
-            image_folder_path: str
+            image_folder_path: str,
+            pipeline_config: Optional[dict] = None,
+            detection_config: Optional[dict] = None
     ):
         self.roboflow_models = {}
         self.roboflow_model = roboflow_model_factory
         self.repository = repository
         self.image_folder_path = image_folder_path
+        self.pipeline_config = pipeline_config or {}
+        self.detection_config = detection_config or {}
+        self._processing_state = {}
+        self.metrics = RunMetrics("image_processing")
 
         for config in models_config:
             api_key = config['api_key']
@@ -39,7 +73,7 @@ class ImageProcessService:
             all_files = os.listdir(self.image_folder_path)
             return [f for f in all_files if f.endswith(file_extension)]
         except Exception as e:
-            logging.error(f"Error accessing folder: {e}")
+            logger.error(f"Error accessing folder: {e}")
             return []
 
     @staticmethod
@@ -49,32 +83,159 @@ class ImageProcessService:
         longitude = random.uniform(16.16, 22.89)
         return latitude, longitude
 
+    @profiled("image_processing.process_images")
     def process_images(self):
+        asyncio.run(self.process_images_async())
+
+    async def process_images_async(self):
         images = self._get_files_from_folder()
-        for image_filename in images:
-            logging.info(f"Processing image: {image_filename}")
-            image_path = os.path.join(self.image_folder_path, image_filename)
-            self._process_single_image(image_filename, image_path)
-
-    def _process_single_image(self, image_filename: str, image_path: str):
-        existing_image = self.repository.get_image_by_filename(image_filename)
-        if existing_image:
-            logging.info(f"Image {image_filename} already exists in the database. Skipping insertion.")
-            image_id = existing_image[0]
-        else:
-            image_id = self._insert_image(image_filename, image_path)
+        logger.info(f"Found {len(images)} images in {self.image_folder_path}")
+
+        # One query tells which files are already fully processed, so a run with
+        # nothing to do returns before any model is resolved or thread is started.
+        self._processing_state = self.repository.get_processing_state()
+        pending = [image for image in images if self._needs_processing(image)]
+        if not pending:
+            logger.info("All images are already processed. Nothing to do.")
+            return None
+
+        pipeline = self._build_pipeline()
+        await pipeline.run(pending)
+
+        for model_name, roboflow_model in self.roboflow_models.items():
+            logger.info(f"Model client {model_name}: {roboflow_model.stats()}")
+        self.metrics.log_summary()
+        write_textfile(self.metrics)
+        return pipeline
+
+    def _needs_processing(self, image_filename: str) -> bool:
+        state = self._processing_state.get(image_filename)
+        if state is None:
+            return True
+        _, has_predictions, has_detections = state
+        return bool(self._models_to_run(has_predictions, has_detections))
+
+    def _build_pipeline(self) -> Pipeline:
+        """Wire the processing steps into a pipeline using the configured concurrency."""
+        # The adaptive limiters of the model clients decide how many calls are in flight, so the infer stage has a
+        # worker for every slot they may open.
+        concurrency = dict(self.pipeline_config.get("concurrency", {}), infer=self._infer_workers())
+
+        handlers = {
+            "discover": self._discover,
+            "load": self._load,
+            "infer": self._infer,
+            "annotate": self._annotate,
+            "encode": self._encode,
+            "persist": self._persist,
+        }
+        stages = [
+            Stage(
+                name=name,
+                handler=handlers[name],
+                concurrency=concurrency.get(name, 1)
+            )
+            for name in PIPELINE_STAGES
+        ]
+
+        return Pipeline(
+            stages,
+            queue_size=self.pipeline_config.get("queue_size", 8),
+            stats_interval=self.pipeline_config.get("stats_interval_seconds", 5.0),
+            metrics=self.metrics
+        )
+
+    def _infer_workers(self) -> int:
+        return max((int(model.config.max_concurrency) for model in self.roboflow_models.values()), default=1)
+
+    def _discover(self, image_filename: str) -> Optional[ImageWorkItem]:
+        logger.info(f"Processing image: {image_filename}")
+        item = ImageWorkItem(
+            filename=image_filename,
+            path=os.path.join(self.image_folder_path, image_filename)
+        )
+
+        state = self._processing_state.get(image_filename)
+        if state is None:
+            item.model_names = self._models_to_run(has_predictions=False, has_detections=False)
+            return item
+
+        logger.info(f"Image {image_filename} already exists in the database. Skipping insertion.")
+        item.image_id, has_predictions, has_detections = state
+        item.model_names = self._models_to_run(has_predictions, has_detections)
+        return item if item.model_names else None
+
+    def _models_to_run(self, has_predictions: bool, has_detections: bool) -> List[str]:
+        """Return the models whose results are still missing for an image."""
+        model_names = []
+        for model_name in self.roboflow_models:
+            project_name = self._project_name(model_name)
+            if project_name == ROOF_TYPE_PROJECT and has_predictions:
+                continue
+            if project_name == SOLAR_PANEL_PROJECT and has_detections:
+                continue
+            model_names.append(model_name)
+        return model_names
 
-        if image_id is not None:
-            self._process_with_models(image_path, image_id)
+    def _load(self, item: ImageWorkItem) -> ImageWorkItem:
+        item.image_data = self.read_image_file(item.path)
+        self.metrics.record("load", 0.0, bytes=len(item.image_data), calls=0)
+        with Image.open(BytesIO(item.image_data)) as img:
+            item.width, item.height = img.size
+        return item
 
-    def _insert_image(self, image_filename: str, image_path: str):
-        with Image.open(image_path) as img:
-            width, height = img.size
-            image_data = self.read_image_file(image_path)
+    def _infer(self, item: ImageWorkItem) -> ImageWorkItem:
+        for model_name in item.model_names:
+            logger.info(f"Processing image with model: {model_name}")
+            try:
+                item.results[model_name] = self.roboflow_models[model_name].predict(item.path)
+            except Exception as e:
+                logger.error("Error predicting image %s with model %s: %s", item.path, model_name, e)
+        return item
 
-        image_id = self.repository.insert_image(width, height, image_filename, image_data)
+    def _annotate(self, item: ImageWorkItem) -> ImageWorkItem:
+        for model_name, result_json in item.results.items():
+            if self._project_name(model_name) != SOLAR_PANEL_PROJECT:
+                continue
+            try:
+                import cv2
+                image = cv2.imdecode(np.frombuffer(item.image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                item.annotated_images[model_name] = RoboflowModel.annotate(image, result_json)
+            except Exception as e:
+                logger.warning("Error annotating image %s: %s", item.path, e)
+        return item
+
+    def _encode(self, item: ImageWorkItem) -> ImageWorkItem:
+        for model_name, annotated_image in item.annotated_images.items():
+            item.encoded_images[model_name] = self.convert_annotated_image_to_bytes(annotated_image)
+            self.metrics.record("encode", 0.0, bytes=len(item.encoded_images[model_name] or b""), calls=0)
+        # The pixels are no longer needed once encoded; drop them before the item waits in the persist queue.
+        item.annotated_images.clear()
+        return item
+
+    def _persist(self, item: ImageWorkItem) -> Optional[ImageWorkItem]:
+        if item.image_id is None:
+            item.image_id = self._insert_image(item)
+            if item.image_id is None:
+                return None
+
+        for model_name, result_json in item.results.items():
+            self._handle_model_results(
+                self._project_name(model_name),
+                result_json,
+                item.encoded_images.get(model_name),
+                item
+            )
+        self.repository.notify_image_processed(item.image_id)
+        return item
+
+    def _project_name(self, model_name: str) -> str:
+        return self.roboflow_models[model_name].params.project_name
+
+    def _insert_image(self, item: ImageWorkItem):
+        image_id = self.repository.insert_image(item.width, item.height, item.filename, item.image_data)
         if image_id is None:
-            logging.error(f"Failed to insert image {image_filename} into the database.")
+            logger.error(f"Failed to insert image {item.filename} into the database.")
             return None
 
         self._insert_coordinate_if_needed(image_id)
@@ -87,69 +248,54 @@ class ImageProcessService:
             latitude, longitude = random_coord
             self.repository.insert_coordinate(image_id, latitude, longitude)
 
-    def _process_with_models(self, image_path: str, image_id: int):
-        for model_name, roboflow_model in self.roboflow_models.items():
-
-            if model_name == "roof-type-classifier-bafod" and not self.repository.has_predictions(image_id):
-                continue
-
-            if model_name == "solar-panels-81zxz" and not self.repository.has_detections(image_id):
-                continue
-
-            logging.info(f"Processing image with model: {model_name}")
-            result = roboflow_model.process_single_image(image_path)
-
-            if result is not None:
-                self._handle_model_results(result, image_id)
-
-    def _handle_model_results(self, result, image_id: int):
-        result_json = result.result_json
-
-        if result.project_name == "roof-type-classifier-bafod":
-            self._process_roof_type_predictions(result_json, image_id)
-        elif result.project_name == "solar-panels-81zxz":
-            self._process_solar_panel_detections(result_json, result.annotated_image, image_id)
+    def _handle_model_results(self, project_name: str, result_json, annotated_image_data: Optional[bytes],
+                              item: ImageWorkItem):
+        if project_name == ROOF_TYPE_PROJECT:
+            self._process_roof_type_predictions(result_json, item.image_id)
+        elif project_name == SOLAR_PANEL_PROJECT:
+            self._process_solar_panel_detections(
+                result_json, annotated_image_data, item.image_id, item.width, item.height
+            )
 
     def _process_roof_type_predictions(self, result_json, image_id: int):
         if "predictions" in result_json and result_json["predictions"]:
             first_prediction = result_json["predictions"][0]
             if "predictions" in first_prediction:
-                for class_name, details in first_prediction["predictions"].items():
-                    confidence = details.get("confidence")
-                    self.repository.insert_prediction_roof_type(
+                classes = classes_from_prediction(
+                    first_prediction,
+                    min_confidence=self.detection_config.get("min_roof_type_confidence", 0.0)
+                )
+                if len(classes):
+                    self.repository.insert_predictions_roof_type_bulk(
                         image_id=image_id,
-                        class_name=class_name,
+                        class_names=classes.class_names.tolist(),
+                        confidences=classes.confidence.tolist(),
                         time_taken=first_prediction.get("time"),
-                        confidence=confidence,
-                        prediction_type="roof-type-classifier-bafod"  # Example, adjust as necessary
+                        prediction_type=ROOF_TYPE_PROJECT
                     )
 
-    def _process_solar_panel_detections(self, result_json, annotated_image: np.ndarray, image_id: int):
-        if "predictions" in result_json and result_json["predictions"]:
-            first_prediction = result_json["predictions"][0]
+    def _process_solar_panel_detections(self, result_json, image_data: Optional[bytes], image_id: int,
+                                        image_width: Optional[int] = None, image_height: Optional[int] = None):
+        detections = select_valid_detections(
+            detections_from_predictions(result_json.get("predictions") or []),
+            image_width,
+            image_height,
+            min_confidence=self.detection_config.get("min_confidence", 0.0)
+        )
 
-            if all(key in first_prediction for key in ["class", "confidence", "x", "y", "width", "height"]):
-                class_name = first_prediction["class"]
-                confidence = first_prediction["confidence"]
-                x = first_prediction["x"]
-                y = first_prediction["y"]
-                width = first_prediction["width"]
-                height = first_prediction["height"]
-
-                image_data = self.convert_annotated_image_to_bytes(annotated_image)
-
-                self.repository.insert_detection_solar_panel(
-                    image_id=image_id,
-                    class_name=class_name,
-                    confidence=confidence,
-                    x=x,
-                    y=y,
-                    width=width,
-                    height=height,
-                    image_data=image_data
-                )
-            else:
-                self.repository.insert_no_predictions(image_id)
+        if len(detections):
+            self.repository.insert_detections_solar_panel_bulk(
+                image_id=image_id,
+                class_names=detections.class_names.tolist(),
+                confidences=detections.confidence.tolist(),
+                xs=detections.x.tolist(),
+                ys=detections.y.tolist(),
+                widths=detections.width.tolist(),
+                heights=detections.height.tolist(),
+                image_data=image_data
+            )
+        else:
+            self.repository.insert_no_predictions(image_id)
 
     @staticmethod
     def convert_annotated_image_to_bytes(annotated_image: np.ndarray) -> Optional[bytes]:
@@ -161,7 +307,7 @@ class ImageProcessService:
             byte_stream.seek(0)
             return byte_stream.read()
         else:
-            logging.info("Annotated image is None.")
+            logger.info("Annotated image is None.")
             return None
 
     @staticmethod
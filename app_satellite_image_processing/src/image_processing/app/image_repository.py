@@ -1,66 +1,92 @@
-import os
+import hashlib
 import logging
-import psycopg2
-from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.notifications import IMAGE_PROCESSED_CHANNEL, notify
 
 # Ensure you have a logger configured
 logger = logging.getLogger(__name__)
 
+# Stores an annotated image once, by its sha256 (source migration V003); the statement it prefixes references it.
+STORE_ANNOTATED_IMAGE = """
+    WITH annotated_image AS (
+        INSERT INTO satellite_image_processing.annotated_images (sha256, image_data)
+        VALUES (%(sha256)s, %(image_data)s)
+        ON CONFLICT (sha256) DO NOTHING
+    )
+"""
+
 
-@dataclass
-class PostgresConfig:
-    dbname: str
-    user: str
-    password: str
-    host: str
-    port: int
+def with_annotated_image(query: str, image_data: Optional[bytes]) -> Tuple[str, dict]:
+    """Prefix `query` with the store of the annotated image; its %(sha256)s is the reference (NULL without one)."""
+    if image_data is None:
+        return query, {"sha256": None}
+    return STORE_ANNOTATED_IMAGE + query, {"sha256": hashlib.sha256(image_data).hexdigest(), "image_data": image_data}
 
-    def __post_init__(self):
-        # Check if any of the required fields are missing
-        missing_fields = [
-            field for field in ["dbname", "user", "password", "host", "port"]
-            if getattr(self, field) is None
-        ]
-        if missing_fields:
-            raise ValueError(f"Missing required database configuration fields: {', '.join(missing_fields)}")
+__all__ = ["ImageRepository", "PostgresConfig"]
 
 
 class ImageRepository:
-    def __init__(self, config: PostgresConfig):
-        self.connection = self.create_connection(config)
-        self.cursor = self.connection.cursor()
+    """Data access for the source schema; every call checks a connection out of a shared pool,
+    so the repository can be used from several pipeline workers at once."""
 
-    def create_connection(self, config: PostgresConfig):
-        """Establish a connection to the PostgreSQL database."""
+    def __init__(self, config: PostgresConfig, pool_config: Optional[PoolConfig] = None):
+        self.pool = self.create_pool(config, pool_config)
+
+    def create_pool(self, config: PostgresConfig, pool_config: Optional[PoolConfig] = None) -> ConnectionPool:
+        """Open the pool of PostgreSQL connections."""
         try:
-            connection = psycopg2.connect(
-                dbname=config.dbname,
-                user=config.user,
-                password=config.password,
-                host=config.host,
-                port=config.port,
-            )
-            logger.info("PostgreSQL connection established.")
-            return connection
+            pool = ConnectionPool(config, pool_config or PoolConfig(application_name="image_processing"))
+            logger.info("PostgreSQL connection pool established.")
+            return pool
         except Exception as e:
             logger.error(f"Error connecting to PostgreSQL: {e}")
             raise
 
+    def _fetch_one(self, query: str, params: tuple = ()):
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+    def _fetch_all(self, query: str, params: tuple = ()):
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def _write(self, query: str, params: tuple, returning: str = "none"):
+        """Run a write in its own transaction; `returning` is 'none', 'one' or 'all'."""
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query, params)
+            result = None
+            if returning == "one":
+                result = cursor.fetchone()[0]
+            elif returning == "all":
+                result = [row[0] for row in cursor.fetchall()]
+            connection.commit()
+            return result
+
     def has_predictions(self, image_id: int) -> bool:
         """Check if there are existing predictions for the given image ID."""
         query = "SELECT COUNT(*) FROM satellite_image_processing.predictions_roof_type WHERE image_id = %s;"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (image_id,))
-            count = cursor.fetchone()[0]
-        return count > 0
+        return self._fetch_one(query, (image_id,))[0] > 0
 
     def has_detections(self, image_id: int) -> bool:
         """Check if there are existing detections for the given image ID."""
         query = "SELECT COUNT(*) FROM satellite_image_processing.detection_solar_panel WHERE image_id = %s;"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (image_id,))
-            count = cursor.fetchone()[0]
-        return count > 0
+        return self._fetch_one(query, (image_id,))[0] > 0
+
+    def get_processing_state(self) -> dict:
+        """Map every stored filename to (image_id, has_predictions, has_detections) in a single query."""
+        query = """
+        SELECT i.filename,
+               i.image_id,
+               EXISTS (SELECT 1 FROM satellite_image_processing.predictions_roof_type p WHERE p.image_id = i.image_id),
+               EXISTS (SELECT 1 FROM satellite_image_processing.detection_solar_panel d WHERE d.image_id = i.image_id)
+        FROM satellite_image_processing.images i;
+        """
+        return {filename: (image_id, has_predictions, has_detections)
+                for filename, image_id, has_predictions, has_detections in self._fetch_all(query)}
 
     # Images Table Methods
     def insert_image(self, width: int, height: int, filename: str, image_data: bytes):
@@ -71,36 +97,29 @@ class ImageRepository:
         """
         params = (width, height, filename, image_data)
         try:
-            self.cursor.execute(query, params)
-            image_id = self.cursor.fetchone()[0]
-            self.connection.commit()
+            image_id = self._write(query, params, returning="one")
             logger.info(f"Inserted image with ID: {image_id}")
             return image_id
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting image: {e}")
             return None
 
     def fetch_image(self, image_id: int):
         query = "SELECT * FROM satellite_image_processing.images WHERE image_id = %s;"
-        self.cursor.execute(query, (image_id,))
-        return self.cursor.fetchone()
+        return self._fetch_one(query, (image_id,))
 
     def fetch_all_images(self):
         query = "SELECT * FROM satellite_image_processing.images;"
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        return self._fetch_all(query)
 
     def delete_image(self, image_id: int):
         query = "DELETE FROM satellite_image_processing.images WHERE image_id = %s;"
-        self.cursor.execute(query, (image_id,))
-        self.connection.commit()
+        self._write(query, (image_id,))
 
     def get_image_by_filename(self, filename: str):
         """Fetch an image by its filename."""
         query = "SELECT * FROM satellite_image_processing.images WHERE filename = %s;"
-        self.cursor.execute(query, (filename,))
-        result = self.cursor.fetchone()
+        result = self._fetch_one(query, (filename,))
         if result:
             logger.info(f"Fetched image with filename: {filename}")
         else:
@@ -116,13 +135,10 @@ class ImageRepository:
         """
         params = (image_id, latitude, longitude)
         try:
-            self.cursor.execute(query, params)
-            coordinates_id = self.cursor.fetchone()[0]
-            self.connection.commit()
+            coordinates_id = self._write(query, params, returning="one")
             logger.info(f"Inserted coordinates with ID: {coordinates_id}")
             return coordinates_id
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting coordinates: {e}")
             return None
 
@@ -136,41 +152,79 @@ class ImageRepository:
         """
         params = (image_id, class_name, time_taken, confidence, prediction_type)
         try:
-            self.cursor.execute(query, params)
-            prediction_id = self.cursor.fetchone()[0]
-            self.connection.commit()
+            prediction_id = self._write(query, params, returning="one")
             logger.info(f"Inserted roof type prediction with ID: {prediction_id}")
             return prediction_id
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting roof type prediction: {e}")
             return None
 
+    def insert_predictions_roof_type_bulk(self, image_id: int, class_names: list, confidences: list,
+                                          time_taken: float, prediction_type: str):
+        """Insert all class confidences of one classification result in a single statement."""
+        query = """
+        INSERT INTO satellite_image_processing.predictions_roof_type (image_id, class_name, time_taken, confidence, prediction_type)
+        SELECT %s, t.class_name, %s, t.confidence, %s
+        FROM unnest(%s::text[], %s::float8[]) AS t(class_name, confidence)
+        RETURNING prediction_id;
+        """
+        params = (image_id, time_taken, prediction_type, class_names, confidences)
+        try:
+            prediction_ids = self._write(query, params, returning="all")
+            logger.info(f"Inserted {len(prediction_ids)} roof type predictions for image_id: {image_id}")
+            return prediction_ids
+        except Exception as e:
+            logger.error(f"Error inserting roof type predictions: {e}")
+            return None
+
     # Detection Solar Panel Methods
     def insert_detection_solar_panel(self, image_id: int, class_name: str, confidence: float, x: float, y: float,
                                      width: float, height: float, image_data: bytes):
-        query = """
-        INSERT INTO satellite_image_processing.detection_solar_panel (image_id, class_name, confidence, x, y, width, height, image_data)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        query, params = with_annotated_image("""
+        INSERT INTO satellite_image_processing.detection_solar_panel (image_id, class_name, confidence, x, y, width, height, image_sha256)
+        VALUES (%(image_id)s, %(class_name)s, %(confidence)s, %(x)s, %(y)s, %(width)s, %(height)s, %(sha256)s)
         RETURNING detection_id;
-        """
-        params = (image_id, class_name, confidence, x, y, width, height, image_data)
+        """, image_data)
+        params.update(image_id=image_id, class_name=class_name, confidence=confidence, x=x, y=y, width=width,
+                      height=height)
         try:
-            self.cursor.execute(query, params)
-            detection_id = self.cursor.fetchone()[0]
-            self.connection.commit()
+            detection_id = self._write(query, params, returning="one")
             logger.info(f"Inserted solar panel detection with ID: {detection_id}")
             return detection_id
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting solar panel detection: {e}")
             return None
 
+    def insert_detections_solar_panel_bulk(self, image_id: int, class_names: list, confidences: list, xs: list,
+                                           ys: list, widths: list, heights: list, image_data: bytes):
+        """Insert every detection box of one image in a single statement.
+
+        The columns are sent as arrays and expanded server side, and the annotated
+        image is transferred and stored once, however many boxes share it; every
+        row references it by its sha256.
+        """
+        query, params = with_annotated_image("""
+        INSERT INTO satellite_image_processing.detection_solar_panel (image_id, class_name, confidence, x, y, width, height, image_sha256)
+        SELECT %(image_id)s, t.class_name, t.confidence, t.x, t.y, t.width, t.height, %(sha256)s
+        FROM unnest(%(class_names)s::text[], %(confidences)s::float8[], %(xs)s::float8[], %(ys)s::float8[],
+                    %(widths)s::float8[], %(heights)s::float8[])
+            AS t(class_name, confidence, x, y, width, height)
+        RETURNING detection_id;
+        """, image_data)
+        params.update(image_id=image_id, class_names=class_names, confidences=confidences, xs=xs, ys=ys,
+                      widths=widths, heights=heights)
+        try:
+            detection_ids = self._write(query, params, returning="all")
+            logger.info(f"Inserted {len(detection_ids)} solar panel detections for image_id: {image_id}")
+            return detection_ids
+        except Exception as e:
+            logger.error(f"Error inserting solar panel detections: {e}")
+            return None
+
     def get_first_coordinate_by_image_id(self, image_id: int):
         """Fetch the first coordinate by image ID."""
         query = "SELECT * FROM satellite_image_processing.coordinates WHERE image_id = %s LIMIT 1;"
-        self.cursor.execute(query, (image_id,))
-        return self.cursor.fetchone()
+        return self._fetch_one(query, (image_id,))
 
     def insert_no_predictions(self, image_id: int):
         """Insert a placeholder entry indicating no predictions for the given image ID."""
@@ -180,17 +234,21 @@ class ImageRepository:
         """
         params = (image_id,)
         try:
-            self.cursor.execute(query, params)
-            self.connection.commit()
+            self._write(query, params)
             logger.info(f"Inserted placeholder for no predictions for image_id: {image_id}")
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting placeholder for no predictions: {e}")
 
+    def notify_image_processed(self, image_id: int):
+        """Tell listeners such as the ETL daemon that an image and its results are stored."""
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                notify(cursor, IMAGE_PROCESSED_CHANNEL, str(image_id))
+                connection.commit()
+        except Exception as e:
+            logger.warning(f"Could not send {IMAGE_PROCESSED_CHANNEL} notification for image_id {image_id}: {e}")
+
     def close_connection(self):
-        """Close the database connection."""
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+        """Close every pooled database connection."""
+        self.pool.close()
         logger.info("PostgreSQL connection closed.")
@@ -1,16 +1,16 @@
-import logging
 import os
 
+from common.logging_config import LoggingConfig, configure_logging
 
-def setup_logging():
-    log_folder = os.path.join(os.path.dirname(__file__), 'logs')
-    os.makedirs(log_folder, exist_ok=True)
+# Loggers writing one or more lines per image; only a sample of their INFO lines is kept.
+SAMPLE_RATES = {
+    "image_repository": 0.01,
+    "extract_image_data_service": 0.1,
+    "roboflow_model": 0.1,
+}
+
+LOG_FOLDER = os.path.join(os.path.dirname(__file__), 'logs')
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(os.path.join(os.path.dirname(__file__), 'logs', 'app.log'))
-        ]
-    )
+
+def setup_logging():
+    return configure_logging("image_processing", LOG_FOLDER, LoggingConfig.from_env(SAMPLE_RATES))
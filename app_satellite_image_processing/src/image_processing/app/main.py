@@ -6,8 +6,15 @@ from dotenv import load_dotenv
 
 from extract_image_data_service import ImageProcessService
 from roboflow_model import RoboflowModelFactory
-from logging_config import setup_logging
+from model_client import ModelClientConfig
+from model_cache import ModelMetadataCache
+from logging_config import LOG_FOLDER, setup_logging
 from image_repository import ImageRepository, PostgresConfig
+from common.db import PoolConfig
+from common.migrations import apply_migrations
+from common.profiling import configure_profiling
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 
 def load_config(config_file):
@@ -22,9 +29,18 @@ def load_config(config_file):
     return config, image_folder_path
 
 
+def migrations_dir() -> str:
+    """Source schema migrations: next to the app in its image, ../../../postgres/sql/migrations in the repo."""
+    bundled = os.path.join(APP_FOLDER, "migrations")
+    if os.path.isdir(bundled):
+        return bundled
+    return os.path.join(APP_FOLDER, "..", "..", "..", "postgres", "sql", "migrations")
+
+
 def main():
     load_dotenv()
     setup_logging()
+    configure_profiling(LOG_FOLDER)
 
     config, image_folder_path = load_config('config.json')
     models_config = config['models_config']
@@ -37,20 +53,34 @@ def main():
         port=int(os.getenv("PG_PORT"))
     )
 
-    roboflow_model_factory = RoboflowModelFactory()
-    image_repository = ImageRepository(pg_config)
+    cache_config = config.get('model_cache', {})
+    metadata_cache = ModelMetadataCache(
+        path=cache_config.get('path', os.path.join('cache', 'model_metadata.json')),
+        ttl_seconds=cache_config.get('ttl_seconds', 86400)
+    )
+    roboflow_model_factory = RoboflowModelFactory(
+        ModelClientConfig(**config.get('model_client', {})),
+        metadata_cache
+    )
+    image_repository = ImageRepository(pg_config, PoolConfig.from_env("image_processing"))
 
     data_service = ImageProcessService(
         roboflow_model_factory=roboflow_model_factory,
         models_config=models_config,
         repository=image_repository,
-        image_folder_path=image_folder_path
+        image_folder_path=image_folder_path,
+        pipeline_config=config.get('pipeline', {}),
+        detection_config=config.get('detections', {})
     )
 
     try:
+        with image_repository.pool.connection() as connection:
+            apply_migrations(connection, os.getenv("MIGRATIONS_DIR") or migrations_dir(), "satellite_image_processing")
         data_service.process_images()
     except Exception as e:
         logging.error(e)
+    finally:
+        image_repository.close_connection()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ModelMetadataCache:
+    """JSON file cache of resolved model metadata with a time-to-live.
+
+    Resolving a Roboflow model costs several remote calls (key check, workspace,
+    project, version); the answers rarely change, so they are kept on disk and
+    reused by later runs until they are older than `ttl_seconds`.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 86400):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._read().get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["cached_at"] > self.ttl_seconds:
+            logger.info(f"Cached metadata for {key} expired.")
+            return None
+        return entry["metadata"]
+
+    def put(self, key: str, metadata: dict):
+        with self._lock:
+            entries = self._read()
+            entries[key] = {"cached_at": time.time(), "metadata": metadata}
+            self._write(entries)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable model metadata cache {self.path}: {e}")
+            return {}
+
+    def _write(self, entries: dict):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(entries, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write model metadata cache {self.path}: {e}")
@@ -0,0 +1,285 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+THROTTLE_STATUS_CODE = 429
+
+
+class CircuitOpenError(Exception):
+    """Raised when a model stays paused by its circuit breaker for longer than allowed."""
+
+
+@dataclass
+class ModelClientConfig:
+    initial_concurrency: float = 4
+    min_concurrency: float = 1
+    max_concurrency: float = 16
+    additive_increase: float = 1.0
+    multiplicative_decrease: float = 0.5
+    decrease_cooldown_seconds: float = 1.0
+    max_retries: int = 4
+    backoff_base_seconds: float = 0.5
+    backoff_max_seconds: float = 30.0
+    breaker_window: int = 20
+    breaker_min_calls: int = 10
+    breaker_error_rate: float = 0.5
+    breaker_cooldown_seconds: float = 30.0
+    max_pause_seconds: float = 120.0
+
+    def __post_init__(self):
+        if not 0 < self.multiplicative_decrease < 1:
+            raise ValueError("multiplicative_decrease must be between 0 and 1.")
+        if not 1 <= self.min_concurrency <= self.initial_concurrency <= self.max_concurrency:
+            raise ValueError("Concurrency limits must satisfy 1 <= min <= initial <= max.")
+
+
+@dataclass
+class ModelClientStats:
+    calls: int = 0
+    successes: int = 0
+    failures: int = 0
+    retries: int = 0
+    throttles: int = 0
+    breaker_opens: int = 0
+    breaker_state: str = "closed"
+    concurrency_limit: float = 0.0
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """HTTP status of a failed call, from the response the error carries or its own status_code attribute."""
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is None:
+        status_code = getattr(error, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def classify_error(error: Exception) -> str:
+    """Return 'throttle', 'retryable' or 'fatal' for an exception raised by the model backend.
+
+    Only the HTTP status and the exception type count; the message is never
+    parsed, so an error mentioning e.g. `image_500.jpg` is not taken for a 500.
+    """
+    status_code = _status_code(error)
+    if status_code == THROTTLE_STATUS_CODE:
+        return "throttle"
+    if status_code in RETRYABLE_STATUS_CODES:
+        return "retryable"
+
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return "retryable"
+    try:
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return "retryable"
+    except ImportError:
+        pass
+    return "fatal"
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on the number of in-flight calls, shared by all worker threads.
+
+    Every success grows the limit by `additive_increase / limit` (about one slot
+    per full window of successes); a throttle response cuts it by
+    `multiplicative_decrease`, at most once per cooldown so a burst of 429s from
+    the same window only counts once.
+    """
+
+    def __init__(self, config: ModelClientConfig):
+        self.config = config
+        self.limit = float(config.initial_concurrency)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.config.max_concurrency, self.limit + self.config.additive_increase / self.limit)
+            self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.config.decrease_cooldown_seconds:
+                return
+            self._last_decrease = now
+            self.limit = max(self.config.min_concurrency, self.limit * self.config.multiplicative_decrease)
+            logger.warning(f"Model backend throttled us, concurrency limit lowered to {self.limit:.2f}")
+
+
+class CircuitBreaker:
+    """Opens when the error rate over the last `breaker_window` calls reaches the threshold.
+
+    While open every caller waits; after the cooldown a single probe call is let
+    through (half-open) and its outcome closes or re-opens the breaker. Calls that
+    were already in flight when the breaker opened finish without deciding anything.
+    """
+
+    def __init__(self, name: str, config: ModelClientConfig):
+        self.name = name
+        self.config = config
+        self.state = "closed"
+        self.opens = 0
+        self._outcomes = deque(maxlen=config.breaker_window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def wait_until_allowed(self) -> bool:
+        """Block while the breaker is open; returns True for the probe call, whose outcome must be recorded."""
+        deadline = time.monotonic() + self.config.max_pause_seconds
+        while True:
+            with self._lock:
+                if self.state == "closed":
+                    return False
+                now = time.monotonic()
+                if self.state == "open" and now - self._opened_at >= self.config.breaker_cooldown_seconds:
+                    self.state = "half_open"
+                if self.state == "half_open" and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return True
+                remaining = self._opened_at + self.config.breaker_cooldown_seconds - now
+
+            if time.monotonic() >= deadline:
+                raise CircuitOpenError(f"Model {self.name} is paused by its circuit breaker.")
+            time.sleep(min(max(remaining, 0.1), 1.0))
+
+    def record(self, success: bool, probe: bool = False):
+        with self._lock:
+            if self.state != "closed" and not probe:
+                # A call let through before the breaker opened; the probe alone decides when to close it.
+                return
+            if probe:
+                self._probe_in_flight = False
+                if success:
+                    logger.info(f"Circuit breaker for {self.name} closed.")
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            if len(self._outcomes) < self.config.breaker_min_calls:
+                return
+            error_rate = self._outcomes.count(False) / len(self._outcomes)
+            if self.state == "closed" and error_rate >= self.config.breaker_error_rate:
+                self._open()
+
+    def abandon_probe(self):
+        """Free the half-open breaker for another probe when the probe call ended without an outcome."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _open(self):
+        self.state = "open"
+        self.opens += 1
+        self._opened_at = time.monotonic()
+        logger.warning(f"Circuit breaker for {self.name} opened, pausing calls for "
+                       f"{self.config.breaker_cooldown_seconds}s.")
+
+
+class ResilientModelClient:
+    """Wraps a model backend with adaptive concurrency, retries and a circuit breaker.
+
+    Exposes the same `predict` and `params` as the wrapped model, so callers do
+    not need to know whether they talk to the backend directly.
+    """
+
+    def __init__(self, model, config: Optional[ModelClientConfig] = None):
+        self.model = model
+        self.params = model.params
+        self.config = config or ModelClientConfig()
+        self.limiter = AdaptiveConcurrencyLimiter(self.config)
+        self.breaker = CircuitBreaker(model.params.project_name, self.config)
+        self._stats = ModelClientStats()
+        self._stats_lock = threading.Lock()
+
+    def predict(self, image_path: str) -> dict:
+        self._count("calls")
+        attempt = 0
+        while True:
+            probe = self.breaker.wait_until_allowed()
+            outcome_recorded = False
+            try:
+                self.limiter.acquire()
+                try:
+                    result = self.model.predict(image_path)
+                except Exception as e:
+                    kind = classify_error(e)
+                    # A fatal error means the backend answered and rejected this request, so it is not a sign of an
+                    # outage.
+                    self.breaker.record(success=kind == "fatal", probe=probe)
+                    outcome_recorded = True
+                    if kind == "throttle":
+                        self._count("throttles")
+                        self.limiter.on_throttle()
+
+                    if kind == "fatal" or attempt >= self.config.max_retries:
+                        self._count("failures")
+                        raise
+
+                    attempt += 1
+                    self._count("retries")
+                    delay = self._backoff_delay(attempt, _retry_after_seconds(e))
+                    logger.warning(f"Retrying {image_path} on {self.params.project_name} in {delay:.2f}s "
+                                   f"(attempt {attempt}/{self.config.max_retries}): {e}")
+                else:
+                    self.breaker.record(success=True, probe=probe)
+                    outcome_recorded = True
+                    self.limiter.on_success()
+                    self._count("successes")
+                    return result
+                finally:
+                    self.limiter.release()
+            finally:
+                if probe and not outcome_recorded:
+                    # Interrupted before it had an outcome, e.g. cancelled; the next caller probes instead.
+                    self.breaker.abandon_probe()
+
+            time.sleep(delay)
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+        ceiling = min(self.config.backoff_max_seconds, self.config.backoff_base_seconds * 2 ** (attempt - 1))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            setattr(self._stats, counter, getattr(self._stats, counter) + 1)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            self._stats.breaker_state = self.breaker.state
+            self._stats.breaker_opens = self.breaker.opens
+            self._stats.concurrency_limit = round(self.limiter.limit, 2)
+            return asdict(self._stats)
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from common.metrics import RunMetrics
+
+logger = logging.getLogger(__name__)
+
+# Marker pushed through a queue once its producer has nothing more to send.
+_DONE = object()
+
+# Item durations kept per stage for the latency percentiles; older ones are dropped.
+LATENCY_SAMPLES = 10000
+
+
+@dataclass
+class Stage:
+    """A named pipeline step whose blocking handler runs on `concurrency` workers.
+
+    The handler receives one item and returns the item for the next stage, or
+    None to drop it. A stage can bring its own executor, e.g. a single-thread one
+    to serialize access to a resource that is not thread-safe.
+    """
+    name: str
+    handler: Callable[[Any], Any]
+    concurrency: int = 1
+    executor: Optional[Executor] = None
+
+    def __post_init__(self):
+        if self.concurrency < 1:
+            raise ValueError(f"Stage '{self.name}' needs a concurrency of at least 1.")
+
+
+@dataclass
+class StageStats:
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    processed: int = 0
+    dropped: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+
+
+class Pipeline:
+    """Runs items through stages connected by bounded asyncio queues.
+
+    Every stage reads from its own queue of at most `queue_size` items, so a slow
+    stage makes its producers wait (backpressure) instead of buffering the whole
+    input in memory, while the faster stages keep its queue fed.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 8, stats_interval: float = 5.0,
+                 metrics: Optional[RunMetrics] = None):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats_interval = stats_interval
+        self.stats: Dict[str, StageStats] = {stage.name: StageStats() for stage in stages}
+        self.latencies: Dict[str, deque] = {stage.name: deque(maxlen=LATENCY_SAMPLES) for stage in stages}
+        # Every item a stage handles is also a pass through the span named after the stage.
+        self.metrics = metrics
+        self._queues: List[asyncio.Queue] = []
+        self._elapsed = 0.0
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return self._elapsed
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Return the number of items currently waiting in front of each stage."""
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages, self._queues)}
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Return per-stage counters, including how busy each stage's workers were."""
+        for name, depth in self.queue_depths().items():
+            self.stats[name].queue_depth = depth
+
+        snapshot = {}
+        for stage in self.stages:
+            stats = asdict(self.stats[stage.name])
+            capacity = self._elapsed * stage.concurrency
+            stats["busy_seconds"] = round(stats["busy_seconds"], 3)
+            stats["utilization"] = round(stats["busy_seconds"] / capacity, 3) if capacity else 0.0
+            latencies = sorted(self.latencies[stage.name])
+            stats["p50_seconds"] = round(_percentile(latencies, 0.50), 4)
+            stats["p95_seconds"] = round(_percentile(latencies, 0.95), 4)
+            snapshot[stage.name] = stats
+        return snapshot
+
+    def bottleneck(self) -> Optional[str]:
+        """Return the stage whose workers spent the largest share of the run busy."""
+        snapshot = self.snapshot()
+        if not snapshot:
+            return None
+        return max(snapshot, key=lambda name: snapshot[name]["utilization"])
+
+    async def run(self, source: Iterable[Any]):
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        default_workers = sum(stage.concurrency for stage in self.stages if stage.executor is None)
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max(default_workers, 1), thread_name_prefix="pipeline") as executor:
+            monitor = asyncio.create_task(self._monitor(started))
+            try:
+                await asyncio.gather(
+                    self._feed(source),
+                    *(self._run_stage(index, executor) for index in range(len(self.stages)))
+                )
+            finally:
+                monitor.cancel()
+                self._elapsed = time.perf_counter() - started
+
+        logger.info(f"Pipeline finished in {self._elapsed:.2f}s: {self.snapshot()}")
+        logger.info(f"Pipeline bottleneck: {self.bottleneck()}")
+
+    async def _feed(self, source: Iterable[Any]):
+        first_queue = self._queues[0]
+        for item in source:
+            await first_queue.put(item)
+        for _ in range(self.stages[0].concurrency):
+            await first_queue.put(_DONE)
+
+    async def _run_stage(self, index: int, default_executor: Executor):
+        stage = self.stages[index]
+        inbox = self._queues[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        executor = stage.executor or default_executor
+
+        await asyncio.gather(*(self._worker(stage, inbox, outbox, executor) for _ in range(stage.concurrency)))
+
+        if outbox is not None:
+            for _ in range(self.stages[index + 1].concurrency):
+                await outbox.put(_DONE)
+
+    async def _worker(self, stage: Stage, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], executor: Executor):
+        loop = asyncio.get_running_loop()
+        stats = self.stats[stage.name]
+
+        while True:
+            stats.max_queue_depth = max(stats.max_queue_depth, inbox.qsize())
+            item = await inbox.get()
+            if item is _DONE:
+                return
+
+            started = time.perf_counter()
+            result = None
+            try:
+                result = await loop.run_in_executor(executor, stage.handler, item)
+            except Exception as e:
+                stats.failed += 1
+                logger.error(f"Stage {stage.name} failed on {item!r}: {e}")
+                continue
+            finally:
+                duration = time.perf_counter() - started
+                stats.busy_seconds += duration
+                self.latencies[stage.name].append(duration)
+                if self.metrics is not None:
+                    self.metrics.record(stage.name, duration, rows=0 if result is None else 1)
+
+            if result is None:
+                stats.dropped += 1
+                continue
+
+            stats.processed += 1
+            if outbox is not None:
+                await outbox.put(result)
+
+    async def _monitor(self, started: float):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self._elapsed = time.perf_counter() - started
+            depths = ", ".join(f"{name}={depth}" for name, depth in self.queue_depths().items())
+            logger.info(f"Pipeline queue depths: {depths}")
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list; 0.0 when it is empty."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
@@ -1,19 +1,26 @@
-import os
+import hashlib
+import importlib
+import threading
 from dataclasses import dataclass, field
 from typing import Optional
 
-import cv2
 import logging
-from roboflow import Roboflow
-import supervision as sv
+import numpy as np
 
+from model_cache import ModelMetadataCache
+from model_client import ModelClientConfig, ResilientModelClient
 
-class ImageProcessingResult:
-    def __init__(self, result_json, annotated_image, project_name, filename):
-        self.result_json = result_json
-        self.annotated_image = annotated_image
-        self.project_name = project_name
-        self.filename = filename
+logger = logging.getLogger(__name__)
+
+# cv2, supervision and roboflow are slow to import, so they are imported on first use
+# rather than at startup; a run with no work never loads them.
+
+# Roboflow model classes that can be built straight from cached version metadata.
+MODEL_CLASSES = {
+    "classification": ("roboflow.models.classification", "ClassificationModel"),
+    "object-detection": ("roboflow.models.object_detection", "ObjectDetectionModel"),
+    "instance-segmentation": ("roboflow.models.instance_segmentation", "InstanceSegmentationModel"),
+}
 
 
 @dataclass
@@ -32,77 +39,98 @@ class RoboflowModelParams:
 
 
 class RoboflowModel:
-    def __init__(self, params: RoboflowModelParams):
+    """Handle to a remote Roboflow model that is resolved on first use, not on construction."""
+
+    def __init__(self, params: RoboflowModelParams, metadata_cache: Optional[ModelMetadataCache] = None):
         self.params = params
-        self.model = self.initialize_model()
+        self.metadata_cache = metadata_cache
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self.initialize_model()
+        return self._model
 
     def initialize_model(self):
         try:
-            rf = Roboflow(api_key=self.params.api_key)
-            project = rf.workspace().project(self.params.project_name)
-            return project.version(self.params.version_number).model
+            metadata = self._cached_metadata()
+            if metadata is not None and metadata.get("type") in MODEL_CLASSES:
+                logger.info(f"Building model {self.params.project_name} from cached metadata.")
+                return self._build_model(metadata)
+            return self._resolve_model()
         except Exception as e:
-            logging.error("Error initializing model: %s", e)
-            return None
-
-    def predict_and_annotate(self, image_path):
-        try:
-            result_json = self.model.predict(image_path).json()
-
-            # not a nice pattern but it is okay now to keep it simple
-            try:
-                labels = [item["class"] for item in result_json["predictions"]]
-
-                detections = sv.Detections.from_inference(result_json)
-
-                logging.info(f"Total detections: {len(detections)}")
+            logger.error("Error initializing model: %s", e)
+            raise
 
-                # annotate image
-                label_annotator = sv.LabelAnnotator()
-                mask_annotator = sv.MaskAnnotator()
+    def _cache_key(self) -> str:
+        # Include a digest of the API key so projects with the same name in different workspaces never collide.
+        key_digest = hashlib.sha256(self.params.api_key.encode()).hexdigest()[:12]
+        return f"{key_digest}/{self.params.project_name}/{self.params.version_number}"
 
-                image = cv2.imread(image_path)
+    def _cached_metadata(self) -> Optional[dict]:
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.get(self._cache_key())
+
+    def _resolve_model(self):
+        from roboflow import Roboflow
+
+        rf = Roboflow(api_key=self.params.api_key)
+        project = rf.workspace().project(self.params.project_name)
+        version = project.version(self.params.version_number)
+
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(self._cache_key(), {
+                "id": version.id,
+                "type": version.type,
+                "colors": getattr(version, "colors", None),
+                "preprocessing": getattr(version, "preprocessing", None),
+            })
+        return version.model
+
+    def _build_model(self, metadata: dict):
+        module_name, class_name = MODEL_CLASSES[metadata["type"]]
+        model_class = getattr(importlib.import_module(module_name), class_name)
+        return model_class(
+            self.params.api_key,
+            metadata["id"],
+            colors=metadata.get("colors"),
+            preprocessing=metadata.get("preprocessing")
+        )
+
+    def predict(self, image_path: str) -> dict:
+        """Run the remote model on an image and return the raw inference JSON."""
+        return self.model.predict(image_path).json()
 
-                annotated_image = mask_annotator.annotate(scene=image, detections=detections)
-                annotated_image = label_annotator.annotate(scene=annotated_image, detections=detections, labels=labels)
+    @staticmethod
+    def annotate(image: np.ndarray, result_json: dict) -> np.ndarray:
+        """Draw the detections of an inference result onto a BGR image."""
+        import supervision as sv
 
-                return result_json, annotated_image
+        labels = [item["class"] for item in result_json["predictions"]]
 
-            except Exception as e:
-                logging.info("Error predicting and annotating image %s: %s", image_path, e)
+        detections = sv.Detections.from_inference(result_json)
 
-            return result_json, None
+        logger.info(f"Total detections: {len(detections)}")
 
-        except Exception as e:
-            logging.error("Error predicting and annotating image %s: %s", image_path, e)
-            return None
+        label_annotator = sv.LabelAnnotator()
+        mask_annotator = sv.MaskAnnotator()
 
-    def process_single_image(self, image_path: str) -> Optional[ImageProcessingResult]:
-        """Process a single image."""
-        logging.info(f"Processing {image_path}")
-
-        if not os.path.isfile(image_path):
-            logging.warning(f"File does not exist: {image_path}")
-            return None
-        
-        result_json, annotated_image = self.predict_and_annotate(image_path)
-
-        if result_json is not None:
-            filename = os.path.basename(image_path)
-            return ImageProcessingResult(
-                result_json=result_json,
-                annotated_image=annotated_image,
-                project_name=self.params.project_name,
-                filename=filename
-            )
-        else:
-            logging.warning(f"Failed to annotate image: {image_path}")
-            return None
+        annotated_image = mask_annotator.annotate(scene=image, detections=detections)
+        return label_annotator.annotate(scene=annotated_image, detections=detections, labels=labels)
 
 
 class RoboflowModelFactory:
-    @staticmethod
-    def create_model(api_key: str, project_name: str, version_number: int) -> RoboflowModel:
-        """Creates and returns an instance of RoboflowModel with the provided parameters."""
+    def __init__(self, client_config: Optional[ModelClientConfig] = None,
+                 metadata_cache: Optional[ModelMetadataCache] = None):
+        self.client_config = client_config or ModelClientConfig()
+        self.metadata_cache = metadata_cache
+
+    def create_model(self, api_key: str, project_name: str, version_number: int) -> ResilientModelClient:
+        """Creates a lazy RoboflowModel with the provided parameters, wrapped in a rate limiting, retrying client."""
         params = RoboflowModelParams(api_key, project_name, version_number)
-        return RoboflowModel(params)
\ No newline at end of file
+        return ResilientModelClient(RoboflowModel(params, self.metadata_cache), self.client_config)
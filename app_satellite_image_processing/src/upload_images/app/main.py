@@ -1,9 +1,14 @@
 import os
 from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
+
+from common.metrics import RunMetrics, render_prometheus
 
 app = FastAPI()
 
+# Totals since the service started, exposed on /metrics.
+METRICS = RunMetrics("upload_images")
+
 UPLOAD_DIRECTORY = "uploads"
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True) 
 
@@ -81,8 +86,14 @@ async def upload_form():
 async def upload_file(file: UploadFile = File(...)):
     file_location = os.path.join(UPLOAD_DIRECTORY, file.filename)
     
-    with open(file_location, "wb") as file_object:
+    with METRICS.span("upload") as span, open(file_location, "wb") as file_object:
         file_content = await file.read()
         file_object.write(file_content)
+        span.add(1, len(file_content))
     
     return RedirectResponse(url='/', status_code=303)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus([METRICS]), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,78 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Filled by the triggers of the source migration V002__change_queue.sql.
+CHANGES_TABLE = "satellite_image_processing.etl_changes"
+
+
+def has_change_queue(source_conn) -> bool:
+    with source_conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (CHANGES_TABLE,))
+        return cursor.fetchone()[0]
+
+
+def change_horizon(source_conn) -> int:
+    """Transaction id below which every source transaction has ended; a full load started now reads all of them."""
+    with source_conn.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::TEXT::BIGINT;")
+        return cursor.fetchone()[0]
+
+
+def prune_changes(source_conn, horizon: int) -> int:
+    """Delete the queued changes of the transactions a full load started at `horizon` has covered."""
+    with source_conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {CHANGES_TABLE} WHERE xact_id < %s::TEXT::XID8;", (horizon,))
+        pruned = cursor.rowcount
+    source_conn.commit()
+    logger.info(f"Removed {pruned} queued source changes covered by the full load.")
+    return pruned
+
+
+def read_changes(source_conn, after: int, limit: int) -> Tuple[List[int], Dict[str, List[int]]]:
+    """The next queued changes after change_id `after`: their ids and the distinct changed keys per table."""
+    with source_conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT change_id, table_name, row_key FROM {CHANGES_TABLE}
+            WHERE change_id > %s ORDER BY change_id LIMIT %s;
+        """, (after, limit))
+        rows = cursor.fetchall()
+    source_conn.rollback()
+    keys: Dict[str, List[int]] = {}
+    for _, table, row_key in rows:
+        keys.setdefault(table, []).append(row_key)
+    return [row[0] for row in rows], {table: sorted(set(values)) for table, values in keys.items()}
+
+
+def delete_changes(source_conn, change_ids: List[int]):
+    """Remove merged changes from the queue, once the history transaction that merged them is committed."""
+    with source_conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {CHANGES_TABLE} WHERE change_id = ANY(%s);", (change_ids,))
+    source_conn.commit()
+
+
+def start_full_load(checkpoints, source_conn) -> Optional[int]:
+    """The change horizon of a full load's run, recorded when the run starts so a resumed run keeps its own.
+
+    None when the source has no change queue.
+    """
+    if not has_change_queue(source_conn):
+        source_conn.rollback()
+        return None
+    horizon, _, _ = checkpoints.table_state("source_changes")
+    if not horizon:
+        horizon = change_horizon(source_conn)
+        source_conn.rollback()
+        checkpoints.save("source_changes", horizon, 0)
+        checkpoints.connection.commit()
+    return horizon
+
+
+def finish_full_load(checkpoints, source_conn, horizon: Optional[int]):
+    """Drop the queued changes the finished full load covered, so the daemon does not merge them again."""
+    if horizon is None or checkpoints.table_state("source_changes")[2]:
+        return
+    pruned = prune_changes(source_conn, horizon)
+    checkpoints.save("source_changes", horizon, pruned, completed=True)
+    checkpoints.connection.commit()
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+from psycopg2 import sql
+
+from common.metrics import RunMetrics, write_textfile
+
+logger = logging.getLogger(__name__)
+
+
+class RunCheckpoints:
+    """Progress of one ETL stage, kept in control tables of the stage's destination database.
+
+    A checkpoint is written in the same transaction as the chunk it describes, so
+    after a crash the stored last key is exactly what has been committed. A run
+    left 'running' is resumed by the next start; a completed run is not repeated.
+    The spans timed on `metrics` are stored in <schema>.etl_run_log when the run finishes.
+    The control tables are created by the migrations of each destination database.
+    """
+
+    def __init__(self, connection, schema: str, stage: str, run_id: Optional[str] = None):
+        """Pass `run_id` to keep reading and writing the checkpoints of a known run without starting it."""
+        self.connection = connection
+        self.schema = schema
+        self.stage = stage
+        self.run_id = run_id
+        self.started_at = None
+        self.resumed = False
+        self.completed = False
+        self.metrics = RunMetrics(stage)
+        self._runs = sql.Identifier(schema, "etl_runs")
+        self._checkpoints = sql.Identifier(schema, "etl_checkpoints")
+        self._run_log = sql.Identifier(schema, "etl_run_log")
+
+    def start_run(self, run_id: Optional[str] = None) -> str:
+        """Resume the given run (default: ETL_RUN_ID, else this stage's last unfinished run) or start a new one."""
+        run_id = run_id or os.getenv("ETL_RUN_ID")
+        with self.connection.cursor() as cursor:
+            if run_id:
+                cursor.execute(sql.SQL("SELECT status, started_at FROM {} WHERE run_id = %s AND stage = %s;")
+                               .format(self._runs), (run_id, self.stage))
+                existing = cursor.fetchone()
+            else:
+                cursor.execute(sql.SQL("""
+                    SELECT run_id, status, started_at FROM {}
+                    WHERE stage = %s AND status = 'running'
+                    ORDER BY started_at DESC LIMIT 1;
+                """).format(self._runs), (self.stage,))
+                found = cursor.fetchone()
+                run_id, existing = (found[0], found[1:]) if found else (None, None)
+
+            if existing:
+                status, self.started_at = existing
+                self.resumed = True
+                self.completed = status == "completed"
+            else:
+                run_id = run_id or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+                cursor.execute(sql.SQL("INSERT INTO {} (run_id, stage, status) VALUES (%s, %s, 'running') "
+                                       "RETURNING started_at;").format(self._runs), (run_id, self.stage))
+                self.started_at = cursor.fetchone()[0]
+        self.connection.commit()
+        self.run_id = run_id
+
+        if self.completed:
+            logger.info(f"Run {run_id} of {self.stage} already completed, nothing to do.")
+        elif self.resumed:
+            logger.info(f"Resuming run {run_id} of {self.stage} from its checkpoints.")
+        else:
+            logger.info(f"Started run {run_id} of {self.stage}.")
+        return run_id
+
+    def table_state(self, table: str):
+        """Return (last_key, rows_done, completed) of a table in the current run."""
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                SELECT last_key, rows_done, completed FROM {}
+                WHERE run_id = %s AND stage = %s AND table_name = %s;
+            """).format(self._checkpoints), (self.run_id, self.stage, table))
+            row = cursor.fetchone()
+        return row if row else (0, 0, False)
+
+    def save(self, table: str, last_key: int, rows_done: int, completed: bool = False):
+        """Record progress of a table; committed by the caller together with the chunk it covers."""
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                INSERT INTO {} (run_id, stage, table_name, last_key, rows_done, completed, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                ON CONFLICT (run_id, stage, table_name) DO UPDATE
+                SET last_key = EXCLUDED.last_key,
+                    rows_done = EXCLUDED.rows_done,
+                    completed = EXCLUDED.completed,
+                    updated_at = NOW();
+            """).format(self._checkpoints), (self.run_id, self.stage, table, last_key, rows_done, completed))
+
+    def finish_run(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                UPDATE {} SET status = 'completed', finished_at = NOW()
+                WHERE run_id = %s AND stage = %s;
+            """).format(self._runs), (self.run_id, self.stage))
+            # A resumed run replaces the record, which then covers what the resumed attempt did.
+            cursor.execute(sql.SQL("""
+                INSERT INTO {} (run_id, stage, started_at, elapsed_seconds, rows, bytes, spans)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (run_id, stage) DO UPDATE
+                SET started_at = EXCLUDED.started_at,
+                    finished_at = NOW(),
+                    elapsed_seconds = EXCLUDED.elapsed_seconds,
+                    rows = EXCLUDED.rows,
+                    bytes = EXCLUDED.bytes,
+                    spans = EXCLUDED.spans;
+            """).format(self._run_log), (self.run_id, self.stage, self.metrics.started_at,
+                                         self.metrics.elapsed_seconds, self.metrics.rows, self.metrics.bytes,
+                                         json.dumps(self.metrics.spans())))
+        self.connection.commit()
+        self.completed = True
+        logger.info(f"Run {self.run_id} of {self.stage} completed.")
+        self.metrics.log_summary()
+        write_textfile(self.metrics)
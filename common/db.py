@@ -0,0 +1,315 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a connection can no longer be trusted and the work is worth retrying.
+DISCONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+@dataclass
+class PostgresConfig:
+    dbname: str
+    user: str
+    password: str
+    host: str
+    port: int
+
+    def __post_init__(self):
+        # Check if any of the required fields are missing
+        missing_fields = [
+            field for field in ["dbname", "user", "password", "host", "port"]
+            if getattr(self, field) is None
+        ]
+        if missing_fields:
+            raise ValueError(f"Missing required database configuration fields: {', '.join(missing_fields)}")
+
+    @classmethod
+    def from_env(cls, env_prefix: str) -> "PostgresConfig":
+        return cls(
+            dbname=os.getenv(f"{env_prefix}_DBNAME"),
+            user=os.getenv(f"{env_prefix}_USER"),
+            password=os.getenv(f"{env_prefix}_PASSWORD"),
+            host=os.getenv(f"{env_prefix}_HOST"),
+            port=int(os.getenv(f"{env_prefix}_PORT", 5432))
+        )
+
+
+@dataclass
+class PoolConfig:
+    min_size: int = 1
+    max_size: int = 4
+    checkout_timeout_seconds: float = 30.0
+    # Connections idle for longer than this are probed with SELECT 1 before being handed out.
+    validate_after_idle_seconds: float = 5.0
+    connect_retries: int = 5
+    backoff_base_seconds: float = 0.5
+    backoff_max_seconds: float = 30.0
+    statement_timeout_ms: Optional[int] = None
+    application_name: str = "etl_sonar_panel"
+    # psycopg2 connection class to open, e.g. one that counts statements for a benchmark.
+    connection_factory: Optional[Callable] = None
+
+    def __post_init__(self):
+        if not 0 <= self.min_size <= self.max_size or self.max_size < 1:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
+
+    @classmethod
+    def from_env(cls, application_name: str, env_prefix: str = "DB_POOL") -> "PoolConfig":
+        timeout = os.getenv(f"{env_prefix}_STATEMENT_TIMEOUT_MS")
+        return cls(
+            min_size=int(os.getenv(f"{env_prefix}_MIN_SIZE", 1)),
+            max_size=int(os.getenv(f"{env_prefix}_MAX_SIZE", 4)),
+            checkout_timeout_seconds=float(os.getenv(f"{env_prefix}_CHECKOUT_TIMEOUT", 30)),
+            connect_retries=int(os.getenv(f"{env_prefix}_CONNECT_RETRIES", 5)),
+            statement_timeout_ms=int(timeout) if timeout else None,
+            application_name=application_name
+        )
+
+
+def backoff_delay(attempt: int, base: float, ceiling: float) -> float:
+    """Exponential backoff with full jitter for the given 1-based attempt."""
+    return random.uniform(0, min(ceiling, base * 2 ** (attempt - 1)))
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections to one database.
+
+    Connections are validated on checkout, replaced when broken and (re)opened
+    with exponential backoff, so a database restart costs a few retries instead
+    of the whole run.
+    """
+
+    def __init__(self, config: PostgresConfig, pool_config: Optional[PoolConfig] = None):
+        self.config = config
+        self.pool_config = pool_config or PoolConfig()
+        self._idle = deque()
+        self._in_use = set()
+        self._opening = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "validation_failures": 0,
+            "connect_failures": 0,
+        }
+
+        for _ in range(self.pool_config.min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+        logger.info(f"Connection pool ready for {config.dbname} at {config.host} "
+                    f"(min {self.pool_config.min_size}, max {self.pool_config.max_size}).")
+
+    def _connect(self):
+        options = []
+        if self.pool_config.statement_timeout_ms:
+            options.append(f"-c statement_timeout={self.pool_config.statement_timeout_ms}")
+
+        attempt = 0
+        while True:
+            try:
+                connection = psycopg2.connect(
+                    dbname=self.config.dbname,
+                    user=self.config.user,
+                    password=self.config.password,
+                    host=self.config.host,
+                    port=self.config.port,
+                    application_name=self.pool_config.application_name,
+                    options=" ".join(options) or None,
+                    connection_factory=self.pool_config.connection_factory
+                )
+                with self._condition:
+                    self._metrics["connections_created"] += 1
+                return connection
+            except psycopg2.OperationalError as e:
+                attempt += 1
+                with self._condition:
+                    self._metrics["connect_failures"] += 1
+                if attempt > self.pool_config.connect_retries:
+                    logger.error(f"Giving up connecting to {self.config.dbname} at {self.config.host}: {e}")
+                    raise
+                delay = backoff_delay(attempt, self.pool_config.backoff_base_seconds,
+                                      self.pool_config.backoff_max_seconds)
+                logger.warning(f"Connecting to {self.config.dbname} failed (attempt {attempt}), "
+                               f"retrying in {delay:.2f}s: {e}")
+                time.sleep(delay)
+
+    def _is_usable(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.pool_config.validate_after_idle_seconds:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except DISCONNECT_ERRORS:
+            with self._condition:
+                self._metrics["validation_failures"] += 1
+            return False
+
+    def getconn(self):
+        """Check out a validated connection, opening a new one while below max_size."""
+        deadline = time.monotonic() + self.pool_config.checkout_timeout_seconds
+        waited = False
+        started = time.monotonic()
+
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise PoolTimeoutError(f"Connection pool for {self.config.dbname} is closed.")
+                candidate = None
+                if self._idle:
+                    candidate = self._idle.pop()
+                elif len(self._in_use) + self._opening < self.pool_config.max_size:
+                    # Reserve the slot before connecting outside the lock.
+                    self._opening += 1
+                    candidate = (None, 0.0)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            f"No connection to {self.config.dbname} available within "
+                            f"{self.pool_config.checkout_timeout_seconds}s.")
+                    waited = True
+                    self._condition.wait(remaining)
+                    continue
+
+            connection, idle_since = candidate
+            opened = connection is None
+            if opened:
+                try:
+                    connection = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._opening -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._is_usable(connection, idle_since):
+                self._discard(connection)
+                continue
+
+            with self._condition:
+                if opened:
+                    self._opening -= 1
+                self._in_use.add(connection)
+                self._metrics["checkouts"] += 1
+                if waited:
+                    self._metrics["waits"] += 1
+                    self._metrics["wait_seconds"] += time.monotonic() - started
+            return connection
+
+    def putconn(self, connection, discard: bool = False):
+        """Return a connection to the pool; broken or discarded ones are closed and forgotten."""
+        with self._condition:
+            self._in_use.discard(connection)
+
+        if discard or connection.closed or self._closed:
+            self._discard(connection)
+            return
+
+        try:
+            connection.rollback()
+        except DISCONNECT_ERRORS:
+            self._discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._metrics["connections_discarded"] += 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a block; it is rolled back if the block fails."""
+        connection = self.getconn()
+        broken = False
+        try:
+            yield connection
+        except DISCONNECT_ERRORS:
+            broken = True
+            raise
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            self.putconn(connection, discard=broken)
+
+    def stats(self) -> dict:
+        """Return pool size, utilization and checkout counters."""
+        with self._condition:
+            in_use = len(self._in_use)
+            stats = dict(self._metrics)
+            stats.update({
+                "database": self.config.dbname,
+                "idle": len(self._idle),
+                "in_use": in_use,
+                "max_size": self.pool_config.max_size,
+                "utilization": round(in_use / self.pool_config.max_size, 3),
+                "wait_seconds": round(self._metrics["wait_seconds"], 3),
+            })
+        return stats
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+        logger.info(f"Connection pool for {self.config.dbname} closed: {self.stats()}")
+
+
+def run_with_reconnect(work: Callable, pools: Sequence[ConnectionPool], retries: int = 3,
+                       backoff_base_seconds: float = 1.0, backoff_max_seconds: float = 30.0):
+    """Call `work` with one connection from each pool, retrying on fresh connections after a disconnect.
+
+    `work` must be safe to repeat: everything it did before the failure is rolled
+    back, so it should only commit once its unit of work is complete.
+    """
+    attempt = 0
+    while True:
+        connections = []
+        try:
+            for pool in pools:
+                connections.append(pool.getconn())
+            return work(*connections)
+        except DISCONNECT_ERRORS as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff_delay(attempt, backoff_base_seconds, backoff_max_seconds)
+            logger.warning(f"Lost a database connection (attempt {attempt}/{retries}), "
+                           f"retrying in {delay:.2f}s: {e}")
+        finally:
+            # Healthy connections are rolled back and reused; broken ones fail the rollback and are discarded.
+            for pool, connection in zip(pools, connections):
+                pool.putconn(connection)
+        time.sleep(delay)
@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+SUMMARY_LOGGER = "log_sampling"
+
+
+@dataclass
+class LoggingConfig:
+    level: str = "INFO"
+    json: bool = False
+    # Share of the records below WARNING kept per logger name, e.g. {"image_repository": 0.01}.
+    sample_rates: Dict[str, float] = field(default_factory=dict)
+    summary_interval_seconds: float = 60.0
+
+    @classmethod
+    def from_env(cls, sample_rates: Optional[Dict[str, float]] = None) -> "LoggingConfig":
+        """Read LOG_LEVEL, LOG_FORMAT (text or json), LOG_SUMMARY_SECONDS and LOG_SAMPLE.
+
+        LOG_SAMPLE is a list like `image_repository=0.01,etl_1_stage=0.1`; its rates
+        override the service defaults passed as `sample_rates`.
+        """
+        rates = dict(sample_rates or {})
+        for entry in filter(None, os.getenv("LOG_SAMPLE", "").split(",")):
+            name, rate = entry.split("=")
+            rates[name.strip()] = float(rate)
+        return cls(
+            level=os.getenv("LOG_LEVEL", "INFO").upper(),
+            json=os.getenv("LOG_FORMAT", "text").lower() == "json",
+            sample_rates=rates,
+            summary_interval_seconds=float(os.getenv("LOG_SUMMARY_SECONDS", 60))
+        )
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every 1/rate records below WARNING of each sampled logger and counts the others.
+
+    Sampling is by count rather than at random, so a loop logging once per row
+    still shows up at a steady pace. Warnings and errors always pass.
+    """
+
+    def __init__(self, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) if rate > 0 else None for name, rate in sample_rates.items()}
+        self._seen = defaultdict(int)
+        self._dropped = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or record.name not in self.every:
+            return True
+        every = self.every[record.name]
+        with self._lock:
+            seen = self._seen[record.name]
+            self._seen[record.name] += 1
+            if every is not None and seen % every == 0:
+                return True
+            self._dropped[(record.name, record.levelname)] += 1
+        return False
+
+    def take_dropped(self) -> Dict[tuple, int]:
+        """Return the records dropped per (logger, level) since the last call."""
+        with self._lock:
+            dropped, self._dropped = self._dropped, defaultdict(int)
+        return dict(dropped)
+
+
+class LoggingRuntime:
+    """The listener thread writing the queued records and the thread summarizing what sampling dropped."""
+
+    def __init__(self, listener: QueueListener, sampling: SamplingFilter, summary_interval_seconds: float):
+        self.listener = listener
+        self.sampling = sampling
+        self.summary_interval_seconds = summary_interval_seconds
+        self._stop = threading.Event()
+        self._summary = threading.Thread(target=self._run_summaries, name="log-summary", daemon=True)
+
+    def start(self):
+        self.listener.start()
+        if self.sampling.every:
+            self._summary.start()
+        atexit.register(self.stop)
+
+    def log_summary(self):
+        for (name, level), count in sorted(self.sampling.take_dropped().items()):
+            every = self.sampling.every[name]
+            kept = f"kept 1 in {every}" if every else "all dropped"
+            logging.getLogger(SUMMARY_LOGGER).info(f"Sampled out {count} {level} records of {name} ({kept}).")
+
+    def _run_summaries(self):
+        while not self._stop.wait(self.summary_interval_seconds):
+            self.log_summary()
+
+    def stop(self):
+        """Flush the last summary and every queued record; safe to call twice."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.log_summary()
+        self.listener.stop()
+
+
+def configure_logging(service: str, log_folder: str, config: Optional[LoggingConfig] = None,
+                      text_format: str = TEXT_FORMAT) -> LoggingRuntime:
+    """Log to the console and <log_folder>/app.log without blocking the caller on I/O.
+
+    Loggers only put records on a queue; a listener thread formats and writes
+    them. Records of the loggers in `config.sample_rates` are sampled before
+    they are queued, and what was dropped is summarized every
+    `config.summary_interval_seconds`.
+    """
+    config = config or LoggingConfig.from_env()
+    os.makedirs(log_folder, exist_ok=True)
+    formatter = JsonFormatter(service) if config.json else logging.Formatter(text_format)
+    handlers = [logging.StreamHandler(), logging.FileHandler(os.path.join(log_folder, 'app.log'))]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue()
+    queue_handler = QueueHandler(records)
+    sampling = SamplingFilter(config.sample_rates)
+    queue_handler.addFilter(sampling)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.level)
+
+    runtime = LoggingRuntime(QueueListener(records, *handlers, respect_handler_level=True), sampling,
+                             config.summary_interval_seconds)
+    runtime.start()
+    return runtime
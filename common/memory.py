@@ -0,0 +1,66 @@
+import logging
+import os
+import resource
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process right now (Linux), or the lifetime peak elsewhere."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Highest resident set size this process has reached so far."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Samples the process RSS in a background thread to find the peak within one block of work.
+
+    The kernel only tracks a lifetime peak, which says nothing about a stage that
+    runs after a more memory hungry one, hence the sampling.
+    """
+
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.start_bytes = self.peak_bytes = current_rss_bytes()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+
+@contextmanager
+def track_peak_rss(label: str):
+    """Log the peak RSS reached while the block runs."""
+    sampler = RssSampler()
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        logger.info(f"Peak RSS during {label}: {sampler.peak_bytes / 2 ** 20:.1f} MiB "
+                    f"(started at {sampler.start_bytes / 2 ** 20:.1f} MiB)")
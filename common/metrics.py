@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "satellite"
+
+
+@dataclass
+class SpanStats:
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+
+
+class Span:
+    """Handle of an open span; rows and bytes added to it are recorded when the span closes."""
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows: int = 0, bytes: int = 0):
+        self.rows += rows
+        self.bytes += bytes
+
+    def add_rows(self, rows: list):
+        """Count fetched or written rows together with their estimated size."""
+        self.add(len(rows), rows_size(rows))
+
+
+def value_size(value) -> int:
+    """Rough wire size of a value: the payload of text and binary values, 8 bytes for anything else."""
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(value_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(item) for item in value)
+    return 8
+
+
+def rows_size(rows: Iterable) -> int:
+    return sum(value_size(row) for row in rows)
+
+
+class RunMetrics:
+    """Time, rows and bytes of the named spans of one run of a service, e.g. `extract.images` or `fact_build`.
+
+    A span can be entered many times, once per chunk or item; its calls, total and
+    longest time, rows and bytes add up. The rows and bytes of the run are what
+    its `timed_chunks` read.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.started_at = datetime.now(timezone.utc)
+        self.rows = 0
+        self.bytes = 0
+        self._started = time.perf_counter()
+        self._spans: Dict[str, SpanStats] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return time.perf_counter() - self._started
+
+    def record(self, name: str, seconds: float, rows: int = 0, bytes: int = 0, calls: int = 1):
+        with self._lock:
+            stats = self._spans.setdefault(name, SpanStats())
+            stats.calls += calls
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.rows += rows
+            stats.bytes += bytes
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        span = Span()
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.record(name, time.perf_counter() - started, span.rows, span.bytes)
+
+    def timed_chunks(self, name: str, chunks: Iterable[list]) -> Iterator[list]:
+        """Yield from `chunks`, charging the wait for each chunk, its rows and their size to span `name`."""
+        iterator = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            try:
+                rows = next(iterator)
+            except StopIteration:
+                self.record(name, time.perf_counter() - started, calls=0)
+                return
+            size = rows_size(rows)
+            self.record(name, time.perf_counter() - started, len(rows), size)
+            with self._lock:
+                self.rows += len(rows)
+                self.bytes += size
+            yield rows
+
+    def spans(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: asdict(stats) for name, stats in sorted(self._spans.items())}
+
+    def log_summary(self):
+        spans = ", ".join(f"{name} {stats['seconds']:.2f}s/{stats['rows']} rows"
+                          for name, stats in self.spans().items())
+        logger.info(f"{self.service} took {self.elapsed_seconds:.2f}s for {self.rows} rows: {spans or 'no spans'}")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def render_prometheus(metrics_list: List[RunMetrics], completed: bool = False) -> str:
+    """The metrics in the Prometheus text exposition format.
+
+    Span totals are counters: a batch job starts them over with every run, a
+    service keeps adding to them for as long as it lives.
+    """
+    lines = []
+
+    def family(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+        lines.extend(f"{METRIC_PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+    spans = [(metrics.service, name, stats) for metrics in metrics_list for name, stats in metrics.spans().items()]
+    for field, kind, suffix, help_text in (
+            ("calls", "counter", "calls_total", "Times a span was entered."),
+            ("seconds", "counter", "seconds_total", "Time spent in a span."),
+            ("max_seconds", "gauge", "max_seconds", "Longest single pass through a span."),
+            ("rows", "counter", "rows_total", "Rows a span read or wrote."),
+            ("bytes", "counter", "bytes_total", "Estimated bytes a span read or wrote.")):
+        family(f"span_{suffix}", kind, help_text,
+               [(_labels(service=service, span=name), stats[field]) for service, name, stats in spans])
+
+    family("run_rows", "gauge", "Rows read by the current or last run.",
+           [(_labels(service=metrics.service), metrics.rows) for metrics in metrics_list])
+    family("run_bytes", "gauge", "Estimated bytes read by the current or last run.",
+           [(_labels(service=metrics.service), metrics.bytes) for metrics in metrics_list])
+    family("run_duration_seconds", "gauge", "Duration of the current or last run.",
+           [(_labels(service=metrics.service), round(metrics.elapsed_seconds, 3)) for metrics in metrics_list])
+    family("run_started_timestamp_seconds", "gauge", "Start of the current or last run.",
+           [(_labels(service=metrics.service), metrics.started_at.timestamp()) for metrics in metrics_list])
+    if completed:
+        family("run_last_success_timestamp_seconds", "gauge", "End of the last successful run.",
+               [(_labels(service=metrics.service), time.time()) for metrics in metrics_list])
+    return "\n".join(lines) + "\n"
+
+
+def textfile_folder() -> Optional[str]:
+    """Folder a node_exporter textfile collector reads, from METRICS_TEXTFILE_DIR; None when unset."""
+    return os.getenv("METRICS_TEXTFILE_DIR") or None
+
+
+def write_textfile(metrics: RunMetrics, folder: Optional[str] = None):
+    """Write the metrics of a finished batch run to <folder>/<service>.prom; a no-op without a folder."""
+    folder = folder or textfile_folder()
+    if not folder:
+        return
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{metrics.service}.prom")
+    # The collector must never read a half-written file.
+    with open(f"{path}.tmp", "w") as file:
+        file.write(render_prometheus([metrics], completed=True))
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+import re
+from typing import List, Tuple
+
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+# Migration files are named V<version>__<description>.sql; version 1 is the init.sql baseline.
+MIGRATION_FILE_PATTERN = re.compile(r"^V(\d+)__(\w+)\.sql$")
+
+
+def resolve_migrations_dir(app_folder: str) -> str:
+    """Migrations of a service: copied next to the app in its image, under ../../postgres/sql/migrations in the repo."""
+    bundled = os.path.join(app_folder, "migrations")
+    if os.path.isdir(bundled):
+        return bundled
+    return os.path.join(app_folder, "..", "..", "postgres", "sql", "migrations")
+
+
+def discover_migrations(directory: str) -> List[Tuple[int, str, str]]:
+    """Return (version, name, path) for every migration file in the directory, in version order."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}.")
+    return sorted(migrations)
+
+
+def apply_migrations(connection, directory: str, schema: str) -> List[int]:
+    """Apply the migrations not yet recorded in <schema>.schema_migrations, all in one transaction.
+
+    An advisory lock keeps two services starting at the same time from applying
+    the same migration twice.
+    """
+    migrations_table = sql.Identifier(schema, "schema_migrations")
+    applied_now = []
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"{schema}.schema_migrations",))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+        """).format(migrations_table))
+        cursor.execute(sql.SQL("SELECT version FROM {};").format(migrations_table))
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for version, name, path in discover_migrations(directory):
+            if version in applied:
+                continue
+            logger.info(f"Applying migration V{version}__{name} to schema {schema}.")
+            with open(path, "r") as file:
+                cursor.execute(file.read())
+            cursor.execute(
+                sql.SQL("INSERT INTO {} (version, name) VALUES (%s, %s);").format(migrations_table),
+                (version, name)
+            )
+            applied_now.append(version)
+
+    connection.commit()
+    if applied_now:
+        logger.info(f"Schema {schema} migrated to version {applied_now[-1]}.")
+    return applied_now
+
+
+def main():
+    from dotenv import load_dotenv
+    from common.db import ConnectionPool, PostgresConfig
+
+    parser = argparse.ArgumentParser(description="Apply pending SQL migrations to a database.")
+    parser.add_argument("directory", help="folder holding the V<version>__<name>.sql files")
+    parser.add_argument("schema", help="schema that owns the schema_migrations table")
+    parser.add_argument("--env-prefix", default="DEST", help="prefix of the *_DBNAME, *_HOST, ... variables")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env(args.env_prefix))
+    try:
+        with pool.connection() as connection:
+            apply_migrations(connection, args.directory, args.schema)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import logging
+import select
+import time
+from typing import List
+
+import psycopg2
+import psycopg2.extensions
+
+from common.db import PostgresConfig
+
+logger = logging.getLogger(__name__)
+
+# Sent by the image processor with the image_id as payload once an image and its model results are stored.
+IMAGE_PROCESSED_CHANNEL = "image_processed"
+
+
+def notify(cursor, channel: str, payload: str):
+    """Queue a notification; PostgreSQL delivers it when the cursor's transaction commits."""
+    cursor.execute("SELECT pg_notify(%s, %s);", (channel, payload))
+
+
+class Listener:
+    """Dedicated autocommit connection LISTENing on one channel.
+
+    A LISTEN only lives as long as its session, so the listener keeps its own
+    connection outside any pool and reopens it after a disconnect.
+    """
+
+    def __init__(self, config: PostgresConfig, channel: str):
+        self.config = config
+        self.channel = channel
+        self.connection = None
+
+    def _connect(self):
+        self.connection = psycopg2.connect(
+            dbname=self.config.dbname,
+            user=self.config.user,
+            password=self.config.password,
+            host=self.config.host,
+            port=self.config.port,
+            application_name=f"listen_{self.channel}"
+        )
+        self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel};")
+        logger.info(f"Listening for {self.channel} notifications on {self.config.dbname}.")
+
+    def wait(self, timeout: float) -> List[str]:
+        """Block for up to `timeout` seconds and return the payloads received; empty on timeout."""
+        try:
+            if self.connection is None or self.connection.closed:
+                self._connect()
+            if select.select([self.connection], [], [], timeout) == ([], [], []):
+                return []
+            self.connection.poll()
+            payloads = [notification.payload for notification in self.connection.notifies]
+            self.connection.notifies.clear()
+            return payloads
+        except psycopg2.Error as e:
+            logger.warning(f"Listening on {self.channel} failed, falling back to polling: {e}")
+            self.close()
+            time.sleep(timeout)
+            return []
+
+    def close(self):
+        if self.connection is not None and not self.connection.closed:
+            self.connection.close()
+        self.connection = None
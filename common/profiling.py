@@ -0,0 +1,255 @@
+import cProfile
+import functools
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sampling")
+
+
+@dataclass
+class ProfilingConfig:
+    # "cprofile" (deterministic, the calling thread only) or "sampling" (every thread); None: no CPU profile.
+    mode: Optional[str] = None
+    # Trace allocations with tracemalloc and report the top sites.
+    memory: bool = False
+    # Names given to `profiled`; empty means all of them.
+    targets: Sequence[str] = field(default_factory=tuple)
+    interval_seconds: float = 0.005
+    top: int = 30
+    # Stack depth tracemalloc records per allocation.
+    frames: int = 10
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None or self.memory
+
+    @classmethod
+    def from_env(cls) -> "ProfilingConfig":
+        """Read PROFILE (cprofile, sampling or off), PROFILE_MEMORY, PROFILE_TARGETS, PROFILE_INTERVAL_MS,
+        PROFILE_TOP and PROFILE_FRAMES."""
+        mode = os.getenv("PROFILE", "").lower() or None
+        if mode not in MODES + (None,) and mode != "off":
+            raise ValueError(f"PROFILE must be one of {', '.join(MODES)} or off, not {mode}.")
+        return cls(
+            mode=None if mode == "off" else mode,
+            memory=os.getenv("PROFILE_MEMORY", "").lower() == "true",
+            targets=tuple(filter(None, (name.strip() for name in os.getenv("PROFILE_TARGETS", "").split(",")))),
+            interval_seconds=float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000,
+            top=int(os.getenv("PROFILE_TOP", 30)),
+            frames=int(os.getenv("PROFILE_FRAMES", 10))
+        )
+
+    @classmethod
+    def from_args(cls, args) -> "ProfilingConfig":
+        """The environment settings, overridden by the flags of `add_profiling_arguments`."""
+        config = cls.from_env()
+        if args.profile is not None:
+            config.mode = None if args.profile == "off" else args.profile
+        config.memory = config.memory or args.profile_memory
+        if args.profile_targets:
+            config.targets = tuple(name.strip() for name in args.profile_targets.split(","))
+        return config
+
+
+def add_profiling_arguments(parser):
+    parser.add_argument("--profile", choices=MODES + ("off",), default=None,
+                        help="profile the stages with cProfile or the sampling profiler (default: PROFILE)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="also trace allocations with tracemalloc (default: PROFILE_MEMORY)")
+    parser.add_argument("--profile-targets", default=None,
+                        help="comma separated names of the profiled functions (default: PROFILE_TARGETS, else all)")
+
+
+class SamplingProfiler:
+    """Records the stack of every thread each `interval_seconds` from a background thread.
+
+    The counts per stack are written as collapsed stacks (`thread;outer;...;inner
+    count`), the input of flamegraph.pl, speedscope and similar tools. As it
+    samples wall-clock time, threads waiting on the database or a queue show up
+    with the frame they wait in.
+    """
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval_seconds):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{getattr(code, 'co_qualname', code.co_name)} "
+                                 f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(calls))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def allocation_report(name: str, start: tracemalloc.Snapshot, end: tracemalloc.Snapshot, top: int) -> str:
+    """Where the block allocated memory it still held at its end, by line and by full traceback."""
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Allocations of {name}: peak traced {peak / 2 ** 20:.1f} MiB, "
+             f"{current / 2 ** 20:.1f} MiB traced at the end.", "",
+             f"Top {top} lines by growth during the block:"]
+    for stat in end.compare_to(start, "lineno")[:top]:
+        lines.append(f"  {stat}")
+    lines += ["", f"Top {top} tracebacks alive at the end:"]
+    for stat in end.statistics("traceback")[:top]:
+        lines.append(f"  {stat.size / 2 ** 10:.1f} KiB in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format())
+    return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """Profiles the blocks of the configured targets and writes the reports to <log_folder>/profiles.
+
+    One block is profiled at a time per process: a target entered while another
+    is being profiled, such as a step of a profiled stage, is part of the outer
+    profile instead of getting its own.
+    """
+
+    def __init__(self, config: ProfilingConfig, log_folder: str):
+        self.config = config
+        self.folder = os.path.join(log_folder, "profiles")
+        self._busy = threading.Lock()
+        self._sequence = itertools.count(1)
+
+    def selects(self, name: str) -> bool:
+        return not self.config.targets or name in self.config.targets
+
+    @contextmanager
+    def block(self, name: str) -> Iterator[None]:
+        if not self.selects(name) or not self._busy.acquire(blocking=False):
+            yield
+            return
+        try:
+            base = os.path.join(self.folder, f"{name}-{datetime.now().strftime('%Y%m%dT%H%M%S')}-"
+                                             f"{next(self._sequence)}")
+            with self._profiled(name, base):
+                yield
+        finally:
+            self._busy.release()
+
+    @contextmanager
+    def _profiled(self, name: str, base: str) -> Iterator[None]:
+        config = self.config
+        tracing = config.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(config.frames)
+        start_snapshot = None
+        if config.memory:
+            tracemalloc.reset_peak()
+            start_snapshot = tracemalloc.take_snapshot()
+        sampler = cpu_profile = None
+        if config.mode == "sampling":
+            sampler = SamplingProfiler(config.interval_seconds)
+            sampler.start()
+        elif config.mode == "cprofile":
+            cpu_profile = cProfile.Profile()
+            cpu_profile.enable()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if cpu_profile is not None:
+                cpu_profile.disable()
+            if sampler is not None:
+                sampler.stop()
+            end_snapshot = tracemalloc.take_snapshot() if config.memory else None
+            if end_snapshot is not None:
+                # Leave out what the profiler itself keeps, such as the sampled stacks.
+                ignored = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+                start_snapshot = start_snapshot.filter_traces(ignored)
+                end_snapshot = end_snapshot.filter_traces(ignored)
+            self._write(name, base, elapsed, cpu_profile, sampler, start_snapshot, end_snapshot)
+            if tracing:
+                tracemalloc.stop()
+
+    def _write(self, name: str, base: str, elapsed: float, cpu_profile: Optional[cProfile.Profile],
+               sampler: Optional[SamplingProfiler], start_snapshot, end_snapshot):
+        os.makedirs(self.folder, exist_ok=True)
+        written: List[str] = []
+        if cpu_profile is not None:
+            cpu_profile.dump_stats(f"{base}.pstats")
+            report = io.StringIO()
+            pstats.Stats(cpu_profile, stream=report).sort_stats("cumulative").print_stats(self.config.top)
+            with open(f"{base}.txt", "w") as file:
+                file.write(report.getvalue())
+            written += [f"{base}.pstats", f"{base}.txt"]
+        if sampler is not None:
+            sampler.write_collapsed(f"{base}.collapsed")
+            written.append(f"{base}.collapsed")
+        if end_snapshot is not None:
+            with open(f"{base}.allocations.txt", "w") as file:
+                file.write(allocation_report(name, start_snapshot, end_snapshot, self.config.top))
+            written.append(f"{base}.allocations.txt")
+        logger.info(f"Profiled {name} ({elapsed:.2f}s): {', '.join(written)}")
+
+
+_profiler: Optional[Profiler] = None
+
+
+def configure_profiling(log_folder: str, config: Optional[ProfilingConfig] = None) -> Optional[Profiler]:
+    """Profile the `profiled` functions of this process as configured (default: from the environment)."""
+    global _profiler
+    config = config or ProfilingConfig.from_env()
+    _profiler = Profiler(config, log_folder) if config.enabled else None
+    if _profiler is not None:
+        logger.info(f"Profiling {', '.join(config.targets) or 'all targets'} "
+                    f"(cpu: {config.mode or 'off'}, memory: {'on' if config.memory else 'off'}) "
+                    f"into {_profiler.folder}.")
+    return _profiler
+
+
+def profiled(name: str):
+    """Profile every call of the decorated function as `name` once profiling is configured.
+
+    Without profiling the wrapper only checks a module global before calling the
+    function, so it adds no measurable time to a stage.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _profiler.block(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
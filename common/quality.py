@@ -0,0 +1,196 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import psycopg2.extras
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+
+def to_numbers(values: Sequence) -> np.ndarray:
+    """Values as float64; NULL and anything that is not a number (stage columns are text) become NaN."""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([_to_number(value) for value in values], dtype=np.float64)
+
+
+def _to_number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+@dataclass
+class Reference:
+    """Rows looked up once per batch for the keys in one of its columns, e.g. the current image of each detection.
+
+    `query` takes the array of distinct keys as its only parameter and returns
+    the key followed by `fields`.
+    """
+    column: str
+    query: str
+    fields: Sequence[str] = ()
+
+
+class Batch:
+    """Column view of a chunk of rows; each column is converted once, when a rule first reads it."""
+
+    def __init__(self, columns: Sequence[str], rows: list):
+        self.size = len(rows)
+        self._raw = dict(zip(columns, (np.array(values, dtype=object) for values in zip(*rows))))
+        self._numbers: Dict[str, np.ndarray] = {}
+        self._references: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def raw(self, column: str) -> np.ndarray:
+        return self._raw[column]
+
+    def numbers(self, column: str) -> np.ndarray:
+        if column not in self._numbers:
+            self._numbers[column] = to_numbers(self._raw[column])
+        return self._numbers[column]
+
+    def resolve(self, name: str, reference: Reference, cursor):
+        """Look up `reference` for the keys of this batch; rows without a match get NaN fields."""
+        keys = self.numbers(reference.column)
+        distinct = np.unique(keys[np.isfinite(keys)])
+        cursor.execute(reference.query, ([int(key) for key in distinct],))
+        found = cursor.fetchall()
+
+        found_keys = to_numbers([row[0] for row in found])
+        order = np.argsort(found_keys)
+        found_keys = found_keys[order]
+        position = np.clip(np.searchsorted(found_keys, keys), 0, max(len(found_keys) - 1, 0))
+        matched = np.zeros(self.size, dtype=bool) if not len(found_keys) else found_keys[position] == keys
+
+        columns = {"found": matched}
+        for index, field_name in enumerate(reference.fields, start=1):
+            values = to_numbers([row[index] for row in found])[order] if found else np.full(1, np.nan)
+            columns[field_name] = np.where(matched, values[position], np.nan)
+        self._references[name] = columns
+
+    def reference(self, name: str, field_name: str = "found") -> np.ndarray:
+        return self._references[name][field_name]
+
+
+@dataclass
+class Rule:
+    """A named check over a whole batch; `passes` returns a boolean array with one entry per row."""
+    reason: str
+    passes: Callable[[Batch], np.ndarray]
+
+
+def not_null(column: str) -> Rule:
+    return Rule(f"{column} is missing", lambda batch: ~np.equal(batch.raw(column), None))
+
+
+def is_number(column: str) -> Rule:
+    return Rule(f"{column} is not a number", lambda batch: np.isfinite(batch.numbers(column)))
+
+
+def in_range(column: str, low: float, high: float) -> Rule:
+    """Passes finite values in [low, high]; NULL fails."""
+    def passes(batch: Batch) -> np.ndarray:
+        values = batch.numbers(column)
+        with np.errstate(invalid="ignore"):
+            return (values >= low) & (values <= high)
+    return Rule(f"{column} outside [{low}, {high}]", passes)
+
+
+def positive(column: str) -> Rule:
+    def passes(batch: Batch) -> np.ndarray:
+        with np.errstate(invalid="ignore"):
+            return batch.numbers(column) > 0
+    return Rule(f"{column} not positive", passes)
+
+
+def references(column: str, reference: str) -> Rule:
+    return Rule(f"{column} has no matching {reference}", lambda batch: batch.reference(reference))
+
+
+@dataclass
+class TableRules:
+    """Declarative checks of one table: its column names in row order, the rules and the lookups they use."""
+    columns: Sequence[str]
+    rules: List[Rule]
+    references: Dict[str, Reference] = field(default_factory=dict)
+    # Columns left out of the quarantined copy of a row, such as blobs.
+    omit: Sequence[str] = ()
+
+
+def evaluate(table_rules: TableRules, batch: Batch) -> Dict[int, List[str]]:
+    """Run every rule over the batch; returns the reasons of each failing row by its position."""
+    failed = np.zeros((len(table_rules.rules), batch.size), dtype=bool)
+    for index, rule in enumerate(table_rules.rules):
+        failed[index] = ~np.asarray(rule.passes(batch), dtype=bool)
+    failing = np.flatnonzero(failed.any(axis=0))
+    return {int(position): [rule.reason for index, rule in enumerate(table_rules.rules) if failed[index, position]]
+            for position in failing}
+
+
+class QualityGate:
+    """Checks every chunk a stage fetched against the rules of its table before it is written.
+
+    Rows failing a rule are written to <schema>.etl_quarantine (created by the
+    stage's migrations) with their reasons, in the same transaction as the chunk
+    and its checkpoint, and the other rows go on; a row already quarantined for
+    the same reasons has its entry updated. The checks run column-wise over the
+    whole chunk with NumPy; the time they take is the `quality.<table>` span of
+    the run.
+    """
+
+    def __init__(self, checkpoints, rule_sets: Dict[str, TableRules], enabled: bool = True):
+        self.checkpoints = checkpoints
+        self.rule_sets = rule_sets
+        self.enabled = enabled
+        self.quarantined: Dict[str, int] = {}
+        self._quarantine = sql.Identifier(checkpoints.schema, "etl_quarantine")
+
+    def check(self, cursor, table: str, rows: list) -> list:
+        """Return the rows of `table` that pass its rules and quarantine the others using `cursor`."""
+        table_rules = self.rule_sets.get(table)
+        if not self.enabled or table_rules is None or not rows:
+            return rows
+
+        with self.checkpoints.metrics.span(f"quality.{table}") as span:
+            batch = Batch(table_rules.columns, rows)
+            for name, reference in table_rules.references.items():
+                batch.resolve(name, reference, cursor)
+            failures = evaluate(table_rules, batch)
+            span.add(len(rows))
+            if not failures:
+                return rows
+            self._quarantine_rows(cursor, table, table_rules, rows, failures)
+
+        self.quarantined[table] = self.quarantined.get(table, 0) + len(failures)
+        reasons = sorted({reason for row_reasons in failures.values() for reason in row_reasons})
+        logger.warning(f"Quarantined {len(failures)} of {len(rows)} rows of {table}: {', '.join(reasons)}.")
+        return [row for position, row in enumerate(rows) if position not in failures]
+
+    def _quarantine_rows(self, cursor, table: str, table_rules: TableRules, rows: list,
+                         failures: Dict[int, List[str]]):
+        kept = [(index, name) for index, name in enumerate(table_rules.columns) if name not in table_rules.omit]
+        # One entry per key and reasons: a statement may not update the same row twice.
+        entries = {}
+        for position, reasons in failures.items():
+            row_key = None if rows[position][0] is None else str(rows[position][0])
+            entries[(row_key, tuple(reasons)) if row_key is not None else position] = (
+                self.checkpoints.run_id, self.checkpoints.stage, table, row_key, reasons,
+                json.dumps({name: rows[position][index] for index, name in kept}, default=str))
+        psycopg2.extras.execute_values(cursor, sql.SQL("""
+            INSERT INTO {} (run_id, stage, table_name, row_key, reasons, row_data) VALUES %s
+            ON CONFLICT (table_name, row_key, reasons) DO UPDATE
+            SET run_id = EXCLUDED.run_id,
+                stage = EXCLUDED.stage,
+                row_data = EXCLUDED.row_data,
+                quarantined_at = NOW();
+        """).format(self._quarantine).as_string(cursor), list(entries.values()))
+
+    def log_summary(self):
+        if self.quarantined:
+            logger.warning(f"{self.checkpoints.stage} quarantined "
+                           f"{', '.join(f'{count} rows of {table}' for table, count in self.quarantined.items())}.")
@@ -0,0 +1,11 @@
+# Schema the image processor writes and the ETL reads from.
+SOURCE_SCHEMA = "satellite_image_processing"
+
+# Tables the ETL reads through a view because their rows are stored differently from how they are loaded: detections
+# keep their annotated image in annotated_images (source migration V003) and the view puts it back on every row.
+SOURCE_VIEWS = {"detection_solar_panel": "detection_solar_panel_full"}
+
+
+def source_relation(table: str) -> str:
+    """The relation holding the rows of a source table in their original columns."""
+    return f"{SOURCE_SCHEMA}.{SOURCE_VIEWS.get(table, table)}"
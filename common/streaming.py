@@ -0,0 +1,35 @@
+import itertools
+import logging
+import os
+from typing import Iterator, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ITERSIZE = 1000
+
+_cursor_ids = itertools.count()
+
+
+def itersize_from_env(default: int = DEFAULT_ITERSIZE) -> int:
+    """Rows fetched per round trip by server-side cursors, configurable with ETL_ITERSIZE."""
+    return int(os.getenv("ETL_ITERSIZE", default))
+
+
+def iter_chunks(connection, query, params: Optional[Sequence] = None, itersize: Optional[int] = None,
+                name: Optional[str] = None) -> Iterator[list]:
+    """Run a query on a named (server-side) cursor and yield its rows in lists of at most `itersize`.
+
+    Only one chunk is held in memory at a time, however large the result is. The
+    cursor lives inside the connection's transaction, so the connection must not
+    be committed while the iterator is being consumed.
+    """
+    itersize = itersize or itersize_from_env()
+    cursor_name = name or f"etl_stream_{next(_cursor_ids)}"
+    with connection.cursor(name=cursor_name) as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            yield rows
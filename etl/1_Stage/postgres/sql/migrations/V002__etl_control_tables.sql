@@ -0,0 +1,34 @@
+-- Control tables of RunCheckpoints (common/checkpoints.py): the runs of each ETL stage writing to this database, the
+-- progress of every table in a run and the metrics of finished runs. RunCheckpoints used to create them itself on
+-- every start, hence IF NOT EXISTS.
+CREATE TABLE IF NOT EXISTS stage.etl_runs (
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMPTZ NULL,
+    PRIMARY KEY (run_id, stage)
+);
+
+CREATE TABLE IF NOT EXISTS stage.etl_checkpoints (
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    last_key BIGINT NOT NULL DEFAULT 0,
+    rows_done BIGINT NOT NULL DEFAULT 0,
+    completed BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, stage, table_name)
+);
+
+CREATE TABLE IF NOT EXISTS stage.etl_run_log (
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    finished_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    elapsed_seconds DOUBLE PRECISION NOT NULL,
+    rows BIGINT NOT NULL,
+    bytes BIGINT NOT NULL,
+    spans JSONB NOT NULL,
+    PRIMARY KEY (run_id, stage)
+);
@@ -1,56 +1,43 @@
 import os
 import logging
-import psycopg2
-from dataclasses import dataclass
+import sys
+import psycopg2.extras
 from dotenv import load_dotenv
 
+from common.changes import finish_full_load, start_full_load
+from common.checkpoints import RunCheckpoints
+from common.db import ConnectionPool, PoolConfig, PostgresConfig, run_with_reconnect
+from common.logging_config import configure_logging
+from common.memory import track_peak_rss
+from common.migrations import apply_migrations, resolve_migrations_dir
+from common.profiling import configure_profiling, profiled
+from common.source import source_relation
+from common.streaming import iter_chunks
 
-@dataclass
-class PostgresConfig:
-    dbname: str
-    user: str
-    password: str
-    host: str
-    port: int
+# Source tables and the key their rows are copied in order of, so a run can resume after the last copied key.
+SOURCE_TABLES = {
+    "images": "image_id",
+    "coordinates": "coordinates_id",
+    "predictions_roof_type": "prediction_id",
+    "detection_solar_panel": "detection_id"
+}
 
-    def __post_init__(self):
-        # Check if any of the required fields are missing
-        missing_fields = [
-            field for field in ["dbname", "user", "password", "host", "port"]
-            if getattr(self, field) is None
-        ]
-        if missing_fields:
-            raise ValueError(f"Missing required database configuration fields: {', '.join(missing_fields)}")
 
+LOG_FOLDER = os.path.join(os.path.dirname(__file__), 'logs')
 
-def setup_logging():
-    log_folder = os.path.join(os.path.dirname(__file__), 'logs')
-    os.makedirs(log_folder, exist_ok=True)
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(os.path.join(log_folder, 'app.log'))
-        ]
-    )
+def setup_logging():
+    return configure_logging("1_stage", LOG_FOLDER)
 
 
-def connect_postgres(config: PostgresConfig):
+def create_pool(config: PostgresConfig) -> ConnectionPool:
     try:
-        connection = psycopg2.connect(
-            dbname=config.dbname,
-            user=config.user,
-            password=config.password,
-            host=config.host,
-            port=config.port,
-        )
+        pool = ConnectionPool(config, PoolConfig.from_env("1_stage"))
         logging.info(f"Connected to database: {config.dbname} at {config.host}")
-        return connection
+        return pool
     except Exception as e:
-        logging.error(f"Error connecting to PostgreSQL: {e}")
-        return None
+        logging.error(f"Error connecting to PostgreSQL database {config.dbname}: {e}")
+        raise
 
 
 def truncate_table(cursor, table_name, cascade=False):
@@ -74,81 +61,88 @@ def truncate_table(cursor, table_name, cascade=False):
         cursor.connection.rollback()  # Rollback if there's an error
 
 
-def copy_table_data(source_cursor, dest_cursor, table_name):
-    """Copy data from source table to destination table."""
-    source_cursor.execute(f"SELECT * FROM satellite_image_processing.{table_name}")
-    rows = source_cursor.fetchall()
+@profiled("stage.copy_table_data")
+def copy_table_data(source_cursor, dest_cursor, table_name, checkpoints: RunCheckpoints):
+    """Copy a source table to the stage in key order, committing each chunk together with its checkpoint."""
+    key = SOURCE_TABLES[table_name]
+    last_key, copied, completed = checkpoints.table_state(table_name)
+    if completed:
+        logging.info(f"Table {table_name} already copied in this run ({copied} rows).")
+        return
 
-    if rows:
+    query = f"SELECT * FROM {source_relation(table_name)} WHERE {key} > %s ORDER BY {key}"
+    metrics = checkpoints.metrics
+    for rows in metrics.timed_chunks(f"extract.{table_name}", iter_chunks(source_cursor.connection, query,
+                                                                          (last_key,))):
         # Construct insert query for destination table
         placeholders = ', '.join(['%s'] * len(rows[0]))
         insert_query = f"INSERT INTO stage.{table_name} VALUES ({placeholders})"
 
-        dest_cursor.executemany(insert_query, rows)
-        logging.info(f"Copied {len(rows)} rows to {table_name}")
+        with metrics.span(f"load.{table_name}") as span:
+            psycopg2.extras.execute_batch(dest_cursor, insert_query, rows)
+            copied += len(rows)
+            last_key = rows[-1][0]
+            checkpoints.save(table_name, last_key, copied)
+            dest_cursor.connection.commit()
+            span.add_rows(rows)
+
+    checkpoints.save(table_name, last_key, copied, completed=True)
+    dest_cursor.connection.commit()
+
+    if copied:
+        logging.info(f"Copied {copied} rows to {table_name}")
     else:
         logging.info(f"No rows found in table: {table_name}")
 
 
-def main():
-    load_dotenv()
-    setup_logging()
-
-    source_config = PostgresConfig(
-        dbname=os.getenv("SOURCE_DBNAME"),
-        user=os.getenv("SOURCE_USER"),
-        password=os.getenv("SOURCE_PASSWORD"),
-        host=os.getenv("SOURCE_HOST"),
-        port=int(os.getenv("SOURCE_PORT"))
-    )
-
-    dest_config = PostgresConfig(
-        dbname=os.getenv("DEST_DBNAME"),
-        user=os.getenv("DEST_USER"),
-        password=os.getenv("DEST_PASSWORD"),
-        host=os.getenv("DEST_HOST"),
-        port=int(os.getenv("DEST_PORT"))
-    )
-
-    source_conn = connect_postgres(source_config)
-    dest_conn = connect_postgres(dest_config)
-
-    if not source_conn or not dest_conn:
-        logging.error("Failed to connect to source or destination database.")
+@profiled("stage.transfer_data")
+def transfer_data(source_conn, dest_conn):
+    """Replace the stage tables with a fresh copy of the source tables, resuming an interrupted run."""
+    checkpoints = RunCheckpoints(dest_conn, "stage", "1_stage")
+    checkpoints.start_run()
+    if checkpoints.completed:
         return
+    horizon = start_full_load(checkpoints, source_conn)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        # Truncate destination tables once per run; the step is checkpointed like a table
+        if not checkpoints.table_state("truncate")[2]:
+            for table in SOURCE_TABLES:
+                truncate_table(dest_cursor, table)
+            checkpoints.save("truncate", 0, 0, completed=True)
+            dest_conn.commit()
+
+        # Copy data from source to destination
+        for table in SOURCE_TABLES:
+            with track_peak_rss(f"stage.{table}"):
+                copy_table_data(source_cursor, dest_cursor, table, checkpoints)
+
+    finish_full_load(checkpoints, source_conn, horizon)
+    checkpoints.finish_run()
+    logging.info("Data transfer completed successfully.")
 
-    source_cursor = source_conn.cursor()
-    dest_cursor = dest_conn.cursor()
-
-    # Truncate destination tables
-    dest_tables = [
-        "images",
-        "coordinates",
-        "predictions_roof_type",
-        "detection_solar_panel"
-    ]
-
-    for table in dest_tables:
-        truncate_table(dest_cursor, table)
-
-    # Copy data from source to destination
-    source_tables = [
-        "images",
-        "coordinates",
-        "predictions_roof_type",
-        "detection_solar_panel"
-    ]
-
-    for table in source_tables:
-        copy_table_data(source_cursor, dest_cursor, table)
 
-    dest_conn.commit()
-    logging.info("Data transfer completed successfully.")
+def main():
+    load_dotenv()
+    setup_logging()
+    configure_profiling(LOG_FOLDER)
 
-    source_cursor.close()
-    dest_cursor.close()
-    source_conn.close()
-    dest_conn.close()
+    pools = []
+    try:
+        pools.append(create_pool(PostgresConfig.from_env("SOURCE")))
+        pools.append(create_pool(PostgresConfig.from_env("DEST")))
+        migrations = os.getenv("MIGRATIONS_DIR") or resolve_migrations_dir(os.path.dirname(os.path.abspath(__file__)))
+        with pools[1].connection() as dest_conn:
+            apply_migrations(dest_conn, migrations, "stage")
+        with track_peak_rss("1_Stage"):
+            run_with_reconnect(transfer_data, pools)
+    except Exception as e:
+        logging.error(f"Data transfer failed: {e}")
+        sys.exit(1)
+    finally:
+        # Only the pools that were opened, e.g. the source pool when the destination is unreachable.
+        for pool in pools:
+            pool.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+-- Every version of a row keeps its business key, so the key alone can be neither the primary key
+-- nor referenced by a foreign key, and a filename is only unique among current versions.
+ALTER TABLE history.coordinates DROP CONSTRAINT IF EXISTS coordinates_image_id_fkey;
+ALTER TABLE history.predictions_roof_type DROP CONSTRAINT IF EXISTS predictions_roof_type_image_id_fkey;
+ALTER TABLE history.detection_solar_panel DROP CONSTRAINT IF EXISTS detection_solar_panel_image_id_fkey;
+
+ALTER TABLE history.images DROP CONSTRAINT IF EXISTS images_filename_key;
+
+ALTER TABLE history.images DROP CONSTRAINT IF EXISTS images_pkey;
+ALTER TABLE history.images ADD CONSTRAINT images_pkey PRIMARY KEY (image_id, valid_from);
+
+ALTER TABLE history.coordinates DROP CONSTRAINT IF EXISTS coordinates_pkey;
+ALTER TABLE history.coordinates ADD CONSTRAINT coordinates_pkey PRIMARY KEY (coordinates_id, valid_from);
+
+ALTER TABLE history.predictions_roof_type DROP CONSTRAINT IF EXISTS predictions_roof_type_pkey;
+ALTER TABLE history.predictions_roof_type ADD CONSTRAINT predictions_roof_type_pkey PRIMARY KEY (prediction_id, valid_from);
+
+ALTER TABLE history.detection_solar_panel DROP CONSTRAINT IF EXISTS detection_solar_panel_pkey;
+ALTER TABLE history.detection_solar_panel ADD CONSTRAINT detection_solar_panel_pkey PRIMARY KEY (detection_id, valid_from);
+
+-- At most one current version per business key; these are the indexes behind every
+-- "... AND valid_to IS NULL" lookup of the SCD2 merge.
+CREATE UNIQUE INDEX IF NOT EXISTS images_current_image_id_key
+    ON history.images (image_id) INCLUDE (date_uploaded)
+    WHERE valid_to IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS images_current_filename_key
+    ON history.images (filename)
+    WHERE valid_to IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS coordinates_current_image_id_key
+    ON history.coordinates (image_id) INCLUDE (latitude, longitude)
+    WHERE valid_to IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS predictions_roof_type_current_prediction_id_key
+    ON history.predictions_roof_type (prediction_id)
+    WHERE valid_to IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS detection_solar_panel_current_detection_id_key
+    ON history.detection_solar_panel (detection_id)
+    WHERE valid_to IS NULL;
+
+-- Covering indexes for the 3_DM fact load, which joins current predictions and detections on image_id.
+CREATE INDEX IF NOT EXISTS predictions_roof_type_current_image_id_idx
+    ON history.predictions_roof_type (image_id) INCLUDE (prediction_id)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX IF NOT EXISTS detection_solar_panel_current_image_id_idx
+    ON history.detection_solar_panel (image_id) INCLUDE (detection_id)
+    WHERE valid_to IS NULL;
+
+ANALYZE history.images;
+ANALYZE history.coordinates;
+ANALYZE history.predictions_roof_type;
+ANALYZE history.detection_solar_panel;
@@ -0,0 +1,145 @@
+-- Turn the history tables into tables partitioned by RANGE (valid_from), one partition per month.
+-- Later partitions are created ahead of time by partitions.py; the DEFAULT partition only catches
+-- versions that fall outside every range and should stay empty.
+--
+-- A unique index on a partitioned table must contain the partition key, so the "one current version per
+-- business key" indexes of V002 become plain partial indexes; the SCD2 merge closes the current version
+-- before inserting the next one in the same transaction.
+
+ALTER TABLE history.images RENAME TO images_unpartitioned;
+ALTER TABLE history.coordinates RENAME TO coordinates_unpartitioned;
+ALTER TABLE history.predictions_roof_type RENAME TO predictions_roof_type_unpartitioned;
+ALTER TABLE history.detection_solar_panel RENAME TO detection_solar_panel_unpartitioned;
+
+CREATE TABLE history.images (
+    image_id BIGINT NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    filename TEXT NOT NULL,
+    image_data BYTEA NOT NULL,
+    date_uploaded TIMESTAMPTZ NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    valid_to TIMESTAMPTZ NULL
+) PARTITION BY RANGE (valid_from);
+
+CREATE TABLE history.coordinates (
+    coordinates_id BIGINT NOT NULL,
+    image_id BIGINT,
+    latitude DECIMAL(10, 5) NOT NULL,
+    longitude DECIMAL(10, 5) NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    valid_to TIMESTAMPTZ NULL
+) PARTITION BY RANGE (valid_from);
+
+CREATE TABLE history.predictions_roof_type (
+    prediction_id BIGINT NOT NULL,
+    image_id BIGINT,
+    class_name TEXT NOT NULL,
+    time_taken DECIMAL(10, 5) NOT NULL,
+    confidence DECIMAL(10, 5) NOT NULL,
+    prediction_type TEXT NOT NULL,
+    date_processed TIMESTAMPTZ NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    valid_to TIMESTAMPTZ NULL
+) PARTITION BY RANGE (valid_from);
+
+CREATE TABLE history.detection_solar_panel (
+    detection_id BIGINT NOT NULL,
+    image_id BIGINT,
+    class_name TEXT,
+    confidence DECIMAL(10, 5),
+    x INT,
+    y INT,
+    width INT,
+    height INT,
+    image_data BYTEA,
+    date_processed TIMESTAMPTZ NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    valid_to TIMESTAMPTZ NULL
+) PARTITION BY RANGE (valid_from);
+
+-- Monthly partitions from the oldest stored version up to the current month, plus the default partition.
+DO $$
+DECLARE
+    table_name TEXT;
+    first_month TIMESTAMP;
+    month_start TIMESTAMP;
+BEGIN
+    FOREACH table_name IN ARRAY ARRAY['images', 'coordinates', 'predictions_roof_type', 'detection_solar_panel']
+    LOOP
+        EXECUTE format('SELECT date_trunc(''month'', min(valid_from) AT TIME ZONE ''UTC'') FROM history.%I',
+                       table_name || '_unpartitioned')
+            INTO first_month;
+        month_start := coalesce(first_month, date_trunc('month', now() AT TIME ZONE 'UTC'));
+
+        WHILE month_start <= date_trunc('month', now() AT TIME ZONE 'UTC') LOOP
+            EXECUTE format(
+                'CREATE TABLE history.%I PARTITION OF history.%I FOR VALUES FROM (%L) TO (%L)',
+                table_name || '_p' || to_char(month_start, 'YYYYMMDD'),
+                table_name,
+                month_start AT TIME ZONE 'UTC',
+                (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+            );
+            month_start := month_start + INTERVAL '1 month';
+        END LOOP;
+
+        EXECUTE format('CREATE TABLE history.%I PARTITION OF history.%I DEFAULT', table_name || '_default', table_name);
+    END LOOP;
+END
+$$;
+
+INSERT INTO history.images SELECT image_id, width, height, filename, image_data, date_uploaded, valid_from, valid_to
+FROM history.images_unpartitioned;
+INSERT INTO history.coordinates SELECT coordinates_id, image_id, latitude, longitude, valid_from, valid_to
+FROM history.coordinates_unpartitioned;
+INSERT INTO history.predictions_roof_type SELECT prediction_id, image_id, class_name, time_taken, confidence,
+    prediction_type, date_processed, valid_from, valid_to
+FROM history.predictions_roof_type_unpartitioned;
+INSERT INTO history.detection_solar_panel SELECT detection_id, image_id, class_name, confidence, x, y, width, height,
+    image_data, date_processed, valid_from, valid_to
+FROM history.detection_solar_panel_unpartitioned;
+
+DROP TABLE history.images_unpartitioned;
+DROP TABLE history.coordinates_unpartitioned;
+DROP TABLE history.predictions_roof_type_unpartitioned;
+DROP TABLE history.detection_solar_panel_unpartitioned;
+
+ALTER TABLE history.images ADD CONSTRAINT images_pkey PRIMARY KEY (image_id, valid_from);
+ALTER TABLE history.coordinates ADD CONSTRAINT coordinates_pkey PRIMARY KEY (coordinates_id, valid_from);
+ALTER TABLE history.predictions_roof_type ADD CONSTRAINT predictions_roof_type_pkey PRIMARY KEY (prediction_id, valid_from);
+ALTER TABLE history.detection_solar_panel ADD CONSTRAINT detection_solar_panel_pkey PRIMARY KEY (detection_id, valid_from);
+
+-- Current-version access paths. In a partition whose versions are all closed these indexes are empty,
+-- so probing an old partition costs a single page.
+CREATE INDEX images_current_image_id_idx
+    ON history.images (image_id) INCLUDE (date_uploaded)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX images_current_filename_idx
+    ON history.images (filename)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX coordinates_current_image_id_idx
+    ON history.coordinates (image_id) INCLUDE (latitude, longitude)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX predictions_roof_type_current_prediction_id_idx
+    ON history.predictions_roof_type (prediction_id)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX detection_solar_panel_current_detection_id_idx
+    ON history.detection_solar_panel (detection_id)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX predictions_roof_type_current_image_id_idx
+    ON history.predictions_roof_type (image_id) INCLUDE (prediction_id)
+    WHERE valid_to IS NULL;
+
+CREATE INDEX detection_solar_panel_current_image_id_idx
+    ON history.detection_solar_panel (image_id) INCLUDE (detection_id)
+    WHERE valid_to IS NULL;
+
+ANALYZE history.images;
+ANALYZE history.coordinates;
+ANALYZE history.predictions_roof_type;
+ANALYZE history.detection_solar_panel;
@@ -0,0 +1,48 @@
+-- Point-in-time reads: every version gets its validity as a tstzrange, and "the version valid at T"
+-- becomes a GiST lookup on valid_period @> T instead of a scan comparing valid_from and valid_to.
+ALTER TABLE history.images
+    ADD COLUMN valid_period TSTZRANGE GENERATED ALWAYS AS (tstzrange(valid_from, valid_to, '[)')) STORED;
+ALTER TABLE history.coordinates
+    ADD COLUMN valid_period TSTZRANGE GENERATED ALWAYS AS (tstzrange(valid_from, valid_to, '[)')) STORED;
+ALTER TABLE history.predictions_roof_type
+    ADD COLUMN valid_period TSTZRANGE GENERATED ALWAYS AS (tstzrange(valid_from, valid_to, '[)')) STORED;
+ALTER TABLE history.detection_solar_panel
+    ADD COLUMN valid_period TSTZRANGE GENERATED ALWAYS AS (tstzrange(valid_from, valid_to, '[)')) STORED;
+
+-- With btree_gist the key and the period share one GiST index, which serves both "all rows as of T"
+-- and "this image as of T". Without the extension the period gets its own GiST index and the key
+-- lookup falls back to a btree on (key, valid_from).
+DO $$
+DECLARE
+    has_btree_gist BOOLEAN;
+BEGIN
+    SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'btree_gist') INTO has_btree_gist;
+
+    IF has_btree_gist THEN
+        CREATE EXTENSION IF NOT EXISTS btree_gist;
+        CREATE INDEX images_image_id_period_idx ON history.images USING gist (image_id, valid_period);
+        CREATE INDEX coordinates_image_id_period_idx ON history.coordinates USING gist (image_id, valid_period);
+        CREATE INDEX predictions_roof_type_image_id_period_idx
+            ON history.predictions_roof_type USING gist (image_id, valid_period);
+        CREATE INDEX detection_solar_panel_image_id_period_idx
+            ON history.detection_solar_panel USING gist (image_id, valid_period);
+    ELSE
+        RAISE NOTICE 'btree_gist is not available, indexing valid_period and image_id separately.';
+        CREATE INDEX images_period_idx ON history.images USING gist (valid_period);
+        CREATE INDEX coordinates_period_idx ON history.coordinates USING gist (valid_period);
+        CREATE INDEX predictions_roof_type_period_idx ON history.predictions_roof_type USING gist (valid_period);
+        CREATE INDEX detection_solar_panel_period_idx ON history.detection_solar_panel USING gist (valid_period);
+        CREATE INDEX images_image_id_valid_from_idx ON history.images (image_id, valid_from);
+        CREATE INDEX coordinates_image_id_valid_from_idx ON history.coordinates (image_id, valid_from);
+        CREATE INDEX predictions_roof_type_image_id_valid_from_idx
+            ON history.predictions_roof_type (image_id, valid_from);
+        CREATE INDEX detection_solar_panel_image_id_valid_from_idx
+            ON history.detection_solar_panel (image_id, valid_from);
+    END IF;
+END
+$$;
+
+ANALYZE history.images;
+ANALYZE history.coordinates;
+ANALYZE history.predictions_roof_type;
+ANALYZE history.detection_solar_panel;
@@ -0,0 +1,7 @@
+-- Images merged into history by the micro-batch daemon whose star rows have not been refreshed yet.
+-- Rows are added in the same transaction as the merge and removed once the star schema is committed,
+-- so a crash between the two databases only repeats a refresh.
+CREATE TABLE IF NOT EXISTS history.etl_pending_images (
+    image_id BIGINT PRIMARY KEY,
+    queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
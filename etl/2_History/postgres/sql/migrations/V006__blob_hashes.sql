@@ -0,0 +1,6 @@
+-- The star schema keeps blobs in a side table keyed by sha256. Storing the hash next to each blob lets
+-- 3_DM compare blobs by hash without reading, hashing or transferring the TOASTed data on every load.
+ALTER TABLE history.images
+    ADD COLUMN image_data_sha256 TEXT GENERATED ALWAYS AS (encode(sha256(image_data), 'hex')) STORED;
+ALTER TABLE history.detection_solar_panel
+    ADD COLUMN image_data_sha256 TEXT GENERATED ALWAYS AS (encode(sha256(image_data), 'hex')) STORED;
@@ -0,0 +1,23 @@
+-- Rows the data-quality gate (common/quality.py) kept out of history, with the reasons they failed.
+-- A row failing the same checks again, e.g. on every run until the source is fixed, updates its entry instead of
+-- adding one, so the table holds one entry per failing row and set of reasons. Rows without a key are not merged.
+CREATE TABLE IF NOT EXISTS history.etl_quarantine (
+    quarantine_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    row_key TEXT NULL,
+    reasons TEXT[] NOT NULL,
+    row_data JSONB NOT NULL,
+    quarantined_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- The gate used to create the table itself and add an entry per run; keep the latest of each.
+DELETE FROM history.etl_quarantine AS q
+USING history.etl_quarantine AS newer
+WHERE newer.table_name = q.table_name AND newer.row_key = q.row_key AND newer.reasons = q.reasons
+  AND newer.quarantine_id > q.quarantine_id;
+
+DROP INDEX IF EXISTS history.history_etl_quarantine_table_key_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS etl_quarantine_table_key_reasons_idx
+    ON history.etl_quarantine (table_name, row_key, reasons);
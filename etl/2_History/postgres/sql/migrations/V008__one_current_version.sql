@@ -0,0 +1,132 @@
+-- At most one current version (valid_to IS NULL) per business key, as V002's unique partial indexes enforced before
+-- V003 partitioned the tables by valid_from. A unique index on a partitioned table must contain the partition key,
+-- and a current version can sit in any partition (it was opened whenever it was last changed), so neither a unique
+-- index nor an exclusion constraint per partition can see two current versions in different months.
+--
+-- Instead, triggers record the key of every current version in history.current_version_keys, whose primary key
+-- rejects a second one. Closing a version releases its key, so the SCD2 merge (close, then insert the next version)
+-- keeps working; concurrent merges of the same key serialize on the primary key like they did on the unique index.
+-- Only inserts, deletes and changes of valid_to or a key column fire the triggers.
+--
+-- Lookups of current versions (WHERE key = ... AND valid_to IS NULL) cannot be pruned by valid_from and probe the
+-- current-version partial index of every partition; those indexes stay tiny in months whose versions are all closed.
+
+CREATE TABLE IF NOT EXISTS history.current_version_keys (
+    table_name TEXT NOT NULL,
+    key_column TEXT NOT NULL,
+    key_value TEXT NOT NULL,
+    PRIMARY KEY (table_name, key_column, key_value)
+);
+
+CREATE OR REPLACE FUNCTION history.claim_current_key(target_table TEXT, target_column TEXT, target_value TEXT)
+RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Like a unique index, NULL keys never conflict.
+    IF target_value IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO history.current_version_keys (table_name, key_column, key_value)
+    VALUES (target_table, target_column, target_value)
+    ON CONFLICT DO NOTHING;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'history.% already has a current version with % = %', target_table, target_column, target_value
+            USING ERRCODE = 'unique_violation';
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION history.release_current_key(target_table TEXT, target_column TEXT, target_value TEXT)
+RETURNS VOID
+LANGUAGE sql AS $$
+    DELETE FROM history.current_version_keys
+    WHERE table_name = target_table AND key_column = target_column AND key_value = target_value;
+$$;
+
+CREATE OR REPLACE FUNCTION history.images_current_version() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.valid_to IS NULL THEN
+        PERFORM history.release_current_key('images', 'image_id', OLD.image_id::TEXT);
+        PERFORM history.release_current_key('images', 'filename', OLD.filename);
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.valid_to IS NULL THEN
+        PERFORM history.claim_current_key('images', 'image_id', NEW.image_id::TEXT);
+        PERFORM history.claim_current_key('images', 'filename', NEW.filename);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION history.coordinates_current_version() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.valid_to IS NULL THEN
+        PERFORM history.release_current_key('coordinates', 'image_id', OLD.image_id::TEXT);
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.valid_to IS NULL THEN
+        PERFORM history.claim_current_key('coordinates', 'image_id', NEW.image_id::TEXT);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION history.predictions_roof_type_current_version() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.valid_to IS NULL THEN
+        PERFORM history.release_current_key('predictions_roof_type', 'prediction_id', OLD.prediction_id::TEXT);
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.valid_to IS NULL THEN
+        PERFORM history.claim_current_key('predictions_roof_type', 'prediction_id', NEW.prediction_id::TEXT);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION history.detection_solar_panel_current_version() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.valid_to IS NULL THEN
+        PERFORM history.release_current_key('detection_solar_panel', 'detection_id', OLD.detection_id::TEXT);
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.valid_to IS NULL THEN
+        PERFORM history.claim_current_key('detection_solar_panel', 'detection_id', NEW.detection_id::TEXT);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+-- The keys of the versions already current; fails on existing duplicates, which have to be closed by hand first.
+INSERT INTO history.current_version_keys (table_name, key_column, key_value)
+SELECT 'images', 'image_id', image_id::TEXT FROM history.images WHERE valid_to IS NULL
+UNION ALL
+SELECT 'images', 'filename', filename FROM history.images WHERE valid_to IS NULL
+UNION ALL
+SELECT 'coordinates', 'image_id', image_id::TEXT FROM history.coordinates WHERE valid_to IS NULL AND image_id IS NOT NULL
+UNION ALL
+SELECT 'predictions_roof_type', 'prediction_id', prediction_id::TEXT
+FROM history.predictions_roof_type WHERE valid_to IS NULL
+UNION ALL
+SELECT 'detection_solar_panel', 'detection_id', detection_id::TEXT
+FROM history.detection_solar_panel WHERE valid_to IS NULL;
+
+DROP TRIGGER IF EXISTS images_current_version ON history.images;
+CREATE TRIGGER images_current_version
+    AFTER INSERT OR DELETE OR UPDATE OF valid_to, image_id, filename ON history.images
+    FOR EACH ROW EXECUTE FUNCTION history.images_current_version();
+
+DROP TRIGGER IF EXISTS coordinates_current_version ON history.coordinates;
+CREATE TRIGGER coordinates_current_version
+    AFTER INSERT OR DELETE OR UPDATE OF valid_to, image_id ON history.coordinates
+    FOR EACH ROW EXECUTE FUNCTION history.coordinates_current_version();
+
+DROP TRIGGER IF EXISTS predictions_roof_type_current_version ON history.predictions_roof_type;
+CREATE TRIGGER predictions_roof_type_current_version
+    AFTER INSERT OR DELETE OR UPDATE OF valid_to, prediction_id ON history.predictions_roof_type
+    FOR EACH ROW EXECUTE FUNCTION history.predictions_roof_type_current_version();
+
+DROP TRIGGER IF EXISTS detection_solar_panel_current_version ON history.detection_solar_panel;
+CREATE TRIGGER detection_solar_panel_current_version
+    AFTER INSERT OR DELETE OR UPDATE OF valid_to, detection_id ON history.detection_solar_panel
+    FOR EACH ROW EXECUTE FUNCTION history.detection_solar_panel_current_version();
@@ -0,0 +1,48 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Query
+
+from as_of import AS_OF_TABLES, MAX_PAGE_SIZE, fetch_as_of, image_state_as_of, to_json_value
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+
+pools = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_dotenv()
+    pools["history"] = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig.from_env("2_history_api"))
+    yield
+    pools.pop("history").close()
+
+
+app = FastAPI(title="History as-of API", lifespan=lifespan)
+
+
+def as_utc(at: Optional[datetime]) -> datetime:
+    if at is None:
+        return datetime.now(timezone.utc)
+    return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+
+# Handlers are plain functions so FastAPI runs the blocking queries in its thread pool.
+@app.get("/as-of/{table}")
+def read_table_as_of(table: str, at: Optional[datetime] = None, image_id: Optional[int] = None,
+                     after: Optional[int] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    if table not in AS_OF_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown history table: {table}")
+    with pools["history"].connection() as connection:
+        page = fetch_as_of(connection, table, as_utc(at), image_id=image_id, after=after, limit=limit)
+    return {"rows": to_json_value(page.rows), "next_after": page.next_after}
+
+
+@app.get("/as-of/images/{image_id}/state")
+def read_image_state_as_of(image_id: int, at: Optional[datetime] = None):
+    with pools["history"].connection() as connection:
+        state = image_state_as_of(connection, image_id, as_utc(at))
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Image {image_id} did not exist at that time.")
+    return to_json_value(state)
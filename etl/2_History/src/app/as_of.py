@@ -0,0 +1,140 @@
+import argparse
+import base64
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+
+# Business key and readable columns of every history table; image_data is only read on request.
+AS_OF_TABLES = {
+    "images": ("image_id", ["image_id", "width", "height", "filename", "date_uploaded"]),
+    "coordinates": ("coordinates_id", ["coordinates_id", "image_id", "latitude", "longitude"]),
+    "predictions_roof_type": ("prediction_id", ["prediction_id", "image_id", "class_name", "time_taken",
+                                                "confidence", "prediction_type", "date_processed"]),
+    "detection_solar_panel": ("detection_id", ["detection_id", "image_id", "class_name", "confidence",
+                                               "x", "y", "width", "height", "date_processed"]),
+}
+MAX_PAGE_SIZE = 1000
+
+
+@dataclass
+class Page:
+    rows: List[dict]
+    # Key to pass as `after` for the next page; None on the last page.
+    next_after: Optional[int]
+
+
+def fetch_as_of(connection, table: str, at: datetime, image_id: Optional[int] = None, after: Optional[int] = None,
+                limit: int = 100, include_image_data: bool = False) -> Page:
+    """Return the versions of `table` that were valid at `at`, ordered by business key, one page at a time."""
+    if table not in AS_OF_TABLES:
+        raise ValueError(f"Unknown history table: {table}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    key, columns = AS_OF_TABLES[table]
+    if include_image_data and table in ("images", "detection_solar_panel"):
+        columns = columns + ["image_data"]
+
+    # valid_from <= at adds nothing logically but lets the planner skip partitions that start after `at`.
+    conditions = [sql.SQL("valid_period @> %(at)s::timestamptz"), sql.SQL("valid_from <= %(at)s")]
+    if image_id is not None:
+        conditions.append(sql.SQL("image_id = %(image_id)s"))
+    if after is not None:
+        conditions.append(sql.SQL("{} > %(after)s").format(sql.Identifier(key)))
+
+    query = sql.SQL("SELECT {columns} FROM {table} WHERE {conditions} ORDER BY {key} LIMIT %(limit)s;").format(
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        table=sql.Identifier("history", table),
+        conditions=sql.SQL(" AND ").join(conditions),
+        key=sql.Identifier(key)
+    )
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(query, {"at": at, "image_id": image_id, "after": after, "limit": limit + 1})
+        rows = cursor.fetchall()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][key]
+    return Page(rows=[dict(row) for row in rows], next_after=next_after)
+
+
+def image_state_as_of(connection, image_id: int, at: datetime) -> Optional[dict]:
+    """Return the image and everything recorded about it as it stood at `at`, or None if it did not exist yet."""
+    image = fetch_as_of(connection, "images", at, image_id=image_id, limit=1).rows
+    if not image:
+        return None
+    state = {"image": image[0]}
+    for table in ("coordinates", "predictions_roof_type", "detection_solar_panel"):
+        rows, after = [], None
+        while True:
+            page = fetch_as_of(connection, table, at, image_id=image_id, after=after, limit=MAX_PAGE_SIZE)
+            rows.extend(page.rows)
+            if page.next_after is None:
+                break
+            after = page.next_after
+        state[table] = rows
+    return state
+
+
+def to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    return value
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO timestamp; naive values are taken as UTC."""
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the history tables as they were at a point in time.")
+    parser.add_argument("--at", type=parse_timestamp, default=datetime.now(timezone.utc),
+                        help="ISO timestamp, UTC when no offset is given (default: now)")
+    parser.add_argument("--table", choices=sorted(AS_OF_TABLES), default="images")
+    parser.add_argument("--image-id", type=int, help="restrict to one image")
+    parser.add_argument("--state", action="store_true", help="print everything known about --image-id")
+    parser.add_argument("--after", type=int, help="key of the last row of the previous page")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="2_history_as_of"))
+    try:
+        with pool.connection() as connection:
+            if args.state:
+                if args.image_id is None:
+                    parser.error("--state needs --image-id")
+                print(json.dumps(to_json_value(image_state_as_of(connection, args.image_id, args.at)), indent=2))
+            else:
+                page = fetch_as_of(connection, args.table, args.at, image_id=args.image_id, after=args.after,
+                                   limit=args.limit)
+                for row in page.rows:
+                    print(json.dumps(to_json_value(row)))
+                if page.next_after is not None:
+                    print(f"# next page: --after {page.next_after}")
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
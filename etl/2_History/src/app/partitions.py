@@ -0,0 +1,224 @@
+import argparse
+import gzip
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+
+HISTORY_TABLES = ["images", "coordinates", "predictions_roof_type", "detection_solar_panel"]
+
+
+@dataclass
+class PartitionConfig:
+    months_per_partition: int = 1
+    # Number of partitions kept ready beyond the one holding the current time.
+    partitions_ahead: int = 3
+    # Closed partitions whose range ended more than this many months ago are archived.
+    retain_months: int = 12
+    archive_folder: str = "archive"
+
+    @classmethod
+    def from_env(cls) -> "PartitionConfig":
+        return cls(
+            months_per_partition=int(os.getenv("HISTORY_PARTITION_MONTHS", 1)),
+            partitions_ahead=int(os.getenv("HISTORY_PARTITIONS_AHEAD", 3)),
+            retain_months=int(os.getenv("HISTORY_RETAIN_MONTHS", 12)),
+            archive_folder=os.getenv("HISTORY_ARCHIVE_FOLDER",
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+        )
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    """Return the first day of the month `months` after the month of `moment`, in UTC."""
+    moment = moment.astimezone(timezone.utc)
+    month_index = moment.year * 12 + moment.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def list_partitions(connection, table: str) -> List[Tuple[str, datetime, datetime]]:
+    """Return (name, lower bound, upper bound) of the range partitions of a history table, oldest first.
+
+    The bounds are returned in UTC whatever the session time zone, so month arithmetic and partition
+    names do not shift by the server's offset.
+    """
+    query = """
+        SELECT child.relname,
+               (regexp_match(pg_get_expr(child.relpartbound, child.oid), 'FROM \\(''([^'']+)''\\)'))[1]::timestamptz,
+               (regexp_match(pg_get_expr(child.relpartbound, child.oid), 'TO \\(''([^'']+)''\\)'))[1]::timestamptz
+        FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_namespace AS ns ON ns.oid = parent.relnamespace
+        WHERE ns.nspname = 'history' AND parent.relname = %s
+          AND pg_get_expr(child.relpartbound, child.oid) <> 'DEFAULT'
+        ORDER BY 2;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, (table,))
+        return [(name, lower.astimezone(timezone.utc), upper.astimezone(timezone.utc))
+                for name, lower, upper in cursor.fetchall()]
+
+
+def stored_columns(cursor, table: str) -> List[str]:
+    """Columns of a history table that can be inserted, i.e. all but the generated ones."""
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum;
+    """, (f"history.{table}",))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor, table: str, name: str, lower: datetime, upper: datetime) -> int:
+    """Create the partition of [lower, upper), first moving the versions of that range out of DEFAULT.
+
+    Postgres refuses to create a partition while the DEFAULT partition holds rows of its range.
+    Those rows are deleted and inserted again through the parent, so the current-version triggers
+    see a delete followed by an insert. Returns the number of rows moved.
+    """
+    parent = sql.Identifier("history", table)
+    partition = sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);").format(
+        sql.Identifier("history", name), parent)
+    in_range = sql.SQL("valid_from >= %s AND valid_from < %s")
+    default = sql.Identifier("history", f"{table}_default")
+
+    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {});").format(default, in_range), (lower, upper))
+    if not cursor.fetchone()[0]:
+        cursor.execute(partition, (lower, upper))
+        return 0
+
+    columns = sql.SQL(", ").join(map(sql.Identifier, stored_columns(cursor, table)))
+    cursor.execute(sql.SQL("CREATE TEMP TABLE partition_move AS SELECT {} FROM {} WHERE {};").format(
+        columns, default, in_range), (lower, upper))
+    cursor.execute(sql.SQL("DELETE FROM {} WHERE {};").format(default, in_range), (lower, upper))
+    cursor.execute(partition, (lower, upper))
+    cursor.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM partition_move;").format(parent, columns, columns))
+    moved = cursor.rowcount
+    cursor.execute("DROP TABLE partition_move;")
+    logging.warning(f"Moved {moved} rows of history.{table} from the DEFAULT partition to {name}.")
+    return moved
+
+
+def ensure_partitions(connection, table: str, config: PartitionConfig, now: Optional[datetime] = None) -> List[str]:
+    """Create partitions after the newest existing one until `partitions_ahead` future ranges exist.
+
+    Months are counted in UTC. Rows already in DEFAULT for a new range move into it in the same transaction.
+    """
+    now = now or datetime.now(timezone.utc)
+    partitions = list_partitions(connection, table)
+    lower = partitions[-1][2] if partitions else add_months(now, 0)
+    horizon = add_months(now, config.months_per_partition * (config.partitions_ahead + 1))
+
+    created = []
+    with connection.cursor() as cursor:
+        while lower < horizon:
+            upper = add_months(lower, config.months_per_partition)
+            name = f"{table}_p{lower:%Y%m%d}"
+            create_partition(cursor, table, name, lower, upper)
+            created.append(name)
+            lower = upper
+    connection.commit()
+
+    if created:
+        logging.info(f"Created partitions {', '.join(created)} of history.{table}.")
+    return created
+
+
+def has_open_versions(connection, partition: str) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE valid_to IS NULL);").format(
+            sql.Identifier("history", partition)))
+        return cursor.fetchone()[0]
+
+
+def export_partition(connection, partition: str, archive_folder: str) -> str:
+    """Write a partition to <archive_folder>/<partition>.csv.gz and return the file path."""
+    os.makedirs(archive_folder, exist_ok=True)
+    path = os.path.join(archive_folder, f"{partition}.csv.gz")
+    temp_path = f"{path}.tmp"
+    query = sql.SQL("COPY (SELECT * FROM {}) TO STDOUT WITH (FORMAT csv, HEADER);").format(
+        sql.Identifier("history", partition))
+    with gzip.open(temp_path, "wb") as file, connection.cursor() as cursor:
+        cursor.copy_expert(query.as_string(connection), file)
+    os.replace(temp_path, path)
+    return path
+
+
+def archive_partitions(connection, table: str, config: PartitionConfig, now: Optional[datetime] = None,
+                       dry_run: bool = False) -> List[str]:
+    """Export, detach and drop partitions older than the retention period that hold no current version.
+
+    Closed versions are never updated again, so the export is consistent; removing
+    the partition afterwards only touches the catalog instead of deleting rows.
+    """
+    now = now or datetime.now(timezone.utc)
+    cutoff = add_months(now, -config.retain_months)
+    archived = []
+
+    for name, _, upper in list_partitions(connection, table):
+        if upper > cutoff:
+            break
+        if has_open_versions(connection, name):
+            logging.info(f"Keeping {name}: it still holds current versions.")
+            continue
+        if dry_run:
+            logging.info(f"Would archive {name}.")
+            archived.append(name)
+            continue
+
+        path = export_partition(connection, name, config.archive_folder)
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(
+                sql.Identifier("history", table), sql.Identifier("history", name)))
+            cursor.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier("history", name)))
+        connection.commit()
+        logging.info(f"Archived {name} to {path}.")
+        archived.append(name)
+
+    connection.rollback()
+    return archived
+
+
+def maintain_partitions(connection, config: PartitionConfig):
+    for table in HISTORY_TABLES:
+        ensure_partitions(connection, table, config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the partitions of the history tables.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("ensure", help="create upcoming partitions")
+    archive_parser = subcommands.add_parser("archive", help="export and drop closed partitions past retention")
+    archive_parser.add_argument("--retain-months", type=int, help="override HISTORY_RETAIN_MONTHS")
+    archive_parser.add_argument("--archive-folder", help="override HISTORY_ARCHIVE_FOLDER")
+    archive_parser.add_argument("--dry-run", action="store_true", help="only list the partitions to archive")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    config = PartitionConfig.from_env()
+    if getattr(args, "retain_months", None) is not None:
+        config.retain_months = args.retain_months
+    if getattr(args, "archive_folder", None):
+        config.archive_folder = args.archive_folder
+
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig.from_env("2_history_partitions"))
+    try:
+        with pool.connection() as connection:
+            if args.command == "ensure":
+                maintain_partitions(connection, config)
+            else:
+                for table in HISTORY_TABLES:
+                    archive_partitions(connection, table, config, dry_run=args.dry_run)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
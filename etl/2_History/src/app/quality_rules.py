@@ -0,0 +1,93 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+import numpy as np
+
+from common.quality import Batch, Reference, Rule, TableRules, in_range, is_number, not_null, positive, references
+
+# Placeholder detection the image processor stores for an image without boxes; it has no box to check.
+NO_PREDICTIONS = "No predictions"
+
+CURRENT_IMAGES = Reference(
+    column="image_id",
+    query="SELECT image_id, width, height FROM history.images WHERE valid_to IS NULL AND image_id = ANY(%s);",
+    fields=("width", "height")
+)
+
+
+@dataclass
+class QualityConfig:
+    enabled: bool = True
+    # Where the imagery is expected to be; the processor covers Hungary.
+    latitude_range: Tuple[float, float] = (45.7, 48.7)
+    longitude_range: Tuple[float, float] = (16.0, 23.0)
+
+    @classmethod
+    def from_env(cls) -> "QualityConfig":
+        """Read ETL_QUALITY_ENABLED and ETL_QUALITY_LATITUDE_RANGE / ETL_QUALITY_LONGITUDE_RANGE ("min,max")."""
+        defaults = cls()
+        return cls(
+            enabled=os.getenv("ETL_QUALITY_ENABLED", "true").lower() == "true",
+            latitude_range=_range(os.getenv("ETL_QUALITY_LATITUDE_RANGE"), defaults.latitude_range),
+            longitude_range=_range(os.getenv("ETL_QUALITY_LONGITUDE_RANGE"), defaults.longitude_range)
+        )
+
+
+def _range(value, default: Tuple[float, float]) -> Tuple[float, float]:
+    if not value:
+        return default
+    low, high = (float(part) for part in value.split(","))
+    return low, high
+
+
+def box_inside_image(batch: Batch) -> np.ndarray:
+    """Boxes (x and y are centres) must lie inside their image; the no-predictions placeholder passes."""
+    x, y = batch.numbers("x"), batch.numbers("y")
+    half_width, half_height = batch.numbers("width") / 2, batch.numbers("height") / 2
+    image_width, image_height = batch.reference("image", "width"), batch.reference("image", "height")
+    with np.errstate(invalid="ignore"):
+        inside = (x - half_width >= 0) & (x + half_width <= image_width) \
+            & (y - half_height >= 0) & (y + half_height <= image_height)
+    return inside | (batch.raw("class_name") == NO_PREDICTIONS)
+
+
+def box_has_size(batch: Batch) -> np.ndarray:
+    with np.errstate(invalid="ignore"):
+        sized = (batch.numbers("width") > 0) & (batch.numbers("height") > 0)
+    return sized | (batch.raw("class_name") == NO_PREDICTIONS)
+
+
+def history_rules(config: QualityConfig) -> Dict[str, TableRules]:
+    """Checks of the rows merged into history, by source table; the columns are those of the source and stage."""
+    image_reference = {"image": CURRENT_IMAGES}
+    return {
+        "images": TableRules(
+            columns=("image_id", "width", "height", "filename", "image_data", "date_uploaded"),
+            rules=[is_number("image_id"), positive("width"), positive("height"), not_null("filename"),
+                   not_null("image_data"), not_null("date_uploaded")],
+            omit=("image_data",)
+        ),
+        "coordinates": TableRules(
+            columns=("coordinates_id", "image_id", "latitude", "longitude"),
+            rules=[references("image_id", "image"), in_range("latitude", *config.latitude_range),
+                   in_range("longitude", *config.longitude_range)],
+            references=image_reference
+        ),
+        "predictions_roof_type": TableRules(
+            columns=("prediction_id", "image_id", "class_name", "time_taken", "confidence", "prediction_type",
+                     "date_processed"),
+            rules=[references("image_id", "image"), not_null("class_name"), in_range("confidence", 0.0, 1.0),
+                   in_range("time_taken", 0.0, np.inf)],
+            references=image_reference
+        ),
+        "detection_solar_panel": TableRules(
+            columns=("detection_id", "image_id", "class_name", "confidence", "x", "y", "width", "height",
+                     "image_data", "date_processed"),
+            rules=[references("image_id", "image"), in_range("confidence", 0.0, 1.0),
+                   Rule("box has no size", box_has_size),
+                   Rule("box outside image", box_inside_image)],
+            references=image_reference,
+            omit=("image_data",)
+        ),
+    }
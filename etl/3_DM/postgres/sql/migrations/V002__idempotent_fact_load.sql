@@ -0,0 +1,14 @@
+-- 3_DM upserts into the star schema instead of truncating it, so a fact row needs a natural key:
+-- one row per image, roof type prediction and solar panel detection, where either may be missing.
+DELETE FROM star.fact_images AS f
+USING star.fact_images AS newer
+WHERE f.image_id = newer.image_id
+  AND f.dim_roof_type_id IS NOT DISTINCT FROM newer.dim_roof_type_id
+  AND f.dim_solar_panel_id IS NOT DISTINCT FROM newer.dim_solar_panel_id
+  AND f.fact_id < newer.fact_id;
+
+ALTER TABLE star.fact_images
+    ADD CONSTRAINT fact_images_grain_key UNIQUE NULLS NOT DISTINCT (image_id, dim_roof_type_id, dim_solar_panel_id);
+
+-- Rows not refreshed by a completed load are removed by date_loaded.
+CREATE INDEX IF NOT EXISTS fact_images_date_loaded_idx ON star.fact_images (date_loaded);
@@ -0,0 +1,119 @@
+-- Pre-aggregated facts per roof class, day and 0.1 degree grid cell, maintained incrementally by rollups.py.
+-- Triggers record which (date_id, cell) groups a load touched; a refresh recomputes only those groups.
+
+CREATE OR REPLACE FUNCTION star.grid_cell(coordinate NUMERIC) RETURNS NUMERIC
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT floor(coordinate / 0.1) * 0.1
+$$;
+
+CREATE TABLE IF NOT EXISTS star.rollup_roof_solar (
+    roof_class TEXT NOT NULL,
+    date_id INT NOT NULL REFERENCES star.dim_date(date_id),
+    grid_lat NUMERIC(9, 4) NOT NULL,
+    grid_lon NUMERIC(9, 4) NOT NULL,
+    fact_count BIGINT NOT NULL,
+    image_count BIGINT NOT NULL,
+    detection_count BIGINT NOT NULL,
+    avg_roof_confidence NUMERIC NULL,
+    avg_detection_confidence NUMERIC NULL,
+    detection_area BIGINT NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (roof_class, date_id, grid_lat, grid_lon)
+);
+
+CREATE INDEX IF NOT EXISTS rollup_roof_solar_cell_idx ON star.rollup_roof_solar (date_id, grid_lat, grid_lon);
+
+CREATE TABLE IF NOT EXISTS star.rollup_dirty_cells (
+    date_id INT NOT NULL,
+    grid_lat NUMERIC(9, 4) NOT NULL,
+    grid_lon NUMERIC(9, 4) NOT NULL,
+    PRIMARY KEY (date_id, grid_lat, grid_lon)
+);
+
+CREATE OR REPLACE FUNCTION star.mark_fact_cells_dirty() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+        SELECT OLD.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+        FROM star.dim_images AS i
+        WHERE i.dim_image_id = OLD.image_id
+        ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+        SELECT NEW.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+        FROM star.dim_images AS i
+        WHERE i.dim_image_id = NEW.image_id
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+-- Dimension changes move facts between groups or change their measures without touching the fact row.
+CREATE OR REPLACE FUNCTION star.mark_dimension_cells_dirty() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'dim_images' THEN
+        INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+        SELECT DISTINCT f.date_id, star.grid_cell(cell.latitude), star.grid_cell(cell.longitude)
+        FROM star.fact_images AS f
+        CROSS JOIN (VALUES (OLD.latitude, OLD.longitude), (NEW.latitude, NEW.longitude)) AS cell(latitude, longitude)
+        WHERE f.image_id = NEW.dim_image_id
+        ON CONFLICT DO NOTHING;
+    ELSIF TG_TABLE_NAME = 'dim_predictions_roof_type' THEN
+        INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+        SELECT DISTINCT f.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+        FROM star.fact_images AS f
+        JOIN star.dim_images AS i ON i.dim_image_id = f.image_id
+        WHERE f.dim_roof_type_id = NEW.dim_roof_type_id
+        ON CONFLICT DO NOTHING;
+    ELSE
+        INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+        SELECT DISTINCT f.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+        FROM star.fact_images AS f
+        JOIN star.dim_images AS i ON i.dim_image_id = f.image_id
+        WHERE f.dim_solar_panel_id = NEW.dim_solar_panel_id
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+-- Loads upsert every row and bump date_loaded; only changes that affect a rollup mark cells dirty.
+CREATE TRIGGER fact_images_rollup_insert_delete
+    AFTER INSERT OR DELETE ON star.fact_images
+    FOR EACH ROW EXECUTE FUNCTION star.mark_fact_cells_dirty();
+
+CREATE TRIGGER fact_images_rollup_update
+    AFTER UPDATE ON star.fact_images
+    FOR EACH ROW
+    WHEN (OLD.date_id IS DISTINCT FROM NEW.date_id)
+    EXECUTE FUNCTION star.mark_fact_cells_dirty();
+
+CREATE TRIGGER dim_images_rollup_update
+    AFTER UPDATE ON star.dim_images
+    FOR EACH ROW
+    WHEN (OLD.latitude IS DISTINCT FROM NEW.latitude OR OLD.longitude IS DISTINCT FROM NEW.longitude)
+    EXECUTE FUNCTION star.mark_dimension_cells_dirty();
+
+CREATE TRIGGER dim_predictions_roof_type_rollup_update
+    AFTER UPDATE ON star.dim_predictions_roof_type
+    FOR EACH ROW
+    WHEN (OLD.class_name IS DISTINCT FROM NEW.class_name OR OLD.confidence IS DISTINCT FROM NEW.confidence)
+    EXECUTE FUNCTION star.mark_dimension_cells_dirty();
+
+CREATE TRIGGER dim_detections_solar_panel_rollup_update
+    AFTER UPDATE ON star.dim_detections_solar_panel
+    FOR EACH ROW
+    WHEN (OLD.class_name IS DISTINCT FROM NEW.class_name OR OLD.confidence IS DISTINCT FROM NEW.confidence
+          OR OLD.width IS DISTINCT FROM NEW.width OR OLD.height IS DISTINCT FROM NEW.height)
+    EXECUTE FUNCTION star.mark_dimension_cells_dirty();
+
+-- Facts loaded before this migration are summarised by the first refresh.
+INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+SELECT DISTINCT f.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+FROM star.fact_images AS f
+JOIN star.dim_images AS i ON i.dim_image_id = f.image_id
+ON CONFLICT DO NOTHING;
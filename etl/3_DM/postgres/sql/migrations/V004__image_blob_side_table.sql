@@ -0,0 +1,37 @@
+-- Dimensions keep only analytic attributes and the sha256 of their blob; the blobs themselves live once
+-- in star.image_blobs, together with a small JPEG thumbnail for dashboards that blobs.py fills in.
+CREATE TABLE IF NOT EXISTS star.image_blobs (
+    sha256 TEXT PRIMARY KEY,
+    image_data BYTEA NOT NULL,
+    byte_size INT NOT NULL,
+    thumbnail BYTEA NULL,
+    date_loaded TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO star.image_blobs (sha256, image_data, byte_size)
+SELECT DISTINCT ON (sha256) sha256, image_data, length(image_data)
+FROM (
+    SELECT encode(sha256(image_data), 'hex') AS sha256, image_data FROM star.dim_images
+    UNION ALL
+    SELECT encode(sha256(image_data), 'hex'), image_data FROM star.dim_detections_solar_panel
+    WHERE image_data IS NOT NULL
+) AS blobs
+ORDER BY sha256
+ON CONFLICT (sha256) DO NOTHING;
+
+ALTER TABLE star.dim_images ADD COLUMN image_data_sha256 TEXT NULL;
+UPDATE star.dim_images SET image_data_sha256 = encode(sha256(image_data), 'hex');
+ALTER TABLE star.dim_images ALTER COLUMN image_data_sha256 SET NOT NULL;
+-- Migrations run in a transaction, so the space of the dropped blobs is reclaimed by the next (auto)vacuum
+-- once every row has been rewritten by a load.
+ALTER TABLE star.dim_images DROP COLUMN image_data;
+
+ALTER TABLE star.dim_detections_solar_panel ADD COLUMN image_data_sha256 TEXT NULL;
+UPDATE star.dim_detections_solar_panel SET image_data_sha256 = encode(sha256(image_data), 'hex')
+WHERE image_data IS NOT NULL;
+ALTER TABLE star.dim_detections_solar_panel DROP COLUMN image_data;
+
+-- Blobs no longer referenced by any dimension row are removed at the end of a load.
+CREATE INDEX IF NOT EXISTS dim_images_image_data_sha256_idx ON star.dim_images (image_data_sha256);
+CREATE INDEX IF NOT EXISTS dim_detections_solar_panel_image_data_sha256_idx
+    ON star.dim_detections_solar_panel (image_data_sha256);
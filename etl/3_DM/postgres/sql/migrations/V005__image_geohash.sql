@@ -0,0 +1,58 @@
+-- Every image gets the geohash of its coordinates, so region queries scan index ranges of cells instead of
+-- filtering all of star.dim_images on latitude and longitude. spatial.py computes the same cells in Python.
+
+CREATE OR REPLACE FUNCTION star.geohash(latitude DOUBLE PRECISION, longitude DOUBLE PRECISION, chars INT)
+RETURNS TEXT
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    alphabet CONSTANT TEXT := '0123456789bcdefghjkmnpqrstuvwxyz';
+    lat_low DOUBLE PRECISION := -90;
+    lat_high DOUBLE PRECISION := 90;
+    lon_low DOUBLE PRECISION := -180;
+    lon_high DOUBLE PRECISION := 180;
+    middle DOUBLE PRECISION;
+    is_longitude BOOLEAN := TRUE;
+    value INT := 0;
+    bits INT := 0;
+    hash TEXT := '';
+BEGIN
+    -- Bits alternate between longitude and latitude, starting with longitude; every 5 bits are one character.
+    WHILE length(hash) < chars LOOP
+        IF is_longitude THEN
+            middle := (lon_low + lon_high) / 2;
+            IF longitude >= middle THEN
+                value := value * 2 + 1;
+                lon_low := middle;
+            ELSE
+                value := value * 2;
+                lon_high := middle;
+            END IF;
+        ELSE
+            middle := (lat_low + lat_high) / 2;
+            IF latitude >= middle THEN
+                value := value * 2 + 1;
+                lat_low := middle;
+            ELSE
+                value := value * 2;
+                lat_high := middle;
+            END IF;
+        END IF;
+        is_longitude := NOT is_longitude;
+        bits := bits + 1;
+        IF bits = 5 THEN
+            hash := hash || substr(alphabet, value + 1, 1);
+            value := 0;
+            bits := 0;
+        END IF;
+    END LOOP;
+    RETURN hash;
+END
+$$;
+
+-- 8 characters are cells of about 38 x 19 metres. The "C" collation orders hashes like their cells nest, so
+-- all hashes starting with a prefix are one index range.
+ALTER TABLE star.dim_images
+    ADD COLUMN geohash TEXT COLLATE "C"
+    GENERATED ALWAYS AS (star.geohash(latitude::DOUBLE PRECISION, longitude::DOUBLE PRECISION, 8)) STORED;
+
+CREATE INDEX IF NOT EXISTS dim_images_geohash_idx ON star.dim_images (geohash);
@@ -0,0 +1,16 @@
+-- The county and municipality of each image, assigned by regions.py from the boundary polygons in
+-- STAR_REGIONS_GEOJSON while dim_images is loaded. NULL when no boundaries are configured or the point is in none.
+
+ALTER TABLE star.dim_images
+    ADD COLUMN IF NOT EXISTS county_code TEXT NULL,
+    ADD COLUMN IF NOT EXISTS municipality_code TEXT NULL;
+
+CREATE INDEX IF NOT EXISTS dim_images_county_code_idx ON star.dim_images (county_code);
+CREATE INDEX IF NOT EXISTS dim_images_municipality_code_idx ON star.dim_images (municipality_code);
+
+-- Names of the regions the codes refer to, upserted from the same file at each load.
+CREATE TABLE IF NOT EXISTS star.dim_regions (
+    region_code TEXT PRIMARY KEY,
+    level TEXT NOT NULL,
+    name TEXT NULL
+);
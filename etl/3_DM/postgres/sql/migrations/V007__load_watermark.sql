@@ -0,0 +1,17 @@
+-- A counter of the changes the loads make to the star schema. A change made in one transaction (a daemon micro-batch,
+-- a rollup refresh that changed cells) advances it in that transaction; full loads and region backfills commit in
+-- chunks and mark themselves running instead, see V008. Readers such as api.py compare it to know whether anything
+-- they cached can have changed, without looking at the tables themselves.
+
+CREATE TABLE IF NOT EXISTS star.load_watermark (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0,
+    loaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO star.load_watermark (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION star.advance_load_watermark() RETURNS BIGINT
+LANGUAGE sql AS $$
+    UPDATE star.load_watermark SET version = version + 1, loaded_at = NOW() RETURNING version;
+$$;
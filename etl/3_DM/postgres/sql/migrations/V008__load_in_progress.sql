@@ -0,0 +1,17 @@
+-- Full loads and region backfills commit chunk by chunk, so between their start and their end the star schema is
+-- neither the old state nor the new one. star.begin_load() advances the watermark and flags a load as running when
+-- it starts, star.end_load() advances it again and clears the flag once everything is committed. While the flag is
+-- set, readers must not cache results or hand out ETags for them. A load that dies leaves the flag set until it is
+-- resumed and finishes, as its tables stay half loaded until then.
+
+ALTER TABLE star.load_watermark ADD COLUMN IF NOT EXISTS loading BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE OR REPLACE FUNCTION star.begin_load() RETURNS BIGINT
+LANGUAGE sql AS $$
+    UPDATE star.load_watermark SET version = version + 1, loading = TRUE, loaded_at = NOW() RETURNING version;
+$$;
+
+CREATE OR REPLACE FUNCTION star.end_load() RETURNS BIGINT
+LANGUAGE sql AS $$
+    UPDATE star.load_watermark SET version = version + 1, loading = FALSE, loaded_at = NOW() RETURNING version;
+$$;
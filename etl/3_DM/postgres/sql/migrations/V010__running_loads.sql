@@ -0,0 +1,32 @@
+-- The single loading flag of V008 was cleared by whichever load finished first, so a region backfill ending during
+-- a full load (or the other way round) let readers cache a half-loaded star schema. Every running load now has its
+-- own row in star.running_loads, keyed by a load id the load passes to star.begin_load() and star.end_load(), and a
+-- load is running while any row exists. Both functions still advance the watermark. A load that dies keeps its row
+-- until it is run again under the same id and finishes.
+
+CREATE TABLE IF NOT EXISTS star.running_loads (
+    load_id TEXT PRIMARY KEY,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- An interrupted 3_DM run resumes under its run id, which is its load id, so it clears its own row when it finishes.
+INSERT INTO star.running_loads (load_id)
+SELECT run_id FROM star.etl_runs
+WHERE stage = '3_dm' AND status = 'running' AND EXISTS (SELECT 1 FROM star.load_watermark WHERE loading)
+ON CONFLICT (load_id) DO NOTHING;
+
+DROP FUNCTION IF EXISTS star.begin_load();
+DROP FUNCTION IF EXISTS star.end_load();
+ALTER TABLE star.load_watermark DROP COLUMN IF EXISTS loading;
+
+CREATE OR REPLACE FUNCTION star.begin_load(load_id TEXT) RETURNS BIGINT
+LANGUAGE sql AS $$
+    INSERT INTO star.running_loads (load_id) VALUES (begin_load.load_id) ON CONFLICT (load_id) DO NOTHING;
+    UPDATE star.load_watermark SET version = version + 1, loaded_at = NOW() RETURNING version;
+$$;
+
+CREATE OR REPLACE FUNCTION star.end_load(load_id TEXT) RETURNS BIGINT
+LANGUAGE sql AS $$
+    DELETE FROM star.running_loads AS r WHERE r.load_id = end_load.load_id;
+    UPDATE star.load_watermark SET version = version + 1, loaded_at = NOW() RETURNING version;
+$$;
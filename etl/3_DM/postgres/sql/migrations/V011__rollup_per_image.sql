@@ -0,0 +1,9 @@
+-- rollups.py used to aggregate the rollup straight from the fact grain (image x roof prediction x detection), so a
+-- detection was counted once per roof prediction of its image, and an image with several roof classes once per
+-- class. It now reduces the facts to one row per image first. Every cell is queued so the next refresh recomputes
+-- the groups summarised the old way.
+INSERT INTO star.rollup_dirty_cells (date_id, grid_lat, grid_lon)
+SELECT DISTINCT f.date_id, star.grid_cell(i.latitude), star.grid_cell(i.longitude)
+FROM star.fact_images AS f
+JOIN star.dim_images AS i ON i.dim_image_id = f.image_id
+ON CONFLICT DO NOTHING;
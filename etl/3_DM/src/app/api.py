@@ -0,0 +1,168 @@
+import json
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, Response
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.metrics import RunMetrics, render_prometheus
+from reads import REGION_COLUMNS, daily_totals, image_detail, image_page, region_totals, roof_type_totals
+from result_cache import CacheConfig, ResultCache, Watermark, entity_tag
+from spatial import GEOHASH_CHARS, MAX_PAGE_SIZE, BoundingBox, cell_aggregates, images_in_box, images_within
+
+state = {}
+
+# Totals since the service started, exposed on /metrics.
+METRICS = RunMetrics("star_api")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_dotenv()
+    config = CacheConfig.from_env()
+    state["pool"] = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig.from_env("3_dm_api"))
+    state["watermark"] = Watermark(state["pool"], config.watermark_seconds)
+    state["cache"] = ResultCache(config)
+    yield
+    state.pop("pool").close()
+
+
+app = FastAPI(title="Star schema read API", lifespan=lifespan)
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def request_key(request: Request) -> str:
+    """The path and the query parameters in a fixed order, so equivalent URLs share a cache entry and an ETag."""
+    parameters = sorted(request.query_params.multi_items())
+    return f"{request.url.path}?{'&'.join(f'{name}={value}' for name, value in parameters)}"
+
+
+def cached(request: Request, name: str, compute: Callable[[object], object]) -> Response:
+    """Answer from the result cache, or with 304 when the client already holds the current result.
+
+    `compute` gets a pooled connection and returns the JSON value of the response.
+    Results only change when a load advances star.load_watermark, so the ETag is
+    derived from the watermark and the request alone, and a matching If-None-Match
+    is answered without reading the cache or the tables. While a full load or a
+    backfill is running the tables change with every chunk it commits, so results
+    are then computed for each request, without an ETag, and not kept.
+    """
+    version, loading = state["watermark"].current()
+
+    def query() -> bytes:
+        with METRICS.span(f"query.{name}") as span, state["pool"].connection() as connection:
+            body = json.dumps(compute(connection), default=json_default).encode("utf-8")
+            span.add(1, len(body))
+        return body
+
+    if loading:
+        return Response(query(), media_type="application/json",
+                        headers={"Cache-Control": "no-store", "X-Cache": "bypass"})
+
+    key = request_key(request)
+    etag = entity_tag(version, key)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        with METRICS.span("not_modified") as span:
+            span.add(1)
+        return Response(status_code=304, headers=headers)
+
+    body, hit = state["cache"].get_or_compute(version, key, query)
+    if hit:
+        with METRICS.span("cache_hit") as span:
+            span.add(1, len(body))
+    headers["X-Cache"] = "hit" if hit else "miss"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def page_value(page) -> dict:
+    return {"rows": page.rows, "next_after": page.next_after}
+
+
+def optional_box(min_lat, min_lon, max_lat, max_lon) -> Optional[BoundingBox]:
+    values = (min_lat, min_lon, max_lat, max_lon)
+    if all(value is None for value in values):
+        return None
+    if any(value is None for value in values):
+        raise HTTPException(status_code=422, detail="Give all of min_lat, min_lon, max_lat and max_lon, or none.")
+    return BoundingBox(*values)
+
+
+# Handlers are plain functions so FastAPI runs the blocking queries in its thread pool.
+@app.get("/images")
+def read_images(request: Request, county: Optional[str] = None, municipality: Optional[str] = None,
+                after: Optional[int] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    return cached(request, "images", lambda connection: page_value(
+        image_page(connection, county=county, municipality=municipality, after=after, limit=limit)))
+
+
+@app.get("/images/{image_id}")
+def read_image(request: Request, image_id: int):
+    def compute(connection):
+        image = image_detail(connection, image_id)
+        if image is None:
+            raise HTTPException(status_code=404, detail=f"Image {image_id} is not in the star schema.")
+        return image
+    return cached(request, "image", compute)
+
+
+@app.get("/aggregates/roof-types")
+def read_roof_types(request: Request, start: date = date.min, end: date = date.max):
+    return cached(request, "roof_types", lambda connection: roof_type_totals(connection, start, end))
+
+
+@app.get("/aggregates/daily")
+def read_daily(request: Request, start: date = date.min, end: date = date.max, after: Optional[date] = None,
+               limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    return cached(request, "daily", lambda connection: page_value(
+        daily_totals(connection, start, end, after=after, limit=limit)))
+
+
+@app.get("/aggregates/regions/{level}")
+def read_regions(request: Request, level: str, after: Optional[str] = None,
+                 limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    if level not in REGION_COLUMNS:
+        raise HTTPException(status_code=404, detail=f"Unknown region level: {level}")
+    return cached(request, "regions", lambda connection: page_value(
+        region_totals(connection, level, after=after, limit=limit)))
+
+
+@app.get("/spatial/box")
+def read_box(request: Request, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+             after: Optional[int] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    box = BoundingBox(min_lat, min_lon, max_lat, max_lon)
+    return cached(request, "box", lambda connection: page_value(
+        images_in_box(connection, box, after=after, limit=limit)))
+
+
+@app.get("/spatial/radius")
+def read_radius(request: Request, lat: float, lon: float, km: float = Query(..., gt=0),
+                after: Optional[int] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    return cached(request, "radius", lambda connection: page_value(
+        images_within(connection, lat, lon, km, after=after, limit=limit)))
+
+
+@app.get("/spatial/cells")
+def read_cells(request: Request, chars: int = Query(5, ge=1, le=GEOHASH_CHARS), min_lat: Optional[float] = None,
+               min_lon: Optional[float] = None, max_lat: Optional[float] = None, max_lon: Optional[float] = None,
+               after: Optional[str] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    box = optional_box(min_lat, min_lon, max_lat, max_lon)
+    return cached(request, "cells", lambda connection: page_value(
+        cell_aggregates(connection, chars, box=box, after=after, limit=limit)))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_prometheus([METRICS]), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,161 @@
+import argparse
+import logging
+import os
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional
+
+import psycopg2.extras
+from dotenv import load_dotenv
+from PIL import Image
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.streaming import itersize_from_env
+
+
+@dataclass
+class BlobSource:
+    """A star dimension whose rows reference a blob by hash, and the history table the blob is read from."""
+    dimension: str
+    key: str
+    history_table: str
+
+
+BLOB_SOURCES = [
+    BlobSource("dim_images", "image_id", "images"),
+    BlobSource("dim_detections_solar_panel", "detection_id", "detection_solar_panel"),
+]
+
+
+def thumbnail_size() -> int:
+    """Longest side in pixels of the dashboard thumbnails, configurable with STAR_THUMBNAIL_SIZE."""
+    return int(os.getenv("STAR_THUMBNAIL_SIZE", 256))
+
+
+def make_thumbnail(data: bytes, size: int) -> Optional[bytes]:
+    """Downscale an image to a JPEG of at most size x size pixels; None if the blob is not a readable image."""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.thumbnail((size, size))
+            output = BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=80)
+            return output.getvalue()
+    except Exception as e:
+        logging.warning(f"Could not create a thumbnail: {e}")
+        return None
+
+
+def store_missing_blobs(history_cursor, star_cursor, source: BlobSource, candidates: Dict[str, int]) -> int:
+    """Copy the blobs of `candidates` (sha256 -> business key) that star.image_blobs does not hold yet.
+
+    Blobs are content addressed, so an unchanged image or overlay is never read
+    from history again. Returns the number of blobs stored.
+    """
+    if not candidates:
+        return 0
+    star_cursor.execute("SELECT sha256 FROM star.image_blobs WHERE sha256 = ANY(%s);", (list(candidates),))
+    stored = {row[0] for row in star_cursor.fetchall()}
+    missing = {digest: key for digest, key in candidates.items() if digest not in stored}
+    if not missing:
+        return 0
+
+    history_cursor.execute(f"""
+        SELECT image_data_sha256, image_data FROM history.{source.history_table}
+        WHERE {source.key} = ANY(%s) AND valid_to IS NULL;
+    """, (list(missing.values()),))
+    size = thumbnail_size()
+    blobs = [(digest, data, len(data), make_thumbnail(bytes(data), size))
+             for digest, data in history_cursor.fetchall() if digest in missing]
+    psycopg2.extras.execute_batch(star_cursor, """
+        INSERT INTO star.image_blobs (sha256, image_data, byte_size, thumbnail)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (sha256) DO NOTHING;
+    """, blobs)
+    return len(blobs)
+
+
+def load_missing_blobs(history_conn, star_conn) -> int:
+    """Store the blob of every dimension row whose hash is not in star.image_blobs, one chunk at a time."""
+    chunk_size = itersize_from_env()
+    loaded = 0
+    with history_conn.cursor() as history_cursor, star_conn.cursor() as star_cursor:
+        for source in BLOB_SOURCES:
+            last_key = -1
+            while True:
+                star_cursor.execute(f"""
+                    SELECT d.{source.key}, d.image_data_sha256
+                    FROM star.{source.dimension} AS d
+                    WHERE d.{source.key} > %s
+                      AND d.image_data_sha256 IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM star.image_blobs AS b WHERE b.sha256 = d.image_data_sha256)
+                    ORDER BY d.{source.key}
+                    LIMIT %s;
+                """, (last_key, chunk_size))
+                rows = star_cursor.fetchall()
+                if not rows:
+                    break
+                loaded += store_missing_blobs(history_cursor, star_cursor, source,
+                                              {digest: key for key, digest in rows})
+                star_conn.commit()
+                last_key = rows[-1][0]
+    history_conn.rollback()
+    if loaded:
+        logging.info(f"Stored {loaded} new blobs in star.image_blobs.")
+    return loaded
+
+
+def remove_unreferenced_blobs(star_cursor) -> int:
+    """Delete the blobs no dimension row points to any more; returns the number removed."""
+    references = " AND ".join(
+        f"NOT EXISTS (SELECT 1 FROM star.{source.dimension} AS d WHERE d.image_data_sha256 = b.sha256)"
+        for source in BLOB_SOURCES)
+    star_cursor.execute(f"DELETE FROM star.image_blobs AS b WHERE {references};")
+    return star_cursor.rowcount
+
+
+def create_missing_thumbnails(star_conn) -> int:
+    """Generate the thumbnails of blobs stored without one, e.g. those moved over by the side table migration."""
+    chunk_size = itersize_from_env()
+    size = thumbnail_size()
+    created = 0
+    last_digest = ""
+    with star_conn.cursor() as cursor:
+        while True:
+            cursor.execute("""
+                SELECT sha256, image_data FROM star.image_blobs
+                WHERE thumbnail IS NULL AND sha256 > %s
+                ORDER BY sha256
+                LIMIT %s;
+            """, (last_digest, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            thumbnails = [(make_thumbnail(bytes(data), size), digest) for digest, data in rows]
+            thumbnails = [(thumbnail, digest) for thumbnail, digest in thumbnails if thumbnail is not None]
+            psycopg2.extras.execute_batch(cursor, "UPDATE star.image_blobs SET thumbnail = %s WHERE sha256 = %s;",
+                                          thumbnails)
+            star_conn.commit()
+            created += len(thumbnails)
+            last_digest = rows[-1][0]
+    logging.info(f"Created {created} thumbnails.")
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain star.image_blobs.")
+    parser.add_argument("command", choices=["thumbnails"], help="create the thumbnails blobs are missing")
+    parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="3_dm_blobs"))
+    try:
+        with pool.connection() as star_conn:
+            create_missing_thumbnails(star_conn)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.streaming import iter_chunks
+
+MANIFEST_FILE = "_manifest.json"
+BLOB_FOLDER = "blobs"
+CONFIDENCE = pa.decimal128(10, 5)
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+
+@dataclass
+class ExportTable:
+    name: str
+    key: str
+    columns: pa.Schema
+    # Column holding the sha256 of a star.image_blobs row; the blob is written to the blob folder.
+    blob_hash_column: Optional[str] = None
+
+
+FACT_TABLE = ExportTable("fact_images", "fact_id", pa.schema([
+    ("fact_id", pa.int64()),
+    ("image_id", pa.int64()),
+    ("dim_roof_type_id", pa.int64()),
+    ("dim_solar_panel_id", pa.int64()),
+    ("date_id", pa.int32()),
+    ("image_date_uploaded", TIMESTAMP),
+]))
+
+DIMENSION_TABLES = [
+    ExportTable("dim_images", "dim_image_id", pa.schema([
+        ("dim_image_id", pa.int64()),
+        ("image_id", pa.int64()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("filename", pa.string()),
+        ("latitude", CONFIDENCE),
+        ("longitude", CONFIDENCE),
+        ("geohash", pa.string()),
+        ("image_data_sha256", pa.string()),
+        ("county_code", pa.string()),
+        ("municipality_code", pa.string()),
+    ]), blob_hash_column="image_data_sha256"),
+    ExportTable("dim_predictions_roof_type", "dim_roof_type_id", pa.schema([
+        ("dim_roof_type_id", pa.int64()),
+        ("prediction_id", pa.int64()),
+        ("class_name", pa.string()),
+        ("time_taken", CONFIDENCE),
+        ("confidence", CONFIDENCE),
+        ("prediction_type", pa.string()),
+        ("date_processed", TIMESTAMP),
+    ])),
+    ExportTable("dim_detections_solar_panel", "dim_solar_panel_id", pa.schema([
+        ("dim_solar_panel_id", pa.int64()),
+        ("detection_id", pa.int64()),
+        ("class_name", pa.string()),
+        ("confidence", CONFIDENCE),
+        ("x", pa.int32()),
+        ("y", pa.int32()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("image_data_sha256", pa.string()),
+        ("date_processed", TIMESTAMP),
+    ]), blob_hash_column="image_data_sha256"),
+    ExportTable("dim_regions", "region_code", pa.schema([
+        ("region_code", pa.string()),
+        ("level", pa.string()),
+        ("name", pa.string()),
+    ])),
+    ExportTable("dim_date", "date_id", pa.schema([
+        ("date_id", pa.int32()),
+        ("date", pa.date32()),
+        ("year", pa.int32()),
+        ("month", pa.int32()),
+        ("day", pa.int32()),
+        ("week", pa.int32()),
+        ("quarter", pa.int32()),
+    ])),
+]
+
+# Fingerprint of the facts of each month; a partition whose fingerprint is unchanged is not written again.
+# date_loaded is left out on purpose, every load bumps it without changing the fact.
+PARTITION_SIGNATURES = """
+    SELECT d.year, d.month, COUNT(*),
+           md5(string_agg(concat_ws('|', f.fact_id, f.image_id, f.dim_roof_type_id, f.dim_solar_panel_id,
+                                    f.date_id, f.image_date_uploaded), ',' ORDER BY f.fact_id))
+    FROM star.fact_images AS f
+    JOIN star.dim_date AS d ON d.date_id = f.date_id
+    GROUP BY d.year, d.month
+    ORDER BY d.year, d.month;
+    """
+
+
+@dataclass
+class ExportResult:
+    written_partitions: List[str] = field(default_factory=list)
+    skipped_partitions: int = 0
+    removed_partitions: List[str] = field(default_factory=list)
+    blobs_written: int = 0
+
+
+def blob_path(output: str, digest: str) -> str:
+    return os.path.join(output, BLOB_FOLDER, digest[:2], digest)
+
+
+def write_missing_blobs(connection, output: str, table: ExportTable, rows: list) -> int:
+    """Fetch and store the blobs of `rows` that are not on disk yet; blobs are named by their sha256."""
+    hash_index = table.columns.names.index(table.blob_hash_column)
+    missing = {row[hash_index] for row in rows
+               if row[hash_index] is not None and not os.path.exists(blob_path(output, row[hash_index]))}
+    if not missing:
+        return 0
+
+    # A named cursor is streaming the rows, so the blobs come through a second, ordinary cursor.
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sha256, image_data FROM star.image_blobs WHERE sha256 = ANY(%s);", (list(missing),))
+        for digest, data in cursor:
+            path = blob_path(output, digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", "wb") as blob:
+                blob.write(bytes(data))
+            os.replace(f"{path}.tmp", path)
+    return len(missing)
+
+
+def write_parquet(connection, path: str, table: ExportTable, query: str, params=None,
+                  output: Optional[str] = None) -> Tuple[int, int]:
+    """Stream a query into one Parquet file, one record batch per fetched chunk.
+
+    Returns the number of rows and of new blobs written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows_written = 0
+    blobs = 0
+    with pq.ParquetWriter(f"{path}.tmp", table.columns, compression="zstd") as writer:
+        for rows in iter_chunks(connection, query, params):
+            if table.blob_hash_column:
+                blobs += write_missing_blobs(connection, output, table, rows)
+            columns = list(zip(*rows))
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=column.type) for values, column in zip(columns, table.columns)],
+                schema=table.columns))
+            rows_written += len(rows)
+        if not rows_written:
+            writer.write_table(table.columns.empty_table())
+    os.replace(f"{path}.tmp", path)
+    connection.rollback()
+    return rows_written, blobs
+
+
+def partition_folder(year: int, month: int) -> str:
+    return os.path.join(FACT_TABLE.name, f"year={year}", f"month={month:02d}")
+
+
+def read_manifest(output: str) -> Dict[str, str]:
+    path = os.path.join(output, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as manifest:
+        return json.load(manifest)
+
+
+def write_manifest(output: str, manifest: Dict[str, str]):
+    path = os.path.join(output, MANIFEST_FILE)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_facts(connection, output: str, full: bool = False) -> ExportResult:
+    """Write the facts as one Parquet file per dim_date year/month, skipping months that did not change."""
+    result = ExportResult()
+    manifest = read_manifest(output)
+    with connection.cursor() as cursor:
+        cursor.execute(PARTITION_SIGNATURES)
+        signatures = {partition_folder(year, month): (year, month, f"{count}:{digest}")
+                      for year, month, count, digest in cursor.fetchall()}
+    connection.rollback()
+
+    query = (f"SELECT {', '.join(FACT_TABLE.columns.names)} FROM star.fact_images "
+             f"WHERE date_id BETWEEN %s AND %s ORDER BY fact_id;")
+    for folder, (year, month, signature) in signatures.items():
+        if not full and manifest.get(folder) == signature:
+            result.skipped_partitions += 1
+            continue
+        # date_id is YYYYMMDD, so a month is a date_id range.
+        params = (year * 10000 + month * 100, year * 10000 + month * 100 + 99)
+        rows, _ = write_parquet(connection, os.path.join(output, folder, "part-0.parquet"), FACT_TABLE, query,
+                                params)
+        manifest[folder] = signature
+        write_manifest(output, manifest)
+        result.written_partitions.append(folder)
+        logging.info(f"Exported {rows} facts to {folder}.")
+
+    # Months whose facts are all gone in the star schema disappear from the export as well.
+    for folder in sorted(set(manifest) - set(signatures)):
+        path = os.path.join(output, folder, "part-0.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+            try:
+                # Prunes the empty month folder and a year folder left empty with it.
+                os.removedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        del manifest[folder]
+        write_manifest(output, manifest)
+        result.removed_partitions.append(folder)
+        logging.info(f"Removed {folder}, its facts are no longer in the star schema.")
+    return result
+
+
+def export_dimensions(connection, output: str) -> int:
+    """Rewrite the dimension snapshots and store their new blobs; returns the number of blobs written."""
+    blobs = 0
+    for table in DIMENSION_TABLES:
+        query = f"SELECT {', '.join(table.columns.names)} FROM star.{table.name} ORDER BY {table.key};"
+        rows, new_blobs = write_parquet(connection, os.path.join(output, f"{table.name}.parquet"), table, query,
+                                        output=output)
+        blobs += new_blobs
+        logging.info(f"Exported {rows} rows of star.{table.name} ({new_blobs} new blobs).")
+    return blobs
+
+
+def export_star(connection, output: str, full: bool = False) -> ExportResult:
+    """Export the star schema to `output`: dimension snapshots, blobs by hash and month-partitioned facts."""
+    os.makedirs(output, exist_ok=True)
+    blobs = export_dimensions(connection, output)
+    result = export_facts(connection, output, full=full)
+    result.blobs_written = blobs
+    logging.info(f"Parquet export to {output} completed: {len(result.written_partitions)} fact partitions written, "
+                 f"{result.skipped_partitions} unchanged, {len(result.removed_partitions)} removed, "
+                 f"{blobs} new blobs.")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the star schema to partitioned Parquet files.")
+    parser.add_argument("--output", default=os.getenv("STAR_EXPORT_FOLDER", "export"),
+                        help="export folder (default: STAR_EXPORT_FOLDER or ./export)")
+    parser.add_argument("--full", action="store_true", help="rewrite every fact partition, changed or not")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="3_dm_export"))
+    try:
+        with pool.connection() as connection:
+            export_star(connection, args.output, full=args.full)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
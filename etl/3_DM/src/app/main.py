@@ -1,41 +1,28 @@
 import os
-import psycopg2
+import sys
 from psycopg2 import sql
 import psycopg2.extras
 import logging
-from dataclasses import dataclass
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
+from common.checkpoints import RunCheckpoints
+from common.db import ConnectionPool, PoolConfig, PostgresConfig, run_with_reconnect
+from common.logging_config import configure_logging
+from common.memory import track_peak_rss
+from common.migrations import apply_migrations, resolve_migrations_dir
+from common.profiling import configure_profiling, profiled
+from blobs import BLOB_SOURCES, load_missing_blobs, remove_unreferenced_blobs, store_missing_blobs
+from common.streaming import iter_chunks
+from regions import store_regions, with_regions
+from rollups import refresh_rollups
 
-@dataclass
-class PostgresConfig:
-    dbname: str
-    user: str
-    password: str
-    host: str
-    port: int
 
-    def __post_init__(self):
-        missing_fields = [
-            field for field in ["dbname", "user", "password", "host", "port"]
-            if getattr(self, field) is None
-        ]
-        if missing_fields:
-            raise ValueError(f"Missing required database configuration fields: {', '.join(missing_fields)}")
+LOG_FOLDER = os.path.join(os.path.dirname(__file__), 'logs')
 
 
 def setup_logging():
-    log_folder = os.path.join(os.path.dirname(__file__), 'logs')
-    os.makedirs(log_folder, exist_ok=True)
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(os.path.join(log_folder, 'app.log'))
-        ]
-    )
+    return configure_logging("3_dm", LOG_FOLDER)
 
 
 def get_date_id(tz_timestamp, cursor):
@@ -56,18 +43,12 @@ def get_date_id(tz_timestamp, cursor):
         return None
 
 
-def connect_to_db(config: PostgresConfig):
+def create_pool(config: PostgresConfig) -> ConnectionPool:
     try:
         logging.info(f"Connecting to {config.dbname} database at {config.host}...")
-        conn = psycopg2.connect(
-            dbname=config.dbname,
-            user=config.user,
-            password=config.password,
-            host=config.host,
-            port=config.port
-        )
+        pool = ConnectionPool(config, PoolConfig.from_env("3_dm"))
         logging.info(f"Connected to {config.dbname} database successfully.")
-        return conn
+        return pool
     except Exception as e:
         logging.error(f"Failed to connect to {config.dbname} database: {e}")
         raise
@@ -120,109 +101,161 @@ def get_primary_key_by_field(cursor, schema_name, table_name, primary_key_column
     return result[0] if result else None
 
 
-def transfer_images_and_coordinates(history_cursor, star_cursor):
+DIM_IMAGES_UPSERT = """
+    INSERT INTO star.dim_images (image_id, width, height, filename, latitude, longitude, image_data_sha256,
+                                 county_code, municipality_code)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (image_id) DO UPDATE
+    SET width = EXCLUDED.width, height = EXCLUDED.height, filename = EXCLUDED.filename,
+        latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+        image_data_sha256 = EXCLUDED.image_data_sha256, county_code = EXCLUDED.county_code,
+        municipality_code = EXCLUDED.municipality_code, date_loaded = NOW();
+    """
+
+DIM_PREDICTIONS_UPSERT = """
+    INSERT INTO star.dim_predictions_roof_type 
+    (prediction_id, class_name, time_taken, confidence, prediction_type, date_processed) 
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (prediction_id) DO UPDATE
+    SET class_name = EXCLUDED.class_name, time_taken = EXCLUDED.time_taken, confidence = EXCLUDED.confidence,
+        prediction_type = EXCLUDED.prediction_type, date_processed = EXCLUDED.date_processed,
+        date_loaded = NOW();
+    """
+
+DIM_DETECTIONS_UPSERT = """
+    INSERT INTO star.dim_detections_solar_panel (detection_id, class_name, confidence, x, y, width, height, image_data_sha256, date_processed) 
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (detection_id) DO UPDATE
+    SET class_name = EXCLUDED.class_name, confidence = EXCLUDED.confidence, x = EXCLUDED.x, y = EXCLUDED.y,
+        width = EXCLUDED.width, height = EXCLUDED.height, image_data_sha256 = EXCLUDED.image_data_sha256,
+        date_processed = EXCLUDED.date_processed, date_loaded = NOW();
+    """
+
+FACT_UPSERT = """
+    INSERT INTO star.fact_images (
+        image_id,
+        dim_roof_type_id,
+        dim_solar_panel_id,
+        date_id,
+        image_date_uploaded
+    ) VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT ON CONSTRAINT fact_images_grain_key DO UPDATE
+    SET date_id = EXCLUDED.date_id,
+        image_date_uploaded = EXCLUDED.image_date_uploaded,
+        date_loaded = NOW();
+    """
+
+# Current versions selected by the full load (keyset on the first column) and by the per-image refresh.
+# Blobs are referenced by hash here and copied to star.image_blobs by blobs.py, only when they are new.
+DIM_IMAGES_SELECT = """
+    SELECT i.image_id, i.width, i.height, i.filename, c.latitude, c.longitude, i.image_data_sha256
+    FROM history.images AS i
+    JOIN history.coordinates AS c ON i.image_id = c.image_id
+    WHERE i.valid_to IS NULL AND c.valid_to IS NULL AND {condition}
+    ORDER BY i.image_id;
+    """
+
+DIM_PREDICTIONS_SELECT = """
+    SELECT prediction_id, class_name, time_taken, confidence, prediction_type, date_processed 
+    FROM history.predictions_roof_type
+    WHERE valid_to IS NULL AND {condition}
+    ORDER BY prediction_id;
+    """
+
+DIM_DETECTIONS_SELECT = """
+    SELECT detection_id, class_name, confidence, x, y, width, height, image_data_sha256, date_processed 
+    FROM history.detection_solar_panel
+    WHERE valid_to IS NULL AND {condition}
+    ORDER BY detection_id;
+    """
+
+FACT_SELECT = """
+    SELECT
+        i.image_id,
+        i.date_uploaded,
+        pr.prediction_id,
+        dsp.detection_id
+    FROM
+        history.images AS i
+    LEFT JOIN
+        history.predictions_roof_type AS pr
+        ON i.image_id = pr.image_id
+        AND pr.valid_to IS NULL
+    LEFT JOIN
+        history.detection_solar_panel AS dsp
+        ON i.image_id = dsp.image_id
+        AND dsp.valid_to IS NULL
+    WHERE
+        i.valid_to IS NULL
+        AND {condition}
+    ORDER BY
+        i.image_id;
+    """
+
+
+def with_image_regions(rows: list) -> list:
+    """Append the county and municipality codes to DIM_IMAGES_SELECT rows, for DIM_IMAGES_UPSERT."""
+    return with_regions(rows, latitude_column=4, longitude_column=5)
+
+
+def load_in_chunks(history_conn, star_cursor, checkpoints: RunCheckpoints, table: str, query: str, insert_sql: str,
+                   prepare_rows=None):
+    """Upsert the rows of a key-ordered query into the star schema, committing each chunk with its checkpoint.
+
+    The query must return the business key first and take the last checkpointed key as its only parameter.
+    `prepare_rows`, if given, turns each fetched chunk into the parameters of `insert_sql` (timed as enrich.<table>).
+    """
+    last_key, transferred, completed = checkpoints.table_state(table)
+    if completed:
+        logging.info(f"Table star.{table} already loaded in this run ({transferred} rows).")
+        return
+
+    metrics = checkpoints.metrics
+    for rows in metrics.timed_chunks(f"extract.{table}", iter_chunks(history_conn, query, (last_key,))):
+        if prepare_rows is not None:
+            with metrics.span(f"enrich.{table}") as span:
+                rows = prepare_rows(rows)
+                span.add(len(rows))
+        with metrics.span(f"dim_load.{table}") as span:
+            psycopg2.extras.execute_batch(star_cursor, insert_sql, rows)
+            transferred += len(rows)
+            last_key = rows[-1][0]
+            checkpoints.save(table, last_key, transferred)
+            star_cursor.connection.commit()
+            span.add_rows(rows)
+
+    checkpoints.save(table, last_key, transferred, completed=True)
+    star_cursor.connection.commit()
+    logging.info(f"Data transfer to star.{table} completed ({transferred} rows).")
+
+
+def transfer_images_and_coordinates(history_cursor, star_cursor, checkpoints: RunCheckpoints):
     """Transfer data from history.images and history.coordinates to star.dim_images."""
     logging.info("Transferring data to star.dim_images...")
+    query = DIM_IMAGES_SELECT.format(condition="i.image_id > %s")
+    store_regions(star_cursor)
+    load_in_chunks(history_cursor.connection, star_cursor, checkpoints, "dim_images", query, DIM_IMAGES_UPSERT,
+                   prepare_rows=with_image_regions)
 
-    # Select image data along with latitude and longitude where valid_to is NULL in both tables
-    history_cursor.execute(
-        """
-        SELECT i.image_id, i.width, i.height, i.filename, c.latitude, c.longitude, i.image_data
-        FROM history.images AS i
-        JOIN history.coordinates AS c ON i.image_id = c.image_id
-        WHERE i.valid_to IS NULL AND c.valid_to IS NULL;
-        """
-    )
-    images = history_cursor.fetchall()
-
-    # Insert into star.dim_images with latitude and longitude
-    for image in images:
-        star_cursor.execute(
-            """
-            INSERT INTO star.dim_images (image_id, width, height, filename, latitude, longitude, image_data)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (image_id) DO NOTHING;
-            """,
-            image
-        )
-    logging.info("Data transfer to star.dim_images completed.")
-
-
-def transfer_predictions(history_cursor, star_cursor):
+
+def transfer_predictions(history_cursor, star_cursor, checkpoints: RunCheckpoints):
     """Transfer data from history.predictions_roof_type to star.dim_predictions_roof_type."""
     logging.info("Transferring data to star.dim_predictions_roof_type...")
+    query = DIM_PREDICTIONS_SELECT.format(condition="prediction_id > %s")
+    load_in_chunks(history_cursor.connection, star_cursor, checkpoints, "dim_predictions_roof_type", query,
+                   DIM_PREDICTIONS_UPSERT)
+
 
-    history_cursor.execute(
-        """
-        SELECT prediction_id, class_name, time_taken, confidence, prediction_type, date_processed 
-        FROM history.predictions_roof_type
-        WHERE valid_to IS NULL;
-        """
-    )
-    predictions = history_cursor.fetchall()
-
-    for pred in predictions:
-        star_cursor.execute(
-            """
-            INSERT INTO star.dim_predictions_roof_type 
-            (prediction_id, class_name, time_taken, confidence, prediction_type, date_processed) 
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (prediction_id) DO NOTHING;
-            """,
-            pred
-        )
-    logging.info("Data transfer to star.dim_predictions_roof_type completed.")
-
-
-def transfer_detections(history_cursor, star_cursor):
+def transfer_detections(history_cursor, star_cursor, checkpoints: RunCheckpoints):
     """Transfer data from history.detection_solar_panel to star.dim_detections_solar_panel."""
     logging.info("Transferring data to star.dim_detections_solar_panel...")
+    query = DIM_DETECTIONS_SELECT.format(condition="detection_id > %s")
+    load_in_chunks(history_cursor.connection, star_cursor, checkpoints, "dim_detections_solar_panel", query,
+                   DIM_DETECTIONS_UPSERT)
 
-    history_cursor.execute(
-        """
-        SELECT detection_id, class_name, confidence, x, y, width, height, image_data, date_processed 
-        FROM history.detection_solar_panel
-        WHERE valid_to IS NULL;
-        """
-    )
-    detections = history_cursor.fetchall()
-
-    for detection in detections:
-        star_cursor.execute(
-            """
-            INSERT INTO star.dim_detections_solar_panel (detection_id, class_name, confidence, x, y, width, height, image_data, date_processed) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (detection_id) DO NOTHING;
-            """,
-            detection
-        )
-    logging.info("Data transfer to star.dim_detections_solar_panel completed.")
-
-
-def populate_fact_table(history_cursor, star_cursor):
-    logging.info("Transferring data to star.dim_images...")
-    history_cursor.execute(
-        """
-            SELECT
-                i.image_id,
-                i.date_uploaded,
-                pr.prediction_id,
-                dsp.detection_id
-            FROM
-                history.images AS i
-            LEFT JOIN
-                history.predictions_roof_type AS pr
-                ON i.image_id = pr.image_id
-                AND pr.valid_to IS NULL
-            LEFT JOIN
-                history.detection_solar_panel AS dsp
-                ON i.image_id = dsp.image_id
-                AND dsp.valid_to IS NULL
-            WHERE
-                i.valid_to IS NULL;
-        """)
-    images = history_cursor.fetchall()
 
+def upsert_facts(star_cursor, images):
+    """Resolve the dimension keys of (image_id, date_uploaded, prediction_id, detection_id) rows and upsert the facts."""
     for image in images:
         image_id = get_primary_key_by_field(
             star_cursor,
@@ -231,6 +264,10 @@ def populate_fact_table(history_cursor, star_cursor):
             primary_key_column='dim_image_id',
             field_name='image_id',
             field_value=image[0])
+        if image_id is None:
+            # Not in dim_images yet, e.g. its coordinates have not arrived; a later load picks it up.
+            logging.warning(f"Skipping facts of image_id {image[0]}: it is not in star.dim_images.")
+            continue
         dim_roof_type_id = get_primary_key_by_field(
             star_cursor,
             schema_name='star',
@@ -249,19 +286,7 @@ def populate_fact_table(history_cursor, star_cursor):
         image_upload_date = image[1]
         date_id = get_date_id(image_upload_date, star_cursor)
 
-        # Prepare the SQL insert statement
-        insert_sql = """
-            INSERT INTO star.fact_images (
-                image_id,
-                dim_roof_type_id,
-                dim_solar_panel_id,
-                date_id,
-                image_date_uploaded
-            ) VALUES (%s, %s, %s, %s, %s);
-            """
-
-        # Execute the insert statement using a cursor
-        star_cursor.execute(insert_sql, (
+        star_cursor.execute(FACT_UPSERT, (
             image_id,
             dim_roof_type_id,
             dim_solar_panel_id,
@@ -269,89 +294,169 @@ def populate_fact_table(history_cursor, star_cursor):
             image_upload_date
         ))
 
-    logging.info("Transferring data to star.fact_images...")
-
 
-def transfer_data(history_conn, star_conn):
+@profiled("star.populate_fact_table")
+def populate_fact_table(history_cursor, star_cursor, checkpoints: RunCheckpoints):
+    logging.info("Transferring data to star.fact_images...")
+    last_key, transferred, completed = checkpoints.table_state("fact_images")
+    if completed:
+        logging.info(f"Table star.fact_images already loaded in this run ({transferred} rows).")
+        return
+
+    # An image can span two chunks, so a resumed load starts again at the last checkpointed image;
+    # the upsert makes repeating its rows harmless.
+    query = FACT_SELECT.format(condition="i.image_id >= %s")
+    metrics = checkpoints.metrics
+    for images in metrics.timed_chunks("extract.fact_images", iter_chunks(history_cursor.connection, query,
+                                                                          (last_key,))):
+        with metrics.span("fact_build") as span:
+            upsert_facts(star_cursor, images)
+            transferred += len(images)
+            last_key = images[-1][0]
+            checkpoints.save("fact_images", last_key, transferred)
+            star_cursor.connection.commit()
+            span.add_rows(images)
+
+    checkpoints.save("fact_images", last_key, transferred, completed=True)
+    star_cursor.connection.commit()
+    logging.info(f"Data transfer to star.fact_images completed ({transferred} rows).")
+
+
+def refresh_images(history_conn, star_conn, image_ids: list) -> int:
+    """Bring the star rows of the given images up to date with history in one transaction.
+
+    Used for micro-batches: only the listed images are read and written, and their
+    facts that no longer match a current prediction or detection are removed.
+    Returns the number of fact rows written.
+    """
+    if not image_ids:
+        return 0
+    params = (list(image_ids),)
+    with history_conn.cursor() as history_cursor, star_conn.cursor() as star_cursor:
+        # The blob source and the position of the blob hash in the selected rows, for the dims that have one.
+        for select_sql, upsert_sql, condition, blob_source, hash_index in (
+                (DIM_IMAGES_SELECT, DIM_IMAGES_UPSERT, "i.image_id = ANY(%s)", BLOB_SOURCES[0], 6),
+                (DIM_PREDICTIONS_SELECT, DIM_PREDICTIONS_UPSERT, "image_id = ANY(%s)", None, None),
+                (DIM_DETECTIONS_SELECT, DIM_DETECTIONS_UPSERT, "image_id = ANY(%s)", BLOB_SOURCES[1], 7)):
+            history_cursor.execute(select_sql.format(condition=condition), params)
+            rows = history_cursor.fetchall()
+            if upsert_sql is DIM_IMAGES_UPSERT:
+                rows = with_image_regions(rows)
+            psycopg2.extras.execute_batch(star_cursor, upsert_sql, rows)
+            if blob_source:
+                store_missing_blobs(history_cursor, star_cursor, blob_source,
+                                    {row[hash_index]: row[0] for row in rows if row[hash_index] is not None})
+
+        history_cursor.execute(FACT_SELECT.format(condition="i.image_id = ANY(%s)"), params)
+        facts = history_cursor.fetchall()
+        upsert_facts(star_cursor, facts)
+
+        # Upserted facts carry this transaction's NOW(); older ones of the same images are outdated.
+        star_cursor.execute("""
+            DELETE FROM star.fact_images AS f
+            USING star.dim_images AS d
+            WHERE f.image_id = d.dim_image_id AND d.image_id = ANY(%s) AND f.date_loaded < NOW();
+        """, params)
+        star_cursor.execute("SELECT star.advance_load_watermark();")
+    history_conn.rollback()
+    star_conn.commit()
+    return len(facts)
+
+
+def remove_stale_rows(star_cursor, checkpoints: RunCheckpoints):
+    """Delete facts and dimension rows that the current run did not refresh, i.e. no longer current in history."""
+    if checkpoints.table_state("stale_rows")[2]:
+        return
+
+    started_at = checkpoints.started_at
+    star_cursor.execute("DELETE FROM star.fact_images WHERE date_loaded < %s;", (started_at,))
+    removed = star_cursor.rowcount
+    for table, key in (("dim_images", "dim_image_id"),
+                       ("dim_predictions_roof_type", "dim_roof_type_id"),
+                       ("dim_detections_solar_panel", "dim_solar_panel_id")):
+        fact_column = "image_id" if table == "dim_images" else key
+        star_cursor.execute(f"""
+            DELETE FROM star.{table} AS d
+            WHERE d.date_loaded < %s
+              AND NOT EXISTS (SELECT 1 FROM star.fact_images AS f WHERE f.{fact_column} = d.{key});
+        """, (started_at,))
+        removed += star_cursor.rowcount
+    removed += remove_unreferenced_blobs(star_cursor)
+
+    checkpoints.save("stale_rows", 0, removed, completed=True)
+    star_cursor.connection.commit()
+    logging.info(f"Removed {removed} star rows that are no longer current in history.")
+
+
+def transfer_data(history_conn, star_conn, checkpoints: RunCheckpoints):
     with history_conn.cursor() as history_cursor, star_conn.cursor() as star_cursor:
         logging.info("Transferring data to star.dim_images...")
 
-        transfer_images_and_coordinates(history_cursor, star_cursor)
-        transfer_predictions(history_cursor, star_cursor)
-        transfer_detections(history_cursor, star_cursor)
-        star_conn.commit()
+        with track_peak_rss("star.dim_images"):
+            transfer_images_and_coordinates(history_cursor, star_cursor, checkpoints)
+        with track_peak_rss("star.dim_predictions_roof_type"):
+            transfer_predictions(history_cursor, star_cursor, checkpoints)
+        with track_peak_rss("star.dim_detections_solar_panel"):
+            transfer_detections(history_cursor, star_cursor, checkpoints)
         logging.info("Dimension table transfers completed successfully.")
 
-        populate_fact_table(history_cursor, star_cursor)
+        with track_peak_rss("star.image_blobs"), checkpoints.metrics.span("blob_load") as span:
+            span.add(load_missing_blobs(history_conn, star_conn))
 
-    star_conn.commit()
-    logging.info("Data transfer completed successfully.")
+        with track_peak_rss("star.fact_images"):
+            populate_fact_table(history_cursor, star_cursor, checkpoints)
 
+        with checkpoints.metrics.span("stale_rows"):
+            remove_stale_rows(star_cursor, checkpoints)
 
-def truncate_table(cursor, table_name, cascade=True):
-    """
-    Truncate the specified table.
+    # Idempotent, so a resumed run simply refreshes whatever is still queued.
+    with checkpoints.metrics.span("rollup_refresh") as span:
+        span.add(refresh_rollups(star_conn))
+    # Committed with the end of the run, so readers only cache results again once all of the data is in.
+    with star_conn.cursor() as star_cursor:
+        star_cursor.execute("SELECT star.end_load(%s);", (checkpoints.run_id,))
+    checkpoints.finish_run()
+    logging.info("Data transfer completed successfully.")
 
-    Parameters:
-    - cursor: The database cursor to execute the command.
-    - table_name: The name of the table to truncate.
-    - cascade: If True, use CASCADE to also truncate dependent tables.
-    """
-    try:
-        # Construct the TRUNCATE command directly as a string
-        cascade_clause = "CASCADE" if cascade else ""
-        truncate_command = f"TRUNCATE TABLE star.{table_name} {cascade_clause}".strip()
 
-        cursor.execute(truncate_command)
-        logging.info(f"Truncated table: {table_name}")
-    except Exception as e:
-        logging.error(f"Error truncating table {table_name}: {e}")
-        cursor.connection.rollback()  # Rollback if there's an error
+@profiled("star.load")
+def load(history_conn, star_conn):
+    """Upsert the current history into the star schema, resuming an interrupted run from its checkpoints."""
+    checkpoints = RunCheckpoints(star_conn, "star", "3_dm")
+    checkpoints.start_run()
+    if checkpoints.completed:
+        return
+    # The chunks are committed as they load, so readers stop caching until end_load (see migration V010).
+    with star_conn.cursor() as star_cursor:
+        star_cursor.execute("SELECT star.begin_load(%s);", (checkpoints.run_id,))
+    star_conn.commit()
+
+    # Cover every upload date up to the end of next year, so the fact load never misses a date_id.
+    populate_dim_date(2020, datetime.now().year + 1, star_conn)
+    transfer_data(history_conn, star_conn, checkpoints)
 
 
 def main():
     setup_logging()
     load_dotenv()
+    configure_profiling(LOG_FOLDER)
 
-    history_config = PostgresConfig(
-        dbname=os.getenv("SOURCE_DBNAME"),
-        user=os.getenv("SOURCE_USER"),
-        password=os.getenv("SOURCE_PASSWORD"),
-        host=os.getenv("SOURCE_HOST"),
-        port=int(os.getenv("SOURCE_PORT"))
-    )
-
-    star_config = PostgresConfig(
-        dbname=os.getenv("DEST_DBNAME"),
-        user=os.getenv("DEST_USER"),
-        password=os.getenv("DEST_PASSWORD"),
-        host=os.getenv("DEST_HOST"),
-        port=int(os.getenv("DEST_PORT"))
-    )
-
-    history_conn = connect_to_db(history_config)
-    star_conn = connect_to_db(star_config)
-
+    pools = []
     try:
-        with star_conn.cursor() as cursor:
-            tables_to_truncate = [
-                "dim_images",
-                "dim_predictions_roof_type",
-                "dim_detections_solar_panel",
-                "fact_images"
-            ]
-            for table in tables_to_truncate:
-                truncate_table(cursor, table, cascade=True)
-
-            star_conn.commit()
-
-        populate_dim_date(2020, 2025, star_conn)
-        transfer_data(history_conn, star_conn)
+        pools.append(create_pool(PostgresConfig.from_env("SOURCE")))
+        pools.append(create_pool(PostgresConfig.from_env("DEST")))
+        history_pool, star_pool = pools
+        migrations = os.getenv("MIGRATIONS_DIR") or resolve_migrations_dir(os.path.dirname(os.path.abspath(__file__)))
+        with star_pool.connection() as star_conn:
+            apply_migrations(star_conn, migrations, "star")
+        with track_peak_rss("3_DM"):
+            run_with_reconnect(load, [history_pool, star_pool])
     except Exception as e:
         logging.error(f"Error during data transfer: {e}")
+        sys.exit(1)
     finally:
-        history_conn.close()
-        star_conn.close()
+        for pool in pools:
+            pool.close()
         logging.info("Database connections closed.")
 
 
@@ -0,0 +1,146 @@
+from datetime import date
+from typing import Optional
+
+from psycopg2.extras import RealDictCursor
+
+from spatial import MAX_PAGE_SIZE, Page, fetch_page
+
+# Column of star.dim_images holding the region code of each level, see migration V006.
+REGION_COLUMNS = {"county": "county_code", "municipality": "municipality_code"}
+
+IMAGES_PAGE = """
+    SELECT image_id, filename, width, height, latitude, longitude, geohash, county_code, municipality_code,
+           image_data_sha256, date_loaded
+    FROM star.dim_images
+    WHERE image_id > %(after)s {condition}
+    ORDER BY image_id
+    LIMIT %(limit)s;
+    """
+
+IMAGE_DETAIL = """
+    SELECT i.image_id, i.filename, i.width, i.height, i.latitude, i.longitude, i.geohash,
+           i.county_code, county.name AS county_name, i.municipality_code, municipality.name AS municipality_name,
+           i.image_data_sha256, i.date_loaded
+    FROM star.dim_images AS i
+    LEFT JOIN star.dim_regions AS county ON county.region_code = i.county_code
+    LEFT JOIN star.dim_regions AS municipality ON municipality.region_code = i.municipality_code
+    WHERE i.image_id = %(image_id)s;
+    """
+
+IMAGE_PREDICTIONS = """
+    SELECT DISTINCT p.prediction_id, p.class_name, p.confidence, p.time_taken, p.prediction_type, p.date_processed
+    FROM star.dim_images AS i
+    JOIN star.fact_images AS f ON f.image_id = i.dim_image_id
+    JOIN star.dim_predictions_roof_type AS p ON p.dim_roof_type_id = f.dim_roof_type_id
+    WHERE i.image_id = %(image_id)s
+    ORDER BY p.confidence DESC, p.prediction_id;
+    """
+
+IMAGE_DETECTIONS = """
+    SELECT DISTINCT d.detection_id, d.class_name, d.confidence, d.x, d.y, d.width, d.height, d.image_data_sha256,
+           d.date_processed
+    FROM star.dim_images AS i
+    JOIN star.fact_images AS f ON f.image_id = i.dim_image_id
+    JOIN star.dim_detections_solar_panel AS d ON d.dim_solar_panel_id = f.dim_solar_panel_id
+    WHERE i.image_id = %(image_id)s AND d.class_name IS DISTINCT FROM 'No predictions'
+    ORDER BY d.detection_id;
+    """
+
+# From the roof and solar rollup (see rollups.py), so these read one row per roof type, day and grid cell.
+ROOF_TYPE_TOTALS = """
+    SELECT r.roof_class, SUM(r.image_count)::BIGINT AS image_count, SUM(r.detection_count)::BIGINT AS detection_count,
+           SUM(r.avg_roof_confidence * r.image_count) / NULLIF(SUM(r.image_count), 0) AS avg_roof_confidence,
+           SUM(r.detection_area)::BIGINT AS detection_area
+    FROM star.rollup_roof_solar AS r
+    JOIN star.dim_date AS d ON d.date_id = r.date_id
+    WHERE d.date BETWEEN %(start)s AND %(end)s
+    GROUP BY r.roof_class
+    ORDER BY r.roof_class;
+    """
+
+DAILY_TOTALS = """
+    SELECT d.date, SUM(r.detection_count)::BIGINT AS detection_count,
+           jsonb_object_agg(r.roof_class, r.image_count ORDER BY r.roof_class) AS roof_types
+    FROM (
+        SELECT roof_class, date_id, SUM(image_count) AS image_count, SUM(detection_count) AS detection_count
+        FROM star.rollup_roof_solar
+        GROUP BY roof_class, date_id
+    ) AS r
+    JOIN star.dim_date AS d ON d.date_id = r.date_id
+    WHERE d.date BETWEEN %(start)s AND %(end)s AND d.date > %(after)s
+    GROUP BY d.date
+    ORDER BY d.date
+    LIMIT %(limit)s;
+    """
+
+REGION_TOTALS = """
+    WITH images AS (
+        SELECT dim_image_id, {column} AS region_code
+        FROM star.dim_images
+        WHERE {column} > %(after)s
+    )
+    SELECT im.region_code, r.name, COUNT(DISTINCT im.dim_image_id) AS image_count,
+           COUNT(DISTINCT d.dim_solar_panel_id) FILTER (WHERE d.class_name IS DISTINCT FROM 'No predictions')
+               AS detection_count
+    FROM images AS im
+    LEFT JOIN star.dim_regions AS r ON r.region_code = im.region_code
+    LEFT JOIN star.fact_images AS f ON f.image_id = im.dim_image_id
+    LEFT JOIN star.dim_detections_solar_panel AS d ON d.dim_solar_panel_id = f.dim_solar_panel_id
+    GROUP BY im.region_code, r.name
+    ORDER BY im.region_code
+    LIMIT %(limit)s;
+    """
+
+
+def image_page(connection, county: Optional[str] = None, municipality: Optional[str] = None,
+               after: Optional[int] = None, limit: int = 100) -> Page:
+    """Images by image_id, one page at a time, optionally only those of a county or municipality."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    conditions = []
+    if county is not None:
+        conditions.append("AND county_code = %(county)s")
+    if municipality is not None:
+        conditions.append("AND municipality_code = %(municipality)s")
+    params = {"after": after or 0, "county": county, "municipality": municipality}
+    return fetch_page(connection, IMAGES_PAGE.format(condition=" ".join(conditions)), params, "image_id", limit)
+
+
+def image_detail(connection, image_id: int) -> Optional[dict]:
+    """An image with its regions, its current predictions and its solar panel detections; None if not loaded."""
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(IMAGE_DETAIL, {"image_id": image_id})
+        image = cursor.fetchone()
+        if image is not None:
+            image = dict(image)
+            cursor.execute(IMAGE_PREDICTIONS, {"image_id": image_id})
+            image["predictions"] = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(IMAGE_DETECTIONS, {"image_id": image_id})
+            image["detections"] = [dict(row) for row in cursor.fetchall()]
+    connection.rollback()
+    return image
+
+
+def roof_type_totals(connection, start: date = date.min, end: date = date.max) -> list:
+    """Images, detections and the mean confidence per roof type of the images uploaded between two dates."""
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(ROOF_TYPE_TOTALS, {"start": start, "end": end})
+        rows = [dict(row) for row in cursor.fetchall()]
+    connection.rollback()
+    return rows
+
+
+def daily_totals(connection, start: date = date.min, end: date = date.max, after: Optional[date] = None,
+                 limit: int = 100) -> Page:
+    """Detections and the images per roof type of every upload day, by date, one page at a time."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    params = {"start": start, "end": end, "after": after or date.min}
+    return fetch_page(connection, DAILY_TOTALS, params, "date", limit)
+
+
+def region_totals(connection, level: str, after: Optional[str] = None, limit: int = 100) -> Page:
+    """Images and solar panel detections per county or municipality, by region code, one page at a time."""
+    if level not in REGION_COLUMNS:
+        raise ValueError(f"Unknown region level: {level}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = REGION_TOTALS.format(column=REGION_COLUMNS[level])
+    return fetch_page(connection, query, {"after": after or ""}, "region_code", limit)
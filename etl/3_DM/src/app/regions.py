@@ -0,0 +1,257 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import psycopg2.extras
+import shapely
+from dotenv import load_dotenv
+from shapely.geometry import shape
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.quality import to_numbers
+
+# Administrative levels assigned to every image, each stored in star.dim_images.<level>_code.
+LEVELS = ("county", "municipality")
+# Marks a cached grid cell crossed by a boundary; its points are looked up one by one.
+MIXED = -2
+OUTSIDE = -1
+# Load id of a backfill in star.running_loads; a backfill that died is cleared by the next one to finish.
+BACKFILL_LOAD_ID = "regions-backfill"
+
+
+@dataclass
+class RegionConfig:
+    # GeoJSON FeatureCollection of the region polygons; no file means no enrichment.
+    geojson_path: Optional[str] = None
+    level_property: str = "level"
+    code_property: str = "code"
+    name_property: str = "name"
+    # Side of the grid cells whose region is cached, in degrees (0.01 is about 1.1 x 0.75 km in Hungary).
+    cell_degrees: float = 0.01
+
+    @classmethod
+    def from_env(cls) -> "RegionConfig":
+        return cls(
+            geojson_path=os.getenv("STAR_REGIONS_GEOJSON") or None,
+            level_property=os.getenv("STAR_REGIONS_LEVEL_PROPERTY", "level"),
+            code_property=os.getenv("STAR_REGIONS_CODE_PROPERTY", "code"),
+            name_property=os.getenv("STAR_REGIONS_NAME_PROPERTY", "name"),
+            cell_degrees=float(os.getenv("STAR_REGIONS_CELL_DEGREES", 0.01))
+        )
+
+
+@dataclass
+class Region:
+    code: str
+    level: str
+    name: Optional[str]
+
+
+class RegionIndex:
+    """Region polygons of every level in an STR tree, answering point lookups for whole arrays at once.
+
+    The region of a grid cell lying entirely inside one polygon (or outside all of
+    them) is cached, so only points in cells crossed by a boundary are tested
+    against the polygons themselves.
+    """
+
+    def __init__(self, regions: List[Region], geometries: list, cell_degrees: float):
+        self.regions = regions
+        self.cell_degrees = cell_degrees
+        self._geometries = np.array(geometries, dtype=object)
+        self._codes = np.array([region.code for region in regions] + [None], dtype=object)
+        self._trees: Dict[str, Tuple[shapely.STRtree, np.ndarray]] = {}
+        for level in LEVELS:
+            members = np.array([index for index, region in enumerate(regions) if region.level == level], dtype=np.int64)
+            self._trees[level] = (shapely.STRtree(self._geometries[members]), members)
+        self._cells: Dict[str, Dict[Tuple[int, int], int]] = {level: {} for level in LEVELS}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_geojson(cls, config: RegionConfig) -> "RegionIndex":
+        with open(config.geojson_path) as file:
+            features = json.load(file)["features"]
+        regions, geometries = [], []
+        for feature in features:
+            properties = feature.get("properties") or {}
+            level = properties.get(config.level_property)
+            if level not in LEVELS or feature.get("geometry") is None:
+                continue
+            regions.append(Region(str(properties[config.code_property]), level, properties.get(config.name_property)))
+            geometries.append(shape(feature["geometry"]))
+        shapely.prepare(geometries)
+        logging.info(f"Loaded {len(regions)} regions from {config.geojson_path}: "
+                     f"{', '.join(f'{sum(r.level == level for r in regions)} {level}' for level in LEVELS)}.")
+        return cls(regions, geometries, config.cell_degrees)
+
+    def _cell_keys(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        """(row, column) of the grid cell of every point, as an n x 2 integer array; valid for any cell size."""
+        return np.stack([np.floor(latitudes / self.cell_degrees), np.floor(longitudes / self.cell_degrees)],
+                        axis=1).astype(np.int64)
+
+    def _classify_cells(self, level: str, keys: np.ndarray) -> np.ndarray:
+        """Region index of each cell lying within one region, OUTSIDE for cells touching none, else MIXED."""
+        tree, members = self._trees[level]
+        rows, columns = keys[:, 0], keys[:, 1]
+        boxes = shapely.box(columns * self.cell_degrees, rows * self.cell_degrees,
+                            (columns + 1) * self.cell_degrees, (rows + 1) * self.cell_degrees)
+        result = np.full(len(keys), MIXED, dtype=np.int64)
+        cell_index, region_index = tree.query(boxes, predicate="intersects")
+        touching = np.bincount(cell_index, minlength=len(keys))
+        result[touching == 0] = OUTSIDE
+        # Cells touching a single region, and covered by its (prepared) polygon, take that region.
+        single = touching[cell_index] == 1
+        cell_index, region_index = cell_index[single], members[region_index[single]]
+        covered = shapely.covers(self._geometries[region_index], boxes[cell_index])
+        result[cell_index[covered]] = region_index[covered]
+        return result
+
+    def lookup(self, latitudes, longitudes) -> Dict[str, np.ndarray]:
+        """Region code (or None) of every point at every level."""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        valid = np.isfinite(latitudes) & np.isfinite(longitudes)
+        keys = self._cell_keys(np.where(valid, latitudes, 0.0), np.where(valid, longitudes, 0.0))
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        cells = [tuple(key) for key in unique_keys.tolist()]
+
+        codes = {}
+        for level in LEVELS:
+            with self._lock:
+                cache = self._cells[level]
+                unknown = [cell for cell in cells if cell not in cache]
+                if unknown:
+                    classified = self._classify_cells(level, np.array(unknown, dtype=np.int64))
+                    cache.update(zip(unknown, classified.tolist()))
+                cell_regions = np.array([cache[cell] for cell in cells], dtype=np.int64)
+            point_regions = cell_regions[inverse]
+
+            mixed = np.flatnonzero(point_regions == MIXED)
+            if len(mixed):
+                tree, members = self._trees[level]
+                point_index, region_index = tree.query(shapely.points(longitudes[mixed], latitudes[mixed]),
+                                                       predicate="intersects")
+                point_regions[mixed] = OUTSIDE
+                # A point on a shared border gets the first region listed.
+                point_regions[mixed[point_index[::-1]]] = members[region_index[::-1]]
+            point_regions[~valid] = OUTSIDE
+            codes[level] = self._codes[point_regions]
+        return codes
+
+
+_index: Optional[RegionIndex] = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def region_index() -> Optional[RegionIndex]:
+    """The region index of this process, loaded from STAR_REGIONS_GEOJSON on first use; None without a file."""
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            config = RegionConfig.from_env()
+            _index = RegionIndex.from_geojson(config) if config.geojson_path else None
+            _index_loaded = True
+        return _index
+
+
+def with_regions(rows: list, latitude_column: int, longitude_column: int) -> list:
+    """Append the region code of every level to each row; None codes when no regions are configured."""
+    index = region_index()
+    if index is None or not rows:
+        return [tuple(row) + (None,) * len(LEVELS) for row in rows]
+    columns = list(zip(*rows))
+    codes = index.lookup(to_numbers(columns[latitude_column]), to_numbers(columns[longitude_column]))
+    return [tuple(row) + tuple(codes[level][position] for level in LEVELS) for position, row in enumerate(rows)]
+
+
+def store_regions(star_cursor) -> int:
+    """Upsert the configured regions into star.dim_regions, so the codes on dim_images resolve to names."""
+    index = region_index()
+    if index is None:
+        return 0
+    psycopg2.extras.execute_values(star_cursor, """
+        INSERT INTO star.dim_regions (region_code, level, name) VALUES %s
+        ON CONFLICT (region_code) DO UPDATE SET level = EXCLUDED.level, name = EXCLUDED.name;
+    """, [(region.code, region.level, region.name) for region in index.regions])
+    return len(index.regions)
+
+
+def benchmark(points: int, seed: int):
+    index = region_index()
+    if index is None:
+        raise SystemExit("Set STAR_REGIONS_GEOJSON to the region polygons.")
+    rng = np.random.default_rng(seed)
+    # The range ImageProcessService._generate_random_coordinate_hungary draws coordinates from.
+    latitudes = rng.uniform(45.87, 48.58, points)
+    longitudes = rng.uniform(16.16, 22.89, points)
+    for label in ("cold cache", "warm cache"):
+        started = time.perf_counter()
+        codes = index.lookup(latitudes, longitudes)
+        elapsed = time.perf_counter() - started
+        found = ", ".join(f"{np.count_nonzero(codes[level] != None)} in a {level}" for level in LEVELS)  # noqa: E711
+        logging.info(f"{label}: {points} points in {elapsed:.2f}s ({points / elapsed:,.0f} points/s); {found}.")
+
+
+def backfill(star_conn, batch_size: int = 10000) -> int:
+    """Set the region codes of every dim_images row, e.g. after configuring new boundaries."""
+    updated, after = 0, 0
+    with star_conn.cursor() as cursor:
+        cursor.execute("SELECT star.begin_load(%s);", (BACKFILL_LOAD_ID,))
+        star_conn.commit()
+        while True:
+            cursor.execute("""
+                SELECT image_id, latitude, longitude FROM star.dim_images
+                WHERE image_id > %s ORDER BY image_id LIMIT %s;
+            """, (after, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            psycopg2.extras.execute_values(cursor, """
+                UPDATE star.dim_images AS d
+                SET county_code = v.county_code, municipality_code = v.municipality_code
+                FROM (VALUES %s) AS v(image_id, latitude, longitude, county_code, municipality_code)
+                WHERE d.image_id = v.image_id;
+            """, with_regions(rows, 1, 2), page_size=batch_size)
+            star_conn.commit()
+            updated += len(rows)
+            after = rows[-1][0]
+        store_regions(cursor)
+        cursor.execute("SELECT star.end_load(%s);", (BACKFILL_LOAD_ID,))
+    star_conn.commit()
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Region codes of the star images from STAR_REGIONS_GEOJSON.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="set the region codes of every image in star.dim_images")
+    benchmark_parser = commands.add_parser("benchmark", help="time lookups of random points in Hungary")
+    benchmark_parser.add_argument("--points", type=int, default=1_000_000)
+    benchmark_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    if args.command == "benchmark":
+        benchmark(args.points, args.seed)
+        return
+
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="3_dm_regions"))
+    try:
+        with pool.connection() as star_conn:
+            logging.info(f"Set the region codes of {backfill(star_conn)} images.")
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
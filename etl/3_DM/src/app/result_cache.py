@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+WATERMARK_SELECT = "SELECT version, EXISTS (SELECT 1 FROM star.running_loads) FROM star.load_watermark;"
+
+
+@dataclass
+class CacheConfig:
+    max_entries: int = 1024
+    ttl_seconds: float = 300.0
+    # How long a read of star.load_watermark is trusted before it is read again.
+    watermark_seconds: float = 1.0
+
+    @classmethod
+    def from_env(cls) -> "CacheConfig":
+        return cls(
+            max_entries=int(os.getenv("STAR_API_CACHE_ENTRIES", 1024)),
+            ttl_seconds=float(os.getenv("STAR_API_CACHE_TTL_SECONDS", 300)),
+            watermark_seconds=float(os.getenv("STAR_API_WATERMARK_SECONDS", 1))
+        )
+
+
+class Watermark:
+    """The version of star.load_watermark and whether a load is running, read at most once per `max_age_seconds`."""
+
+    def __init__(self, pool, max_age_seconds: float):
+        self.pool = pool
+        self.max_age_seconds = max_age_seconds
+        self._state: Optional[Tuple[int, bool]] = None
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> Tuple[int, bool]:
+        """(version, loading): while `loading`, a load is committing chunks and results must not be cached."""
+        with self._lock:
+            if self._state is None or time.monotonic() - self._read_at >= self.max_age_seconds:
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(WATERMARK_SELECT)
+                        self._state = tuple(cursor.fetchone())
+                    connection.rollback()
+                self._read_at = time.monotonic()
+            return self._state
+
+
+def entity_tag(version: int, key: str) -> str:
+    """ETag of a result: the same request at the same watermark always has the same body."""
+    return f'"{version}-{hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]}"'
+
+
+class ResultCache:
+    """Serialized responses by request key, evicted least recently used beyond `max_entries` or after a TTL.
+
+    Every entry belongs to the watermark version it was computed at; when the
+    version moves on, all entries are dropped at once.
+    """
+
+    def __init__(self, config: CacheConfig):
+        self.config = config
+        self.hits = 0
+        self.misses = 0
+        self._version: Optional[int] = None
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sync(self, version: int) -> bool:
+        """Move on to a newer version; False for an older one, whose results must not be served or kept."""
+        if self._version is not None and version < self._version:
+            return False
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        return True
+
+    def get(self, version: int, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key) if self._sync(version) else None
+            if entry is not None and time.monotonic() - entry[0] >= self.config.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, version: int, key: str, body: bytes):
+        with self._lock:
+            if not self._sync(version) or self.config.max_entries <= 0:
+                return
+            self._entries[key] = (time.monotonic(), body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.config.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, version: int, key: str, compute: Callable[[], bytes]) -> Tuple[bytes, bool]:
+        """The cached body of `key`, else `compute()`'s, cached; also whether it came from the cache."""
+        body = self.get(version, key)
+        if body is not None:
+            return body, True
+        body = compute()
+        self.put(version, key, body)
+        return body, False
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,170 @@
+import argparse
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+
+# Aggregates the facts of the (date_id, cell) groups selected by {source}; shared by the refresh and the check.
+# The fact grain is image x roof prediction x detection, so the facts are first reduced to one row per image:
+# the image is counted under the class of its most confident roof prediction and each of its detections once,
+# which keeps every measure additive across roof classes.
+ROLLUP_SELECT = """
+    WITH facts AS (
+        SELECT f.image_id, f.date_id, f.dim_roof_type_id, f.dim_solar_panel_id,
+               star.grid_cell(i.latitude) AS grid_lat, star.grid_cell(i.longitude) AS grid_lon
+        FROM star.fact_images AS f
+        JOIN star.dim_images AS i ON i.dim_image_id = f.image_id
+        {source}
+    ),
+    images AS (
+        SELECT image_id, date_id, grid_lat, grid_lon, COUNT(*) AS fact_count
+        FROM facts
+        GROUP BY 1, 2, 3, 4
+    ),
+    roofs AS (
+        SELECT DISTINCT ON (f.image_id) f.image_id, p.class_name, p.confidence
+        FROM facts AS f
+        LEFT JOIN star.dim_predictions_roof_type AS p ON p.dim_roof_type_id = f.dim_roof_type_id
+        ORDER BY f.image_id, p.confidence DESC NULLS LAST, p.dim_roof_type_id
+    ),
+    detections AS (
+        SELECT image_id, COUNT(*) AS detection_count, SUM(confidence) AS confidence_sum,
+               COUNT(confidence) AS confidence_count, SUM(width::BIGINT * height) AS detection_area
+        FROM (
+            SELECT DISTINCT f.image_id, d.dim_solar_panel_id, d.confidence, d.width, d.height
+            FROM facts AS f
+            JOIN star.dim_detections_solar_panel AS d ON d.dim_solar_panel_id = f.dim_solar_panel_id
+        ) AS distinct_detections
+        GROUP BY image_id
+    )
+    SELECT
+        COALESCE(r.class_name, 'unknown') AS roof_class,
+        im.date_id,
+        im.grid_lat,
+        im.grid_lon,
+        SUM(im.fact_count)::BIGINT AS fact_count,
+        COUNT(*) AS image_count,
+        COALESCE(SUM(d.detection_count), 0)::BIGINT AS detection_count,
+        AVG(r.confidence) AS avg_roof_confidence,
+        SUM(d.confidence_sum) / NULLIF(SUM(d.confidence_count), 0) AS avg_detection_confidence,
+        COALESCE(SUM(d.detection_area), 0)::BIGINT AS detection_area
+    FROM images AS im
+    JOIN roofs AS r ON r.image_id = im.image_id
+    LEFT JOIN detections AS d ON d.image_id = im.image_id
+    GROUP BY 1, 2, 3, 4
+    """
+
+ROLLUP_COLUMNS = ("roof_class, date_id, grid_lat, grid_lon, fact_count, image_count, detection_count, "
+                  "avg_roof_confidence, avg_detection_confidence, detection_area")
+
+DIRTY_CELLS_JOIN = """
+    JOIN rollup_refresh_cells AS dirty
+      ON dirty.date_id = f.date_id
+     AND dirty.grid_lat = star.grid_cell(i.latitude)
+     AND dirty.grid_lon = star.grid_cell(i.longitude)
+    """
+
+
+def refresh_rollups(star_conn) -> int:
+    """Recompute the rollup groups whose facts changed since the last refresh; returns the number of cells.
+
+    The fact and dimension triggers queue the touched (date_id, cell) pairs in
+    star.rollup_dirty_cells, so the work is proportional to what the loads changed.
+    """
+    with star_conn.cursor() as cursor:
+        # Writers queueing a cell wait for this transaction, so no change slips between the copy and the delete.
+        cursor.execute("LOCK TABLE star.rollup_dirty_cells IN SHARE ROW EXCLUSIVE MODE;")
+        cursor.execute("""
+            CREATE TEMP TABLE rollup_refresh_cells ON COMMIT DROP AS
+            SELECT date_id, grid_lat, grid_lon FROM star.rollup_dirty_cells;
+        """)
+        cells = cursor.rowcount
+        if cells:
+            cursor.execute("""
+                DELETE FROM star.rollup_roof_solar AS r
+                USING rollup_refresh_cells AS dirty
+                WHERE r.date_id = dirty.date_id AND r.grid_lat = dirty.grid_lat AND r.grid_lon = dirty.grid_lon;
+            """)
+            cursor.execute(f"INSERT INTO star.rollup_roof_solar ({ROLLUP_COLUMNS}) "
+                           f"{ROLLUP_SELECT.format(source=DIRTY_CELLS_JOIN)};")
+            cursor.execute("DELETE FROM star.rollup_dirty_cells;")
+            cursor.execute("SELECT star.advance_load_watermark();")
+    star_conn.commit()
+    if cells:
+        logging.info(f"Refreshed the roof and solar rollup for {cells} grid cells.")
+    return cells
+
+
+def rebuild_rollups(star_conn):
+    """Recompute the whole rollup from the facts."""
+    with star_conn.cursor() as cursor:
+        cursor.execute("LOCK TABLE star.rollup_dirty_cells IN SHARE ROW EXCLUSIVE MODE;")
+        cursor.execute("DELETE FROM star.rollup_roof_solar;")
+        cursor.execute(f"INSERT INTO star.rollup_roof_solar ({ROLLUP_COLUMNS}) {ROLLUP_SELECT.format(source='')};")
+        groups = cursor.rowcount
+        cursor.execute("DELETE FROM star.rollup_dirty_cells;")
+        cursor.execute("SELECT star.advance_load_watermark();")
+    star_conn.commit()
+    logging.info(f"Rebuilt the roof and solar rollup ({groups} groups).")
+
+
+def check_rollups(star_conn) -> int:
+    """Compare the rollup with a full recompute from the facts; returns the number of differing groups.
+
+    Cells still waiting for a refresh are left out, they are expected to differ.
+    """
+    with star_conn.cursor() as cursor:
+        cursor.execute(f"""
+            WITH expected AS ({ROLLUP_SELECT.format(source='')}),
+            stored AS (SELECT {ROLLUP_COLUMNS} FROM star.rollup_roof_solar),
+            differences AS (
+                (SELECT * FROM expected EXCEPT SELECT * FROM stored)
+                UNION ALL
+                (SELECT * FROM stored EXCEPT SELECT * FROM expected)
+            )
+            SELECT DISTINCT roof_class, date_id, grid_lat::NUMERIC(9, 4), grid_lon::NUMERIC(9, 4)
+            FROM differences AS g
+            WHERE NOT EXISTS (
+                SELECT 1 FROM star.rollup_dirty_cells AS dirty
+                WHERE dirty.date_id = g.date_id AND dirty.grid_lat = g.grid_lat AND dirty.grid_lon = g.grid_lon
+            );
+        """)
+        mismatches = cursor.fetchall()
+    star_conn.rollback()
+
+    for roof_class, date_id, grid_lat, grid_lon in mismatches[:20]:
+        logging.warning(f"Rollup group {roof_class} / {date_id} / ({grid_lat}, {grid_lon}) "
+                        f"differs from a full recompute.")
+    if mismatches:
+        logging.warning(f"{len(mismatches)} rollup groups differ from a full recompute; run a rebuild.")
+    else:
+        logging.info("Roof and solar rollup matches a full recompute.")
+    return len(mismatches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the roof and solar rollup of the star schema.")
+    parser.add_argument("command", choices=["refresh", "rebuild", "check"],
+                        help="refresh the changed cells, recompute everything, or compare with a full recompute")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="3_dm_rollups"))
+    try:
+        with pool.connection() as star_conn:
+            if args.command == "refresh":
+                refresh_rollups(star_conn)
+            elif args.command == "rebuild":
+                rebuild_rollups(star_conn)
+            elif check_rollups(star_conn):
+                sys.exit(1)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
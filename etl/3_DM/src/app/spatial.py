@@ -0,0 +1,324 @@
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+from psycopg2.extras import RealDictCursor
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Length of star.dim_images.geohash, see migration V005.
+GEOHASH_CHARS = 8
+# A region is looked up as at most this many index ranges; fewer, coarser cells read a few more rows.
+MAX_CELLS = 64
+MAX_PAGE_SIZE = 1000
+EARTH_RADIUS_KM = 6371.0088
+
+
+@dataclass
+class BoundingBox:
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    @classmethod
+    def around(cls, latitude: float, longitude: float, radius_km: float) -> "BoundingBox":
+        """The box enclosing a circle; it does not handle circles over a pole or the antimeridian."""
+        lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+        lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 1e-6)
+        return cls(max(latitude - lat_delta, -90.0), max(longitude - lon_delta, -180.0),
+                   min(latitude + lat_delta, 90.0), min(longitude + lon_delta, 180.0))
+
+
+# The range ImageProcessService._generate_random_coordinate_hungary draws coordinates from.
+HUNGARY = BoundingBox(45.87, 16.16, 48.58, 22.89)
+
+
+def encode(latitude: float, longitude: float, chars: int = GEOHASH_CHARS) -> str:
+    """Geohash of a point; the same as star.geohash() in the database."""
+    lat_low, lat_high, lon_low, lon_high = -90.0, 90.0, -180.0, 180.0
+    hash_chars, value, bits, is_longitude = [], 0, 0, True
+    while len(hash_chars) < chars:
+        if is_longitude:
+            middle = (lon_low + lon_high) / 2
+            if longitude >= middle:
+                value, lon_low = value * 2 + 1, middle
+            else:
+                value, lon_high = value * 2, middle
+        else:
+            middle = (lat_low + lat_high) / 2
+            if latitude >= middle:
+                value, lat_low = value * 2 + 1, middle
+            else:
+                value, lat_high = value * 2, middle
+        is_longitude = not is_longitude
+        bits += 1
+        if bits == 5:
+            hash_chars.append(GEOHASH_ALPHABET[value])
+            value, bits = 0, 0
+    return "".join(hash_chars)
+
+
+def cell_size(chars: int) -> Tuple[float, float]:
+    """Height and width in degrees of the cells of a geohash length."""
+    bits = 5 * chars
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def cover(box: BoundingBox, max_cells: int = MAX_CELLS) -> List[str]:
+    """The longest geohash cells that together contain the box, at most `max_cells` of them."""
+    for chars in range(GEOHASH_CHARS, 0, -1):
+        lat_step, lon_step = cell_size(chars)
+        rows = range(math.floor((box.min_lat + 90) / lat_step), math.floor((box.max_lat + 90) / lat_step) + 1)
+        columns = range(math.floor((box.min_lon + 180) / lon_step), math.floor((box.max_lon + 180) / lon_step) + 1)
+        if len(rows) * len(columns) <= max_cells or chars == 1:
+            # The centre of a cell is unambiguously inside it.
+            return sorted({encode(-90 + (row + 0.5) * lat_step, -180 + (column + 0.5) * lon_step, chars)
+                           for row in rows for column in columns})
+    return []
+
+
+# Images of the cells in %(cells)s: one index range per cell, then the exact test on the coordinates.
+REGION_IMAGES = """
+    SELECT i.image_id, i.filename, i.latitude, i.longitude, i.geohash{distance}
+    FROM unnest(%(cells)s::TEXT[]) AS c(prefix)
+    JOIN star.dim_images AS i
+      ON i.geohash >= c.prefix COLLATE "C" AND i.geohash < (c.prefix || '~') COLLATE "C"
+    WHERE i.latitude BETWEEN %(min_lat)s AND %(max_lat)s
+      AND i.longitude BETWEEN %(min_lon)s AND %(max_lon)s
+      AND i.image_id > %(after)s
+      {condition}
+    ORDER BY i.image_id
+    LIMIT %(limit)s;
+    """
+
+DISTANCE_KM = f"""
+    2 * {EARTH_RADIUS_KM} * asin(sqrt(
+        power(sin(radians(i.latitude::DOUBLE PRECISION - %(latitude)s) / 2), 2)
+        + cos(radians(%(latitude)s)) * cos(radians(i.latitude::DOUBLE PRECISION))
+        * power(sin(radians(i.longitude::DOUBLE PRECISION - %(longitude)s) / 2), 2)))
+    """
+
+# Per cell: the images, their solar panel detections and the images per roof type, an image's roof type
+# being its most confident prediction.
+CELL_AGGREGATES = """
+    WITH images AS (
+        SELECT i.dim_image_id, left(i.geohash, %(chars)s) AS cell
+        FROM {images}
+    ), roofs AS (
+        SELECT DISTINCT ON (f.image_id) f.image_id, p.class_name
+        FROM images AS im
+        JOIN star.fact_images AS f ON f.image_id = im.dim_image_id
+        JOIN star.dim_predictions_roof_type AS p ON p.dim_roof_type_id = f.dim_roof_type_id
+        ORDER BY f.image_id, p.confidence DESC
+    ), detections AS (
+        SELECT f.image_id, COUNT(DISTINCT d.dim_solar_panel_id) AS detections
+        FROM images AS im
+        JOIN star.fact_images AS f ON f.image_id = im.dim_image_id
+        JOIN star.dim_detections_solar_panel AS d ON d.dim_solar_panel_id = f.dim_solar_panel_id
+        WHERE d.class_name IS DISTINCT FROM 'No predictions'
+        GROUP BY f.image_id
+    )
+    SELECT cell, SUM(images)::BIGINT AS image_count, SUM(detections)::BIGINT AS detection_count,
+           jsonb_object_agg(roof_class, images ORDER BY roof_class) AS roof_types
+    FROM (
+        SELECT im.cell, COALESCE(r.class_name, 'unknown') AS roof_class, COUNT(*) AS images,
+               COALESCE(SUM(dt.detections), 0) AS detections
+        FROM images AS im
+        LEFT JOIN roofs AS r ON r.image_id = im.dim_image_id
+        LEFT JOIN detections AS dt ON dt.image_id = im.dim_image_id
+        GROUP BY 1, 2
+    ) AS per_class
+    WHERE cell > %(after)s
+    GROUP BY cell
+    ORDER BY cell
+    LIMIT %(limit)s;
+    """
+
+BOX_IMAGES = """
+    unnest(%(cells)s::TEXT[]) AS c(prefix)
+    JOIN star.dim_images AS i
+      ON i.geohash >= c.prefix COLLATE "C" AND i.geohash < (c.prefix || '~') COLLATE "C"
+    WHERE i.latitude BETWEEN %(min_lat)s AND %(max_lat)s AND i.longitude BETWEEN %(min_lon)s AND %(max_lon)s
+    """
+
+
+@dataclass
+class Page:
+    rows: List[dict]
+    # Key to pass as `after` for the next page; None on the last page.
+    next_after: Optional[object]
+
+
+def fetch_page(connection, query: str, params: dict, key: str, limit: int) -> Page:
+    """Run a keyset query for up to `limit` rows; it is given limit + 1 to tell whether another page follows."""
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(query, {**params, "limit": limit + 1})
+        rows = [dict(row) for row in cursor.fetchall()]
+    connection.rollback()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][key]
+    return Page(rows=rows, next_after=next_after)
+
+
+def _box_params(box: BoundingBox) -> dict:
+    return {"cells": cover(box), "min_lat": box.min_lat, "max_lat": box.max_lat,
+            "min_lon": box.min_lon, "max_lon": box.max_lon}
+
+
+def images_in_box(connection, box: BoundingBox, after: Optional[int] = None, limit: int = 100) -> Page:
+    """Images whose coordinates lie in the box, by image_id, one page at a time."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = REGION_IMAGES.format(distance="", condition="")
+    return fetch_page(connection, query, {**_box_params(box), "after": after or 0}, "image_id", limit)
+
+
+def images_within(connection, latitude: float, longitude: float, radius_km: float, after: Optional[int] = None,
+                  limit: int = 100) -> Page:
+    """Images at most `radius_km` (great-circle distance) from a point, by image_id, with their distance."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = REGION_IMAGES.format(distance=f", {DISTANCE_KM} AS distance_km",
+                                 condition=f"AND {DISTANCE_KM} <= %(radius_km)s")
+    params = {**_box_params(BoundingBox.around(latitude, longitude, radius_km)), "after": after or 0,
+              "latitude": latitude, "longitude": longitude, "radius_km": radius_km}
+    return fetch_page(connection, query, params, "image_id", limit)
+
+
+def cell_aggregates(connection, chars: int, box: Optional[BoundingBox] = None, after: Optional[str] = None,
+                    limit: int = 100) -> Page:
+    """Images, detections and roof types per geohash cell of `chars` characters, optionally inside a box."""
+    if not 1 <= chars <= GEOHASH_CHARS:
+        raise ValueError(f"Cells have 1 to {GEOHASH_CHARS} characters.")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    params = {"chars": chars, "after": after or ""}
+    if box is None:
+        images = "star.dim_images AS i"
+    else:
+        images = BOX_IMAGES
+        params.update(_box_params(box))
+    return fetch_page(connection, CELL_AGGREGATES.format(images=images), params, "cell", limit)
+
+
+def all_pages(fetch, *args) -> List[dict]:
+    rows, after = [], None
+    while True:
+        page = fetch(*args, after=after, limit=MAX_PAGE_SIZE)
+        rows.extend(page.rows)
+        if page.next_after is None:
+            return rows
+        after = page.next_after
+
+
+def check(connection, samples: int, seed: int) -> int:
+    """Compare the indexed region queries with full scans on random regions in Hungary; returns the mismatches."""
+    rng = random.Random(seed)
+    mismatches = 0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT latitude, longitude, geohash FROM star.dim_images ORDER BY random() LIMIT 1000;")
+        for latitude, longitude, geohash in cursor.fetchall():
+            if encode(float(latitude), float(longitude)) != geohash:
+                mismatches += 1
+                logging.error(f"Geohash of ({latitude}, {longitude}) is {geohash} in the database, "
+                              f"{encode(float(latitude), float(longitude))} in Python.")
+
+        for number in range(samples):
+            latitude = rng.uniform(HUNGARY.min_lat, HUNGARY.max_lat)
+            longitude = rng.uniform(HUNGARY.min_lon, HUNGARY.max_lon)
+            # From a few hundred metres to most of the country.
+            size = 10 ** rng.uniform(-2.5, 0.5)
+            box = BoundingBox(latitude - size / 2, longitude - size, latitude + size / 2, longitude + size)
+            radius_km = 10 ** rng.uniform(-0.5, 2.3)
+
+            found = {row["image_id"] for row in all_pages(images_in_box, connection, box)}
+            cursor.execute("""
+                SELECT image_id FROM star.dim_images
+                WHERE latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s;
+            """, (box.min_lat, box.max_lat, box.min_lon, box.max_lon))
+            expected = {row[0] for row in cursor.fetchall()}
+
+            found_near = {row["image_id"] for row in all_pages(images_within, connection, latitude, longitude,
+                                                                radius_km)}
+            cursor.execute(f"""
+                SELECT i.image_id FROM star.dim_images AS i WHERE {DISTANCE_KM} <= %(radius_km)s;
+            """, {"latitude": latitude, "longitude": longitude, "radius_km": radius_km})
+            expected_near = {row[0] for row in cursor.fetchall()}
+
+            for kind, got, wanted in (("box", found, expected), ("radius", found_near, expected_near)):
+                if got != wanted:
+                    mismatches += 1
+                    logging.error(f"Sample {number} {kind}: {len(wanted - got)} images missed, "
+                                  f"{len(got - wanted)} too many.")
+    connection.rollback()
+    return mismatches
+
+
+def to_json_value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def parse_box(values: List[float]) -> BoundingBox:
+    return BoundingBox(*values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Region queries over the image coordinates of the star schema.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    box_parser = commands.add_parser("box", help="images in a bounding box")
+    box_parser.add_argument("box", nargs=4, type=float, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"))
+    radius_parser = commands.add_parser("radius", help="images within a distance of a point")
+    radius_parser.add_argument("latitude", type=float)
+    radius_parser.add_argument("longitude", type=float)
+    radius_parser.add_argument("km", type=float)
+    cells_parser = commands.add_parser("cells", help="images, detections and roof types per geohash cell")
+    cells_parser.add_argument("--chars", type=int, default=5, help="geohash length of the cells (5: about 5 km)")
+    cells_parser.add_argument("--box", nargs=4, type=float, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"))
+    for command in (box_parser, radius_parser, cells_parser):
+        command.add_argument("--after", help="key of the last row of the previous page")
+        command.add_argument("--limit", type=int, default=100)
+    check_parser = commands.add_parser("check", help="compare the indexed queries with full scans (exit code 1 "
+                                                     "on a difference)")
+    check_parser.add_argument("--samples", type=int, default=50)
+    check_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("DEST"), PoolConfig(min_size=1, max_size=1,
+                                                                      application_name="3_dm_spatial"))
+    try:
+        with pool.connection() as connection:
+            if args.command == "check":
+                mismatches = check(connection, args.samples, args.seed)
+                if mismatches:
+                    logging.error(f"{mismatches} region queries differ from a full scan.")
+                    sys.exit(1)
+                logging.info(f"All {args.samples} sampled regions match a full scan.")
+                return
+            if args.command == "box":
+                page = images_in_box(connection, parse_box(args.box), int(args.after or 0), args.limit)
+            elif args.command == "radius":
+                page = images_within(connection, args.latitude, args.longitude, args.km, int(args.after or 0),
+                                     args.limit)
+            else:
+                page = cell_aggregates(connection, args.chars, parse_box(args.box) if args.box else None, args.after,
+                                       args.limit)
+            for row in page.rows:
+                print(json.dumps({key: to_json_value(value) for key, value in row.items()}))
+            if page.next_after is not None:
+                print(f"# next page: --after {page.next_after}")
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
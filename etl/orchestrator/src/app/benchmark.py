@@ -0,0 +1,169 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.memory import RssSampler
+from main import DATABASES, fused_history, prepare_history, prepare_source, prepare_stage, prepare_star
+from stages import load_stage
+from statement_stats import RECORDER, CountingConnection
+from synthetic_data import add_config_arguments, config_from_args, mutate, populate, set_seed
+
+RESULTS_FOLDER = "benchmark_results"
+
+# Per-table progress of the latest run of a stage; tables are processed one after another, so the time
+# since the previous table's last checkpoint is the time spent on a table.
+TABLE_PROGRESS = """
+    SELECT c.table_name, c.rows_done,
+           EXTRACT(EPOCH FROM c.updated_at - LAG(c.updated_at, 1, r.started_at) OVER (ORDER BY c.updated_at))
+    FROM {schema}.etl_checkpoints AS c
+    JOIN {schema}.etl_runs AS r ON r.run_id = c.run_id AND r.stage = c.stage
+    WHERE c.stage = %s
+      AND c.run_id = (SELECT run_id FROM {schema}.etl_runs WHERE stage = %s ORDER BY started_at DESC LIMIT 1)
+    ORDER BY c.updated_at;
+    """
+
+
+def create_pools(databases: List[str]) -> Dict[str, ConnectionPool]:
+    """One single-connection pool per database, each counting its statements."""
+    return {name: ConnectionPool(PostgresConfig.from_env(DATABASES[name]),
+                                 PoolConfig(min_size=1, max_size=1, application_name="etl_benchmark",
+                                            connection_factory=CountingConnection))
+            for name in databases}
+
+
+def table_progress(conn, schema: str, stage: str) -> Dict[str, dict]:
+    with conn.cursor() as cursor:
+        cursor.execute(TABLE_PROGRESS.format(schema=schema), (stage, stage))
+        rows = cursor.fetchall()
+    conn.rollback()
+    return {table: {"rows": rows_done, "seconds": float(seconds or 0)} for table, rows_done, seconds in rows}
+
+
+def stage_steps(fused: bool) -> list:
+    """(name, work, databases, schema and checkpoint stage of the progress) of every ETL stage, in order."""
+    steps = []
+    if fused:
+        steps.append(("history", fused_history, ["source", "history"], ("history", "fused_history")))
+    else:
+        steps.append(("stage", load_stage("stage").transfer_data, ["source", "stage"], ("stage", "1_stage")))
+        steps.append(("history", load_stage("history").transfer_data, ["stage", "history"],
+                      ("history", "2_history")))
+    steps.append(("star", load_stage("star").load, ["history", "star"], ("star", "3_dm")))
+    return steps
+
+
+def run_stage(pools: Dict[str, ConnectionPool], work, databases: List[str], progress: tuple) -> dict:
+    """Run one stage and report its elapsed time, rows and the per-table statement totals."""
+    RECORDER.take()
+    sampler = RssSampler()
+    sampler.start()
+    connections = [pools[name].getconn() for name in databases]
+    try:
+        started = time.perf_counter()
+        work(*connections)
+        elapsed = time.perf_counter() - started
+        statements = RECORDER.take()
+        tables = table_progress(connections[-1], *progress)
+    finally:
+        sampler.stop()
+        for name, connection in zip(databases, connections):
+            pools[name].putconn(connection)
+
+    for name, done in tables.items():
+        totals = statements.setdefault(f"{progress[0]}.{name}", {})
+        totals.update(done)
+        totals["rows_per_second"] = done["rows"] / done["seconds"] if done["seconds"] else None
+    rows = sum(table["rows"] for table in tables.values())
+    return {
+        "elapsed_seconds": elapsed,
+        "rows": rows,
+        "rows_per_second": rows / elapsed if elapsed else None,
+        "round_trips": sum(totals.get("round_trips", 0) for totals in statements.values()),
+        "bytes_sent": sum(totals.get("bytes_sent", 0) for totals in statements.values()),
+        "bytes_received": sum(totals.get("bytes_received", 0) for totals in statements.values()),
+        "peak_rss_bytes": sampler.peak_bytes,
+        "tables": statements,
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the ETL stages against synthetic source data.")
+    parser.add_argument("--images", type=int, default=10000, help="synthetic images the source should hold")
+    parser.add_argument("--runs", type=int, default=3, help="ETL runs; every run after the first mutates first")
+    parser.add_argument("--mutate-percent", type=float, default=5.0,
+                        help="share of the synthetic images changed before each repeated run")
+    parser.add_argument("--new-percent", type=float, help="share of new images added before each repeated run "
+                                                          "(default: --mutate-percent)")
+    parser.add_argument("--fused", action="store_true", help="merge the source straight into history")
+    parser.add_argument("--output", default=RESULTS_FOLDER, help="folder of the JSON results")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+
+    databases = ["source", "history", "star"] if args.fused else ["source", "stage", "history", "star"]
+    pools = create_pools(databases)
+    config = config_from_args(args)
+    runs = []
+    try:
+        with pools["source"].connection() as source_conn:
+            prepare_source(source_conn)
+            set_seed(source_conn, args.seed)
+            populate(source_conn, args.images, config)
+        if "stage" in pools:
+            with pools["stage"].connection() as stage_conn:
+                prepare_stage(stage_conn)
+        with pools["history"].connection() as history_conn:
+            prepare_history(history_conn)
+        with pools["star"].connection() as star_conn:
+            prepare_star(star_conn)
+
+        for number in range(1, args.runs + 1):
+            run = {"run": number, "mutations": None, "stages": {}}
+            if number > 1 and (args.mutate_percent or args.new_percent):
+                with pools["source"].connection() as source_conn:
+                    run["mutations"] = mutate(source_conn, args.mutate_percent, args.new_percent, config)
+            for name, work, step_databases, progress in stage_steps(args.fused):
+                run["stages"][name] = result = run_stage(pools, work, step_databases, progress)
+                logging.info(f"Run {number} {name}: {result['rows']} rows in {result['elapsed_seconds']:.2f}s "
+                             f"({result['rows_per_second'] or 0:.0f} rows/s), {result['round_trips']} round trips, "
+                             f"{result['bytes_sent'] / 2 ** 20:.1f} MiB sent, "
+                             f"{result['bytes_received'] / 2 ** 20:.1f} MiB received.")
+            runs.append(run)
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "settings": vars(args),
+        "runs": runs,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"etl-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{commit}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+    logging.info(f"Benchmark results written to {path}.")
+
+
+if __name__ == '__main__':
+    main()
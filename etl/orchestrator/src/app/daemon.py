@@ -0,0 +1,206 @@
+import logging
+import os
+import signal
+import statistics
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Dict, Optional
+
+from common.changes import delete_changes, read_changes
+from common.checkpoints import RunCheckpoints
+from common.db import ConnectionPool, backoff_delay, run_with_reconnect
+from common.notifications import IMAGE_PROCESSED_CHANNEL, Listener
+from common.source import source_relation
+from common.streaming import iter_chunks
+from stages import load_stage
+
+# Rows the daemon quarantines are recorded under one run that never finishes.
+DAEMON_RUN_ID = "daemon"
+
+
+@dataclass
+class DaemonConfig:
+    poll_interval_seconds: float = 10.0
+    # After a notification, wait this long so images finishing together share a micro-batch.
+    batch_delay_seconds: float = 1.0
+    listen: bool = True
+    refresh_batch_size: int = 500
+    # Queued source changes merged per history transaction.
+    change_batch_size: int = 1000
+    latency_window: int = 500
+
+    @classmethod
+    def from_env(cls) -> "DaemonConfig":
+        return cls(
+            poll_interval_seconds=float(os.getenv("ETL_DAEMON_POLL_SECONDS", 10)),
+            batch_delay_seconds=float(os.getenv("ETL_DAEMON_BATCH_DELAY_SECONDS", 1)),
+            listen=os.getenv("ETL_DAEMON_LISTEN", "true").lower() == "true",
+            refresh_batch_size=int(os.getenv("ETL_DAEMON_REFRESH_BATCH_SIZE", 500)),
+            change_batch_size=int(os.getenv("ETL_DAEMON_CHANGE_BATCH_SIZE", 1000))
+        )
+
+
+class MicroBatchDaemon:
+    """Keeps history and the star schema up to date with the source, one small batch at a time.
+
+    Each batch merges the source rows queued in satellite_image_processing.etl_changes
+    (inserts and updates alike) into history, queueing the affected images in
+    history.etl_pending_images in the same transaction, and then refreshes the star
+    rows of the queued images only. Once per UTC day it also creates the upcoming
+    history partitions, so a long-running daemon never inserts into DEFAULT.
+    """
+
+    def __init__(self, pools: Dict[str, ConnectionPool], config: DaemonConfig):
+        self.pools = pools
+        self.config = config
+        self.history = load_stage("history")
+        self.star = load_stage("star")
+        self.started_at = datetime.now(timezone.utc)
+        self.latencies = deque(maxlen=config.latency_window)
+        self.partitions_maintained_on: Optional[date] = None
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        logging.info("Stopping the ETL daemon after the current batch.")
+        self._stop.set()
+
+    def merge_changes(self, source_conn, history_conn) -> int:
+        """Merge the source rows queued in the change queue into history and queue their images for the star.
+
+        Changes are read in change_id order, a page at a time, and the source rows
+        are read as they are now, so a row changed several times is merged once.
+        The merged entries leave the queue only after history is committed: after
+        a crash they are merged again, which adds an identical version at worst.
+        Returns the number of rows merged.
+        """
+        checkpoints = RunCheckpoints(history_conn, "history", "daemon", run_id=DAEMON_RUN_ID)
+        gate = self.history.quality_gate(checkpoints)
+        merged, after = 0, 0
+        with history_conn.cursor() as history_cursor:
+            while not self._stop.is_set():
+                change_ids, keys = read_changes(source_conn, after, self.config.change_batch_size)
+                if not change_ids:
+                    break
+                for table, key, merge_row in self.history.STAGE_TABLES:
+                    if table not in keys:
+                        continue
+                    # images carry the image_id first, every other table right after its own key
+                    image_column = 0 if table == "images" else 1
+                    query = f"SELECT * FROM {source_relation(table)} WHERE {key} = ANY(%s) ORDER BY {key};"
+                    for rows in iter_chunks(source_conn, query, (keys[table],)):
+                        checked = gate.check(history_cursor, table, rows)
+                        for row in checked:
+                            merge_row(history_cursor, row)
+                        history_cursor.execute("""
+                            INSERT INTO history.etl_pending_images (image_id)
+                            SELECT DISTINCT unnest(%s::BIGINT[])
+                            ON CONFLICT (image_id) DO NOTHING;
+                        """, ([row[image_column] for row in checked if row[image_column] is not None],))
+                        merged += len(checked)
+                    source_conn.rollback()
+                after = change_ids[-1]
+                history_conn.commit()
+                delete_changes(source_conn, change_ids)
+        return merged
+
+    def maintain_partitions(self, history_conn):
+        """Create the upcoming history partitions unless that already happened today (UTC)."""
+        today = datetime.now(timezone.utc).date()
+        if self.partitions_maintained_on == today:
+            return
+        self.history.maintain_partitions(history_conn, self.history.PartitionConfig.from_env())
+        self.partitions_maintained_on = today
+
+    def refresh_pending(self, history_conn, star_conn) -> int:
+        """Refresh the star rows of the queued images; returns the number of images refreshed."""
+        refreshed = 0
+        while True:
+            with history_conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT p.image_id, i.date_uploaded
+                    FROM history.etl_pending_images AS p
+                    LEFT JOIN history.images AS i ON i.image_id = p.image_id AND i.valid_to IS NULL
+                    ORDER BY p.image_id
+                    LIMIT %s;
+                """, (self.config.refresh_batch_size,))
+                pending = cursor.fetchall()
+            if not pending:
+                return refreshed
+
+            image_ids = [image_id for image_id, _ in pending]
+            self.star.refresh_images(history_conn, star_conn, image_ids)
+            with history_conn.cursor() as cursor:
+                cursor.execute("DELETE FROM history.etl_pending_images WHERE image_id = ANY(%s);", (image_ids,))
+            history_conn.commit()
+
+            now = datetime.now(timezone.utc)
+            # Only uploads made while the daemon runs say anything about its latency.
+            self.latencies.extend((now - uploaded).total_seconds() for _, uploaded in pending
+                                  if uploaded is not None and uploaded >= self.started_at)
+            refreshed += len(image_ids)
+
+    def run_batch(self, source_conn, history_conn, star_conn):
+        started = time.perf_counter()
+        self.maintain_partitions(history_conn)
+        merged = self.merge_changes(source_conn, history_conn)
+        refreshed = self.refresh_pending(history_conn, star_conn)
+        if refreshed:
+            self.star.refresh_rollups(star_conn)
+        if merged or refreshed:
+            message = (f"Micro-batch merged {merged} source rows and refreshed {refreshed} images "
+                       f"in {time.perf_counter() - started:.2f}s.")
+            if len(self.latencies) >= 2:
+                p95 = statistics.quantiles(self.latencies, n=20)[-1]
+                message += f" Upload-to-star latency p95 {p95:.1f}s over {len(self.latencies)} images."
+            logging.info(message)
+
+    def _wait_for_work(self, listener):
+        """Sleep until the poll interval is over, a notification arrives or the daemon is stopped."""
+        if listener is None:
+            self._stop.wait(self.config.poll_interval_seconds)
+            return
+        deadline = time.monotonic() + self.config.poll_interval_seconds
+        while not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Short waits keep the daemon responsive to a stop request.
+            if listener.wait(min(remaining, 1.0)):
+                self._stop.wait(self.config.batch_delay_seconds)
+                return
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        with self.pools["star"].connection() as star_conn:
+            self.star.populate_dim_date(2020, datetime.now().year + 1, star_conn)
+
+        listener = None
+        if self.config.listen:
+            listener = Listener(self.pools["source"].config, IMAGE_PROCESSED_CHANNEL)
+        logging.info(f"ETL daemon started (poll every {self.config.poll_interval_seconds}s, "
+                     f"{'listening for ' + IMAGE_PROCESSED_CHANNEL if listener else 'polling only'}).")
+
+        failures = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    run_with_reconnect(self.run_batch, [self.pools["source"], self.pools["history"],
+                                                        self.pools["star"]])
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    delay = backoff_delay(failures, self.config.poll_interval_seconds, 300)
+                    logging.error(f"Micro-batch failed ({failures} in a row), retrying in {delay:.1f}s: {e}")
+                    self._stop.wait(delay)
+                    continue
+
+                self._wait_for_work(listener)
+        finally:
+            if listener:
+                listener.close()
+        logging.info("ETL daemon stopped.")
@@ -0,0 +1,63 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Step:
+    name: str
+    run: Callable[[], None]
+    depends_on: List[str] = field(default_factory=list)
+
+
+class StepFailedError(Exception):
+    """Raised when a step of the DAG fails; the steps depending on it are not run."""
+
+
+def run_dag(steps: List[Step], max_parallel: int = 2) -> Dict[str, float]:
+    """Run every step once its dependencies have finished, independent steps side by side.
+
+    Returns the duration of each step in seconds.
+    """
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        missing = [name for name in step.depends_on if name not in by_name]
+        if missing:
+            raise ValueError(f"Step {step.name} depends on unknown steps: {', '.join(missing)}")
+
+    durations = {}
+    pending = dict(by_name)
+    running = {}
+
+    def timed(step: Step):
+        started = time.perf_counter()
+        step.run()
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="etl-step") as executor:
+        while pending or running:
+            ready = [step for step in pending.values() if all(name in durations for name in step.depends_on)]
+            for step in ready:
+                logger.info(f"Starting step {step.name}.")
+                running[executor.submit(timed, step)] = step
+                del pending[step.name]
+
+            if not running:
+                raise ValueError(f"Steps with circular dependencies: {', '.join(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    durations[step.name] = future.result()
+                except Exception as e:
+                    for other in running:
+                        other.cancel()
+                    raise StepFailedError(f"Step {step.name} failed: {e}") from e
+                logger.info(f"Step {step.name} finished in {durations[step.name]:.2f}s.")
+
+    return durations
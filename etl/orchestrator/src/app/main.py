@@ -0,0 +1,156 @@
+import argparse
+import logging
+import os
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from common.changes import finish_full_load, start_full_load
+from common.checkpoints import RunCheckpoints
+from common.db import ConnectionPool, PoolConfig, PostgresConfig, run_with_reconnect
+from common.logging_config import configure_logging
+from common.memory import track_peak_rss
+from common.metrics import RunMetrics, write_textfile
+from common.profiling import ProfilingConfig, add_profiling_arguments, configure_profiling, profiled
+from common.source import source_relation
+from common.migrations import apply_migrations, resolve_migrations_dir
+from daemon import DaemonConfig, MicroBatchDaemon
+from dag import Step, run_dag
+from stages import load_stage, source_migrations_dir, stage_app_folder
+
+# Environment prefix (<PREFIX>_DBNAME, <PREFIX>_HOST, ...) of every database the orchestrator talks to.
+DATABASES = {
+    "source": "SOURCE",
+    "stage": "STAGE",
+    "history": "HISTORY",
+    "star": "STAR",
+}
+
+
+LOG_FOLDER = os.path.join(os.path.dirname(__file__), 'logs')
+
+
+def setup_logging():
+    return configure_logging("orchestrator", LOG_FOLDER,
+                             text_format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+
+def create_pools(databases: List[str]) -> Dict[str, ConnectionPool]:
+    """One pool per database, shared by every step that reads or writes it."""
+    return {name: ConnectionPool(PostgresConfig.from_env(DATABASES[name]), PoolConfig.from_env("orchestrator"))
+            for name in databases}
+
+
+def prepare_source(source_conn):
+    # The change queue the daemon reads and full loads prune; normally already applied by the image processor.
+    apply_migrations(source_conn, source_migrations_dir(), "satellite_image_processing")
+
+
+def prepare_stage(stage_conn):
+    apply_migrations(stage_conn, resolve_migrations_dir(stage_app_folder("stage")), "stage")
+
+
+def prepare_history(history_conn):
+    history = load_stage("history")
+    apply_migrations(history_conn, resolve_migrations_dir(stage_app_folder("history")), "history")
+    history.maintain_partitions(history_conn, history.PartitionConfig.from_env())
+
+
+def prepare_star(star_conn):
+    apply_migrations(star_conn, resolve_migrations_dir(stage_app_folder("star")), "star")
+
+
+@profiled("history.fused_history")
+def fused_history(source_conn, history_conn):
+    """Merge the source tables straight into history, without the stage database in between."""
+    history = load_stage("history")
+    checkpoints = RunCheckpoints(history_conn, "history", "fused_history")
+    checkpoints.start_run()
+    if checkpoints.completed:
+        return
+    horizon = start_full_load(checkpoints, source_conn)
+
+    gate = history.quality_gate(checkpoints)
+    for table, key, merge_row in history.STAGE_TABLES:
+        query = f"SELECT * FROM {source_relation(table)} WHERE {key} > %s ORDER BY {key};"
+        history.merge_table(source_conn, history_conn, checkpoints, table, key, merge_row, query=query, gate=gate)
+    gate.log_summary()
+    finish_full_load(checkpoints, source_conn, horizon)
+    checkpoints.finish_run()
+
+
+def with_connections(pools: Dict[str, ConnectionPool], work, *databases):
+    """Wrap `work` so it runs with one connection from each named pool, retried after a disconnect."""
+    return lambda: run_with_reconnect(work, [pools[name] for name in databases])
+
+
+def prepare_steps(pools: Dict[str, ConnectionPool]) -> List[Step]:
+    return [
+        Step("prepare_source", with_connections(pools, prepare_source, "source")),
+        Step("prepare_history", with_connections(pools, prepare_history, "history")),
+        Step("prepare_star", with_connections(pools, prepare_star, "star")),
+    ]
+
+
+def build_steps(pools: Dict[str, ConnectionPool], fused: bool, write_stage: bool) -> List[Step]:
+    copy_to_stage = with_connections(pools, load_stage("stage").transfer_data, "source", "stage")
+    steps = prepare_steps(pools)
+    if not fused or write_stage:
+        steps.append(Step("prepare_stage", with_connections(pools, prepare_stage, "stage")))
+    if fused:
+        steps.append(Step("history", with_connections(pools, fused_history, "source", "history"),
+                          ["prepare_source", "prepare_history"]))
+        if write_stage:
+            # Only for debugging: nothing downstream reads the stage tables in fused mode.
+            steps.append(Step("stage", copy_to_stage, ["prepare_source", "prepare_stage"]))
+    else:
+        steps.append(Step("stage", copy_to_stage, ["prepare_source", "prepare_stage"]))
+        steps.append(Step("history", with_connections(pools, load_stage("history").transfer_data, "stage", "history"),
+                          ["stage", "prepare_history"]))
+    steps.append(Step("star", with_connections(pools, load_stage("star").load, "history", "star"),
+                      ["history", "prepare_star"]))
+    return steps
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the ETL stages in one process.")
+    parser.add_argument("--fused", action="store_true", default=os.getenv("ETL_FUSED", "").lower() == "true",
+                        help="merge the source straight into history instead of going through the stage database")
+    parser.add_argument("--write-stage", action="store_true",
+                        default=os.getenv("ETL_WRITE_STAGE", "").lower() == "true",
+                        help="in fused mode, still fill the stage tables for debugging")
+    parser.add_argument("--daemon", action="store_true", default=os.getenv("ETL_DAEMON", "").lower() == "true",
+                        help="keep running and push new source rows through history and star in micro-batches")
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+
+    setup_logging()
+    configure_profiling(LOG_FOLDER, ProfilingConfig.from_args(args))
+
+    databases = ["source", "history", "star"]
+    if not (args.fused or args.daemon) or args.write_stage:
+        databases.append("stage")
+    pools = create_pools(databases)
+    try:
+        if args.daemon:
+            run_dag(prepare_steps(pools))
+            MicroBatchDaemon(pools, DaemonConfig.from_env()).run()
+            return
+        metrics = RunMetrics("orchestrator")
+        with track_peak_rss("orchestrator"):
+            durations = run_dag(build_steps(pools, args.fused, args.write_stage))
+        logging.info(f"ETL run completed: {', '.join(f'{name} {seconds:.2f}s' for name, seconds in durations.items())}")
+        for name, seconds in durations.items():
+            metrics.record(f"step.{name}", seconds)
+        write_textfile(metrics)
+    except Exception as e:
+        logging.error(f"ETL run failed: {e}")
+        raise
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+
+if __name__ == '__main__':
+    main()
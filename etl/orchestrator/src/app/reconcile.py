@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from main import DATABASES
+
+# Every other layer is compared with the source.
+REFERENCE = "source"
+
+
+@dataclass
+class Layer:
+    """Where a database keeps a table: the rows, their key and the columns every layer can render identically."""
+    database: str
+    relation: str
+    key: str
+    columns: Sequence[str]
+    condition: str = "TRUE"
+
+    def rows(self) -> str:
+        return (f"SELECT {self.key} AS key, md5(ROW({', '.join(self.columns)})::TEXT) AS hash "
+                f"FROM {self.relation} WHERE {self.condition}")
+
+
+# Normalizations to what the narrowest layer keeps: the star stores DECIMAL(10, 5) and integer boxes, history and
+# the star hold the sha256 of blobs, and the stage holds everything as text.
+def rounded(column: str) -> str:
+    return f"round(({column})::NUMERIC, 5)"
+
+
+def truncated(column: str) -> str:
+    return f"trunc(({column})::DOUBLE PRECISION)::BIGINT"
+
+
+def epoch(column: str) -> str:
+    return f"extract(EPOCH FROM ({column})::TIMESTAMPTZ)"
+
+
+def sha256_hex(column: str) -> str:
+    return f"encode(sha256(({column})::BYTEA), 'hex')"
+
+
+def latest_coordinates(schema: str, cast: str = "") -> str:
+    """History keeps one current coordinate per image, the last one merged."""
+    return (f"(SELECT DISTINCT ON (image_id{cast}) image_id{cast} AS image_id, latitude, longitude "
+            f"FROM {schema}.coordinates WHERE image_id IS NOT NULL "
+            f"ORDER BY image_id{cast}, coordinates_id{cast} DESC) AS c")
+
+
+# Logical table -> layer -> how the layer holds it.
+TABLES: Dict[str, Dict[str, Layer]] = {
+    "images": {
+        "source": Layer("source", "satellite_image_processing.images", "image_id",
+                        ["width", "height", "filename", sha256_hex("image_data")]),
+        "stage": Layer("stage", "stage.images", "image_id::BIGINT",
+                       ["width::INT", "height::INT", "filename", sha256_hex("image_data")]),
+        "history": Layer("history", "history.images", "image_id",
+                         ["width", "height", "filename", "image_data_sha256"], "valid_to IS NULL"),
+        "star": Layer("star", "star.dim_images", "image_id",
+                      ["width", "height", "filename", "image_data_sha256"]),
+    },
+    "coordinates": {
+        "source": Layer("source", latest_coordinates("satellite_image_processing"), "image_id",
+                        [rounded("latitude"), rounded("longitude")]),
+        "stage": Layer("stage", latest_coordinates("stage", "::BIGINT"), "image_id",
+                       [rounded("latitude"), rounded("longitude")]),
+        "history": Layer("history", "history.coordinates", "image_id",
+                         [rounded("latitude"), rounded("longitude")], "valid_to IS NULL"),
+        "star": Layer("star", "star.dim_images", "image_id", [rounded("latitude"), rounded("longitude")]),
+    },
+    "predictions_roof_type": {
+        layer: Layer(layer, relation, key, ["class_name", rounded("time_taken"), rounded("confidence"),
+                                            "prediction_type", epoch("date_processed")], condition)
+        for layer, relation, key, condition in (
+            ("source", "satellite_image_processing.predictions_roof_type", "prediction_id", "TRUE"),
+            ("stage", "stage.predictions_roof_type", "prediction_id::BIGINT", "TRUE"),
+            ("history", "history.predictions_roof_type", "prediction_id", "valid_to IS NULL"),
+            ("star", "star.dim_predictions_roof_type", "prediction_id", "TRUE"))
+    },
+    "detection_solar_panel": {
+        layer: Layer(layer, relation, key, ["class_name", rounded("confidence"), truncated("x"), truncated("y"),
+                                            truncated("width"), truncated("height"), blob,
+                                            epoch("date_processed")], condition)
+        for layer, relation, key, blob, condition in (
+            # The stored hash of the shared annotated image (source migration V003), else the hash of an inline one.
+            ("source", "satellite_image_processing.detection_solar_panel", "detection_id",
+             f"COALESCE(image_sha256, {sha256_hex('image_data')})", "TRUE"),
+            ("stage", "stage.detection_solar_panel", "detection_id::BIGINT", sha256_hex("image_data"), "TRUE"),
+            ("history", "history.detection_solar_panel", "detection_id", "image_data_sha256", "valid_to IS NULL"),
+            ("star", "star.dim_detections_solar_panel", "detection_id", "image_data_sha256", "TRUE"))
+    },
+}
+
+KEY_BOUNDS = "SELECT min(t.key), max(t.key) FROM ({rows}) AS t;"
+
+# Row count and an order-independent sum of the row hashes of every `width` keys inside the given spans.
+RANGE_HASHES = """
+    SELECT t.key / %(width)s, count(*), sum(('x' || left(t.hash, 15))::BIT(60)::BIGINT)
+    FROM unnest(%(lows)s::BIGINT[]) AS r(low)
+    JOIN ({rows}) AS t ON t.key >= r.low AND t.key < r.low + %(span)s
+    GROUP BY 1;
+    """
+
+KEY_HASHES = """
+    SELECT t.key, t.hash
+    FROM unnest(%(lows)s::BIGINT[]) AS r(low)
+    JOIN ({rows}) AS t ON t.key >= r.low AND t.key < r.low + %(span)s;
+    """
+
+
+@dataclass
+class ReconcileConfig:
+    # Keys per range of the first pass; a mismatched range is split into `fanout` ranges, down to `leaf_size`
+    # keys, whose rows are then compared key by key.
+    range_size: int = 100000
+    fanout: int = 100
+    leaf_size: int = 1000
+    workers: int = 8
+    max_keys: int = 1000
+
+
+class Reconciler:
+    """Compares the tables of the pipeline layers with the source without moving their rows.
+
+    Each database hashes its rows and sums the hashes per key range, in parallel
+    across layers and key spans; only ranges whose count or sum differ from the
+    source are split further, and the smallest ones are compared key by key.
+    """
+
+    def __init__(self, pools: Dict[str, ConnectionPool], config: ReconcileConfig):
+        self.pools = pools
+        self.config = config
+        self.executor = ThreadPoolExecutor(max_workers=config.workers, thread_name_prefix="reconcile")
+
+    def _query(self, layer: Layer, query: str, params: dict) -> list:
+        with self.pools[layer.database].connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query.format(rows=layer.rows()), params)
+                rows = cursor.fetchall()
+            connection.rollback()
+        return rows
+
+    def _run(self, jobs: List[Tuple[str, Layer, str, dict]]) -> Dict[str, list]:
+        """Run (layer name, layer, query, params) jobs in parallel; returns the rows of each layer."""
+        futures = [(name, self.executor.submit(self._query, layer, query, params))
+                   for name, layer, query, params in jobs]
+        results: Dict[str, list] = {name: [] for name, _, _, _ in jobs}
+        for name, future in futures:
+            results[name].extend(future.result())
+        return results
+
+    def _split(self, lows: List[int]) -> List[List[int]]:
+        """Spread range starts over the workers, keeping neighbouring ranges together."""
+        parts = max(1, min(self.config.workers, len(lows)))
+        size = -(-len(lows) // parts)
+        return [lows[index:index + size] for index in range(0, len(lows), size)]
+
+    def _jobs(self, layers: Dict[str, Layer], query: str, lows: List[int], span: int, width: int = 1) -> list:
+        return [(name, layer, query, {"lows": part, "span": span, "width": width})
+                for name, layer in layers.items() for part in self._split(lows)]
+
+    def _first_ranges(self, layers: Dict[str, Layer]) -> Tuple[List[int], int]:
+        """Start keys and width of spans covering every key of every layer, a few per worker."""
+        bounds = self._run([(name, layer, KEY_BOUNDS, {}) for name, layer in layers.items()])
+        lows = [row[0] for rows in bounds.values() for row in rows if row[0] is not None]
+        highs = [row[1] for rows in bounds.values() for row in rows if row[1] is not None]
+        if not lows:
+            return [], self.config.range_size
+        width = self.config.range_size
+        first, last = min(lows) // width * width, max(highs) // width * width + width
+        ranges = (last - first) // width
+        span = -(-ranges // (self.config.workers * 4)) * width
+        return list(range(first, last, span)), span
+
+    def reconcile(self, table: str, layer_names: Sequence[str]) -> dict:
+        layers = {name: TABLES[table][name] for name in [REFERENCE, *layer_names]}
+        lows, span = self._first_ranges(layers)
+        width = self.config.range_size
+        report = {"table": table, "rows": {}, "mismatched_ranges": [], "divergent_keys": [], "truncated": False}
+
+        while lows:
+            hashes = self._range_hashes(self._run(self._jobs(layers, RANGE_HASHES, lows, span, width)))
+            if not report["rows"]:
+                report["rows"] = {name: sum(count for count, _ in ranges.values()) for name, ranges in hashes.items()}
+            mismatched = sorted({bucket for name in layer_names
+                                 for bucket in hashes[name].keys() | hashes[REFERENCE].keys()
+                                 if hashes[name].get(bucket) != hashes[REFERENCE].get(bucket)})
+            report["mismatched_ranges"].append({"width": width, "ranges": len(mismatched)})
+            lows, span = [bucket * width for bucket in mismatched], width
+            if width <= self.config.leaf_size:
+                break
+            width = max(width // self.config.fanout, 1)
+
+        if lows:
+            keys = self._run(self._jobs(layers, KEY_HASHES, lows, span))
+            report["divergent_keys"], report["truncated"] = self._compare_keys(keys, layer_names)
+        return report
+
+    @staticmethod
+    def _range_hashes(results: Dict[str, list]) -> Dict[str, Dict[int, tuple]]:
+        return {name: {bucket: (count, total) for bucket, count, total in rows} for name, rows in results.items()}
+
+    def _compare_keys(self, results: Dict[str, list], layer_names: Sequence[str]) -> Tuple[List[dict], bool]:
+        hashes = {name: dict(rows) for name, rows in results.items()}
+        source = hashes[REFERENCE]
+        divergent = []
+        for key in sorted(set().union(*(hashes[name].keys() for name in hashes))):
+            for name in layer_names:
+                expected, actual = source.get(key), hashes[name].get(key)
+                if expected == actual:
+                    continue
+                status = "missing" if actual is None else "extra" if expected is None else "different"
+                divergent.append({"key": key, "layer": name, "status": status})
+                if len(divergent) >= self.config.max_keys:
+                    return divergent, True
+        return divergent, False
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def log_report(report: dict):
+    rows = ", ".join(f"{name} {count}" for name, count in report["rows"].items())
+    table = report["table"]
+    if not report["divergent_keys"]:
+        logging.info(f"{table}: all layers match the source ({rows} rows).")
+        return
+    by_status: Dict[Tuple[str, str], List[int]] = {}
+    for entry in report["divergent_keys"]:
+        by_status.setdefault((entry["layer"], entry["status"]), []).append(entry["key"])
+    for (layer, status), keys in sorted(by_status.items()):
+        shown = ", ".join(str(key) for key in keys[:20]) + (", ..." if len(keys) > 20 else "")
+        logging.warning(f"{table}: {len(keys)} keys {status} in {layer}: {shown}")
+    if report["truncated"]:
+        logging.warning(f"{table}: stopped after {len(report['divergent_keys'])} divergent keys.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that stage, history and star match the source, "
+                                                 "reporting the keys that diverge.")
+    parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=list(TABLES))
+    parser.add_argument("--layers", nargs="+", choices=["stage", "history", "star"], default=["history", "star"],
+                        help="layers compared with the source; the stage only matches right after 1_Stage")
+    parser.add_argument("--range-size", type=int, default=ReconcileConfig.range_size,
+                        help="keys per range of the first pass")
+    parser.add_argument("--fanout", type=int, default=ReconcileConfig.fanout,
+                        help="ranges a mismatched range is split into")
+    parser.add_argument("--leaf-size", type=int, default=ReconcileConfig.leaf_size,
+                        help="widest range compared key by key")
+    parser.add_argument("--workers", type=int, default=ReconcileConfig.workers,
+                        help="queries running at the same time, spread over the databases")
+    parser.add_argument("--max-keys", type=int, default=ReconcileConfig.max_keys,
+                        help="divergent keys reported per table")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+
+    config = ReconcileConfig(range_size=args.range_size, fanout=max(args.fanout, 2), leaf_size=args.leaf_size,
+                             workers=args.workers, max_keys=args.max_keys)
+    pools = {name: ConnectionPool(PostgresConfig.from_env(DATABASES[name]),
+                                  PoolConfig(min_size=1, max_size=config.workers, application_name="etl_reconcile"))
+             for name in [REFERENCE, *args.layers]}
+    reconciler = Reconciler(pools, config)
+    reports = []
+    try:
+        for table in args.tables:
+            started = datetime.now(timezone.utc)
+            report = reconciler.reconcile(table, args.layers)
+            report["seconds"] = (datetime.now(timezone.utc) - started).total_seconds()
+            log_report(report)
+            reports.append(report)
+    finally:
+        reconciler.close()
+        for pool in pools.values():
+            pool.close()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"created_at": datetime.now(timezone.utc).isoformat(), "layers": args.layers,
+                       "tables": reports}, file, indent=2, default=str)
+        logging.info(f"Reconciliation report written to {args.output}.")
+    sys.exit(1 if any(report["divergent_keys"] for report in reports) else 0)
+
+
+if __name__ == '__main__':
+    main()
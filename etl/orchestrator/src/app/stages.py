@@ -0,0 +1,54 @@
+import importlib.util
+import os
+import sys
+import threading
+
+# Folder of each ETL stage below the etl root; every stage app is a main.py next to its helper modules.
+STAGE_FOLDERS = {
+    "stage": "1_Stage",
+    "history": "2_History",
+    "star": "3_DM",
+}
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def etl_root() -> str:
+    """The etl/ folder: ETL_ROOT when set, else two levels above this service's src folder."""
+    return os.getenv("ETL_ROOT") or os.path.abspath(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+
+
+def stage_app_folder(stage: str) -> str:
+    return os.path.join(etl_root(), STAGE_FOLDERS[stage], "src", "app")
+
+
+def source_migrations_dir() -> str:
+    """Migrations of the source schema, owned by the image processor next to the etl/ folder."""
+    return os.path.join(etl_root(), "..", "app_satellite_image_processing", "postgres", "sql", "migrations")
+
+
+def load_stage(stage: str):
+    """Import the main module of a stage under its own name; all stages call their entry module main.py."""
+    with _lock:
+        if stage not in _loaded:
+            _loaded[stage] = _import_stage(stage)
+        return _loaded[stage]
+
+
+def _import_stage(stage: str):
+    folder = stage_app_folder(stage)
+    module_name = f"etl_{STAGE_FOLDERS[stage].lower()}"
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(folder, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+
+    # The stage imports its helper modules (partitions.py, ...) by their bare names.
+    sys.path.insert(0, folder)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(folder)
+
+    sys.modules[module_name] = module
+    return module
@@ -0,0 +1,143 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from typing import Dict
+
+import psycopg2.extensions
+
+from common.metrics import rows_size
+
+# The first schema-qualified name of a statement is the table it is charged to.
+TABLE_NAME = re.compile(r"\b(satellite_image_processing|stage|history|star)\.(\w+)", re.IGNORECASE)
+UNATTRIBUTED = "other"
+
+
+@dataclass
+class TableStats:
+    round_trips: int = 0
+    statements: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    db_seconds: float = 0.0
+
+
+class StatementRecorder:
+    """Round trips, bytes and database time of every statement, summed per table."""
+
+    def __init__(self):
+        self._tables: Dict[str, TableStats] = defaultdict(TableStats)
+        self._lock = threading.Lock()
+
+    def record(self, table: str, round_trips: int = 1, statements: int = 0, sent: int = 0, received: int = 0,
+               seconds: float = 0.0):
+        with self._lock:
+            stats = self._tables[table]
+            stats.round_trips += round_trips
+            stats.statements += statements
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.db_seconds += seconds
+
+    def take(self) -> Dict[str, dict]:
+        """Return the totals recorded since the last call and start over."""
+        with self._lock:
+            tables, self._tables = self._tables, defaultdict(TableStats)
+        return {table: asdict(stats) for table, stats in sorted(tables.items())}
+
+
+RECORDER = StatementRecorder()
+
+
+def table_of(query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    match = TABLE_NAME.search(str(query))
+    return match.group(0).lower() if match else UNATTRIBUTED
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor charging each statement and each server-side fetch to the table it reads or writes.
+
+    Bytes sent are the exact statement text with its parameters, bytes received
+    are estimated from the fetched values.
+    """
+
+    _table = UNATTRIBUTED
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._table = table_of(self.query or query)
+            RECORDER.record(self._table, statements=1, sent=len(self.query or b""),
+                            seconds=time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._table = table_of(query)
+            # psycopg2 sends one statement per parameter set.
+            RECORDER.record(self._table, round_trips=len(vars_list), statements=len(vars_list),
+                            sent=len(self.query or b"") * len(vars_list), seconds=time.perf_counter() - started)
+
+    def _fetched(self, rows, started: float):
+        received = rows_size(rows)
+        # A named cursor goes to the server for every fetch, an ordinary one got its rows with the statement.
+        RECORDER.record(self._table, round_trips=1 if self.name else 0, received=received,
+                        seconds=time.perf_counter() - started if self.name else 0.0)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched([row] if row is not None else [], started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(rows, started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(rows, started)
+        return rows
+
+    def __iter__(self):
+        # Same batching as psycopg2's own iteration: itersize rows per server round trip.
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection whose cursors feed RECORDER; pass it as PoolConfig.connection_factory."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+
+    def _end_transaction(self, end):
+        if self.status != psycopg2.extensions.STATUS_BEGIN:
+            # Nothing to end, psycopg2 does not go to the server.
+            return end()
+        started = time.perf_counter()
+        try:
+            return end()
+        finally:
+            RECORDER.record("transaction", seconds=time.perf_counter() - started)
+
+    def commit(self):
+        return self._end_transaction(super().commit)
+
+    def rollback(self):
+        return self._end_transaction(super().rollback)
@@ -0,0 +1,277 @@
+import argparse
+import logging
+from dataclasses import dataclass
+from io import BytesIO
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from PIL import Image, ImageFilter
+
+from common.db import ConnectionPool, PoolConfig, PostgresConfig
+from common.migrations import apply_migrations
+from stages import source_migrations_dir
+
+SYNTHETIC_PREFIX = "synthetic_"
+# LIKE pattern of the synthetic filenames, with the underscore escaped.
+SYNTHETIC_PATTERN = "synthetic\\_%"
+ROOF_CLASSES = ["flat", "gable", "hip", "complex"]
+ROOF_TYPE_PROJECT = "roof-type-classifier-bafod"
+
+# A real image padded with random bytes to about `kib` KiB (+-50%). Decoders stop at the end of the image, so
+# thumbnails work, while the random tail makes every blob unique and incompressible like real JPEG and PNG files.
+RANDOM_BLOB = """
+    (SELECT %(template)s || decode(string_agg(md5(random()::TEXT || block || '/' || {seed}), ''), 'hex')
+     FROM generate_series(1, GREATEST(1, ((%(kib)s * 1024 * (0.5 + random()) - length(%(template)s)) / 16)::INT))
+         AS block)
+    """
+
+
+@dataclass
+class SyntheticConfig:
+    image_kib: int = 64
+    # Annotated overlays are PNGs, larger than the JPEG tiles.
+    overlay_kib: int = 96
+    max_detections: int = 4
+    batch_size: int = 1000
+
+
+def image_template(image_format: str, size: int = 640) -> bytes:
+    """A size x size image of blurred noise encoded as `image_format`; JPEG is about 9 KiB, PNG about 80 KiB."""
+    image = Image.effect_noise((size, size), 4).convert("RGB").filter(ImageFilter.GaussianBlur(2))
+    output = BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+def synthetic_image_count(conn) -> int:
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM satellite_image_processing.images WHERE filename LIKE %s;",
+                       (SYNTHETIC_PATTERN,))
+        return cursor.fetchone()[0]
+
+
+def next_synthetic_number(conn) -> int:
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT COALESCE(MAX(substring(filename FROM '^{SYNTHETIC_PREFIX}(\\d+)')::BIGINT), 0) + 1
+            FROM satellite_image_processing.images WHERE filename LIKE %s;
+        """, (SYNTHETIC_PATTERN,))
+        return cursor.fetchone()[0]
+
+
+def insert_batch(cursor, first: int, last: int, config: SyntheticConfig) -> List[int]:
+    """Insert images first..last with their coordinates, roof predictions and detections; returns the image ids.
+
+    The rows are generated server side, so only the statements cross the network.
+    """
+    cursor.execute(f"""
+        INSERT INTO satellite_image_processing.images (width, height, filename, image_data, date_uploaded)
+        SELECT 640, 640, '{SYNTHETIC_PREFIX}' || g || '.jpg', {RANDOM_BLOB.format(seed='g')},
+               NOW() - random() * INTERVAL '365 days'
+        FROM generate_series(%(first)s, %(last)s) AS g
+        RETURNING image_id;
+    """, {"first": first, "last": last, "kib": config.image_kib, "template": image_template("JPEG")})
+    image_ids = [row[0] for row in cursor.fetchall()]
+
+    # Somewhere in Hungary.
+    cursor.execute("""
+        INSERT INTO satellite_image_processing.coordinates (image_id, latitude, longitude)
+        SELECT image_id, 45.8 + random() * 2.7, 16.1 + random() * 6.8
+        FROM unnest(%s::BIGINT[]) AS image_id;
+    """, (image_ids,))
+
+    cursor.execute("""
+        INSERT INTO satellite_image_processing.predictions_roof_type
+            (image_id, class_name, time_taken, confidence, prediction_type, date_processed)
+        SELECT i.image_id, c.class_name, 0.05 + random() * 0.3, random(), %s, i.date_uploaded + INTERVAL '1 minute'
+        FROM satellite_image_processing.images AS i
+        CROSS JOIN unnest(%s::TEXT[]) AS c(class_name)
+        WHERE i.image_id = ANY(%s)
+        ORDER BY i.image_id;
+    """, (ROOF_TYPE_PROJECT, ROOF_CLASSES, image_ids))
+
+    # One overlay per image, stored once and referenced by all of its boxes like the processor does; images without
+    # a box get the processor's placeholder row.
+    cursor.execute(f"""
+        WITH boxes AS MATERIALIZED (
+            SELECT image_id, date_uploaded, floor(random() * (%(max_detections)s + 1))::INT AS boxes
+            FROM satellite_image_processing.images
+            WHERE image_id = ANY(%(image_ids)s)
+        ), blobs AS MATERIALIZED (
+            SELECT b.*, CASE WHEN b.boxes > 0 THEN {RANDOM_BLOB.format(seed='b.image_id')} END AS blob
+            FROM boxes AS b
+        ), overlays AS MATERIALIZED (
+            SELECT b.*, encode(sha256(b.blob), 'hex') AS overlay FROM blobs AS b
+        ), stored AS (
+            INSERT INTO satellite_image_processing.annotated_images (sha256, image_data)
+            SELECT overlay, blob FROM overlays WHERE blob IS NOT NULL
+            ON CONFLICT (sha256) DO NOTHING
+        )
+        INSERT INTO satellite_image_processing.detection_solar_panel
+            (image_id, class_name, confidence, x, y, width, height, image_sha256, date_processed)
+        SELECT image_id, class_name, confidence, x, y, width, height, overlay, date_processed
+        FROM (
+            -- x and y are box centres, like the processor stores them, and every box lies inside the 640px image.
+            SELECT o.image_id, 'solar-panel' AS class_name, 0.4 + random() * 0.6 AS confidence,
+                   s.width / 2 + random() * (640 - s.width) AS x, s.height / 2 + random() * (640 - s.height) AS y,
+                   s.width, s.height, o.overlay, o.date_uploaded + INTERVAL '2 minutes' AS date_processed
+            FROM overlays AS o CROSS JOIN generate_series(1, o.boxes)
+            CROSS JOIN LATERAL (SELECT 10 + random() * 60 AS width, 10 + random() * 60 AS height) AS s
+            UNION ALL
+            SELECT o.image_id, 'No predictions', 0, 0, 0, 0, 0, NULL, o.date_uploaded + INTERVAL '2 minutes'
+            FROM overlays AS o WHERE o.boxes = 0
+        ) AS detections
+        ORDER BY image_id;
+    """, {"max_detections": config.max_detections, "image_ids": image_ids, "kib": config.overlay_kib,
+          "template": image_template("PNG")})
+    return image_ids
+
+
+def generate_images(conn, count: int, config: SyntheticConfig) -> int:
+    """Append `count` synthetic images, committing every batch; returns the number inserted."""
+    number = next_synthetic_number(conn)
+    last = number + count - 1
+    inserted = 0
+    with conn.cursor() as cursor:
+        while number <= last:
+            batch_last = min(number + config.batch_size - 1, last)
+            inserted += len(insert_batch(cursor, number, batch_last, config))
+            conn.commit()
+            number = batch_last + 1
+            logging.info(f"Generated {inserted}/{count} synthetic images.")
+    return inserted
+
+
+def populate(conn, images: int, config: SyntheticConfig) -> int:
+    """Top the synthetic images up to `images`; returns the number added."""
+    missing = images - synthetic_image_count(conn)
+    if missing <= 0:
+        logging.info(f"Already {images} or more synthetic images, nothing to generate.")
+        return 0
+    return generate_images(conn, missing, config)
+
+
+def mutate(conn, percent: float, new_percent: Optional[float], config: SyntheticConfig) -> dict:
+    """Change the rows of `percent`% of the synthetic images and add `new_percent`% new ones.
+
+    Moved coordinates, re-scored predictions and detections are what the
+    image processor produces when it reprocesses a tile; history records them
+    as new SCD2 versions and the star schema refreshes the affected images.
+    """
+    new_percent = percent if new_percent is None else new_percent
+    changes = {}
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMP TABLE synthetic_mutated ON COMMIT DROP AS
+            SELECT image_id FROM satellite_image_processing.images
+            WHERE filename LIKE %s AND random() < %s / 100.0;
+        """, (SYNTHETIC_PATTERN, percent))
+        changes["images"] = cursor.rowcount
+        cursor.execute("""
+            UPDATE satellite_image_processing.coordinates AS c
+            SET latitude = latitude + (random() - 0.5) * 0.001, longitude = longitude + (random() - 0.5) * 0.001
+            FROM synthetic_mutated AS m WHERE c.image_id = m.image_id;
+        """)
+        changes["coordinates"] = cursor.rowcount
+        cursor.execute("""
+            UPDATE satellite_image_processing.predictions_roof_type AS p
+            SET confidence = random(), date_processed = NOW()
+            FROM synthetic_mutated AS m WHERE p.image_id = m.image_id;
+        """)
+        changes["predictions_roof_type"] = cursor.rowcount
+        cursor.execute("""
+            UPDATE satellite_image_processing.detection_solar_panel AS d
+            SET confidence = 0.4 + random() * 0.6, date_processed = NOW()
+            FROM synthetic_mutated AS m WHERE d.image_id = m.image_id AND d.image_sha256 IS NOT NULL;
+        """)
+        changes["detection_solar_panel"] = cursor.rowcount
+    conn.commit()
+
+    added = round(synthetic_image_count(conn) * new_percent / 100)
+    changes["new_images"] = generate_images(conn, added, config) if added else 0
+    logging.info(f"Mutated {changes['images']} synthetic images ({changes['coordinates']} coordinates, "
+                 f"{changes['predictions_roof_type']} predictions, {changes['detection_solar_panel']} detections) "
+                 f"and added {changes['new_images']}.")
+    return changes
+
+
+def clear(conn) -> int:
+    """Delete every synthetic image and the rows that reference it; returns the number of images."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMP TABLE synthetic_images ON COMMIT DROP AS
+            SELECT image_id FROM satellite_image_processing.images WHERE filename LIKE %s;
+        """, (SYNTHETIC_PATTERN,))
+        for table in ["coordinates", "predictions_roof_type", "detection_solar_panel"]:
+            cursor.execute(f"DELETE FROM satellite_image_processing.{table} AS t USING synthetic_images AS s "
+                           f"WHERE t.image_id = s.image_id;")
+        cursor.execute("DELETE FROM satellite_image_processing.images AS t USING synthetic_images AS s "
+                       "WHERE t.image_id = s.image_id;")
+        removed = cursor.rowcount
+        cursor.execute("""
+            DELETE FROM satellite_image_processing.annotated_images AS a
+            WHERE NOT EXISTS (SELECT 1 FROM satellite_image_processing.detection_solar_panel AS d
+                              WHERE d.image_sha256 = a.sha256);
+        """)
+    conn.commit()
+    logging.info(f"Removed {removed} synthetic images.")
+    return removed
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--image-kib", type=int, default=SyntheticConfig.image_kib,
+                        help="average size of an image blob in KiB")
+    parser.add_argument("--overlay-kib", type=int, default=SyntheticConfig.overlay_kib,
+                        help="average size of a detection overlay blob in KiB")
+    parser.add_argument("--max-detections", type=int, default=SyntheticConfig.max_detections,
+                        help="upper bound of solar panel boxes per image")
+    parser.add_argument("--batch-size", type=int, default=SyntheticConfig.batch_size,
+                        help="images generated per transaction")
+    parser.add_argument("--seed", type=float, help="random seed in [-1, 1] for a reproducible data set")
+
+
+def config_from_args(args) -> SyntheticConfig:
+    return SyntheticConfig(image_kib=args.image_kib, overlay_kib=args.overlay_kib,
+                           max_detections=args.max_detections, batch_size=args.batch_size)
+
+
+def set_seed(conn, seed: Optional[float]):
+    if seed is not None:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT setseed(%s);", (seed,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the source schema with synthetic images for ETL benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="top the synthetic images up to --images")
+    generate_parser.add_argument("--images", type=int, required=True)
+    add_config_arguments(generate_parser)
+    mutate_parser = commands.add_parser("mutate", help="change a percentage of the synthetic images")
+    mutate_parser.add_argument("--percent", type=float, required=True, help="share of images whose rows change")
+    mutate_parser.add_argument("--new-percent", type=float, help="share of new images to add (default: --percent)")
+    add_config_arguments(mutate_parser)
+    commands.add_parser("clear", help="delete every synthetic image")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    pool = ConnectionPool(PostgresConfig.from_env("SOURCE"), PoolConfig(min_size=1, max_size=1,
+                                                                        application_name="synthetic_data"))
+    try:
+        with pool.connection() as conn:
+            apply_migrations(conn, source_migrations_dir(), "satellite_image_processing")
+            if args.command == "clear":
+                clear(conn)
+                return
+            set_seed(conn, args.seed)
+            if args.command == "generate":
+                populate(conn, args.images, config_from_args(args))
+            else:
+                mutate(conn, args.percent, args.new_percent, config_from_args(args))
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+CONTROL_TABLES_MIGRATION = os.path.join(os.path.dirname(__file__), "..", "..", "etl", "2_History", "postgres", "sql",
+                                        "migrations", "V009__etl_control_tables.sql")
+
+
+@pytest.fixture
+def checkpoint_schema(db_schema):
+    """A scratch schema holding the RunCheckpoints control tables of the history migrations."""
+    connection, schema = db_schema
+    with open(CONTROL_TABLES_MIGRATION) as file:
+        migration = file.read().replace("history.", f"{schema}.")
+    with connection.cursor() as cursor:
+        cursor.execute(migration)
+    connection.commit()
+    return connection, schema
@@ -0,0 +1,56 @@
+import pytest
+
+from common.checkpoints import RunCheckpoints
+
+
+@pytest.fixture(autouse=True)
+def no_textfile(monkeypatch):
+    monkeypatch.delenv("METRICS_TEXTFILE_DIR", raising=False)
+    monkeypatch.delenv("ETL_RUN_ID", raising=False)
+
+
+def test_an_unfinished_run_resumes_from_its_committed_checkpoints(checkpoint_schema):
+    connection, schema = checkpoint_schema
+    first = RunCheckpoints(connection, schema, "1_stage")
+    run_id = first.start_run()
+    assert not first.resumed
+    first.save("images", 500, 500)
+    connection.commit()
+    first.save("images", 1000, 1000)
+    connection.rollback()
+
+    second = RunCheckpoints(connection, schema, "1_stage")
+    assert second.start_run() == run_id
+    assert second.resumed and not second.completed
+    assert second.table_state("images") == (500, 500, False)
+    assert second.table_state("coordinates") == (0, 0, False)
+
+
+def test_a_completed_run_is_not_repeated(checkpoint_schema):
+    connection, schema = checkpoint_schema
+    checkpoints = RunCheckpoints(connection, schema, "1_stage")
+    run_id = checkpoints.start_run()
+    checkpoints.save("images", 10, 10, completed=True)
+    checkpoints.finish_run()
+
+    again = RunCheckpoints(connection, schema, "1_stage")
+    assert again.start_run(run_id) == run_id
+    assert again.completed
+
+    fresh = RunCheckpoints(connection, schema, "1_stage")
+    assert fresh.start_run() != run_id
+    assert not fresh.resumed
+    assert fresh.table_state("images") == (0, 0, False)
+
+
+def test_runs_of_other_stages_are_left_alone(checkpoint_schema, monkeypatch):
+    connection, schema = checkpoint_schema
+    stage_run = RunCheckpoints(connection, schema, "1_stage").start_run()
+
+    history = RunCheckpoints(connection, schema, "2_history")
+    assert history.start_run() != stage_run
+
+    monkeypatch.setenv("ETL_RUN_ID", "nightly")
+    named = RunCheckpoints(connection, schema, "3_dm")
+    assert named.start_run() == "nightly"
+    assert not named.resumed
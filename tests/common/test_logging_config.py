@@ -0,0 +1,39 @@
+import logging
+
+from common.logging_config import LoggingConfig, SamplingFilter
+
+
+def record(name: str, level: int = logging.INFO) -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 1, "message", None, None)
+
+
+def test_sampled_loggers_keep_one_in_every_n_records():
+    sampling = SamplingFilter({"image_repository": 0.25})
+    kept = [sampling.filter(record("image_repository")) for _ in range(12)]
+
+    assert kept == [True, False, False, False] * 3
+    assert sampling.take_dropped() == {("image_repository", "INFO"): 9}
+    assert sampling.take_dropped() == {}
+
+
+def test_warnings_and_other_loggers_always_pass():
+    sampling = SamplingFilter({"image_repository": 0.1})
+
+    assert all(sampling.filter(record("image_repository", logging.WARNING)) for _ in range(5))
+    assert all(sampling.filter(record("etl_1_stage")) for _ in range(5))
+    assert sampling.take_dropped() == {}
+
+
+def test_a_zero_rate_drops_everything_below_warning():
+    sampling = SamplingFilter({"noisy": 0})
+
+    assert not any(sampling.filter(record("noisy", logging.DEBUG)) for _ in range(3))
+    assert sampling.filter(record("noisy", logging.ERROR))
+    assert sampling.take_dropped() == {("noisy", "DEBUG"): 3}
+
+
+def test_log_sample_overrides_the_service_defaults(monkeypatch):
+    monkeypatch.setenv("LOG_SAMPLE", "image_repository=0.5, etl_1_stage=0.1")
+    config = LoggingConfig.from_env({"image_repository": 0.01, "model_client": 0.2})
+
+    assert config.sample_rates == {"image_repository": 0.5, "model_client": 0.2, "etl_1_stage": 0.1}
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from common.checkpoints import RunCheckpoints
+from common.quality import (Batch, QualityGate, Reference, TableRules, evaluate, in_range, is_number, not_null,
+                            positive, references, to_numbers)
+
+QUARANTINE_MIGRATION = os.path.join(os.path.dirname(__file__), "..", "..", "etl", "2_History", "postgres", "sql",
+                                    "migrations", "V007__etl_quarantine.sql")
+
+COLUMNS = ["detection_id", "image_id", "confidence", "width", "image_data"]
+
+RULES = TableRules(
+    columns=COLUMNS,
+    rules=[not_null("image_id"), is_number("confidence"), in_range("confidence", 0, 1), positive("width")],
+    omit=["image_data"]
+)
+
+
+def test_to_numbers_turns_text_and_null_into_nan():
+    values = to_numbers(["1.5", None, "abc", 2])
+    assert values[0] == 1.5 and values[3] == 2
+    assert all(value != value for value in values[1:3])
+
+
+def test_evaluate_reports_every_failed_rule_per_row():
+    rows = [
+        (1, 10, "0.9", "5", b"blob"),
+        (2, None, "1.7", "5", b"blob"),
+        (3, 10, "n/a", "0", None),
+    ]
+    failures = evaluate(RULES, Batch(COLUMNS, rows))
+
+    assert failures == {
+        1: ["image_id is missing", "confidence outside [0, 1]"],
+        2: ["confidence is not a number", "confidence outside [0, 1]", "width not positive"],
+    }
+
+
+class LookupCursor:
+    def __init__(self, found: list):
+        self.found = found
+        self.keys = None
+
+    def execute(self, query, params):
+        self.keys = params[0]
+
+    def fetchall(self):
+        return self.found
+
+
+def test_references_are_looked_up_once_per_distinct_key():
+    rules = TableRules(columns=COLUMNS, rules=[references("image_id", "image")],
+                       references={"image": Reference("image_id", "SELECT ...", ("width",))})
+    batch = Batch(COLUMNS, [(1, 10, 0.5, 1, None), (2, 11, 0.5, 1, None), (3, 10, 0.5, 1, None),
+                            (4, None, 0.5, 1, None)])
+    cursor = LookupCursor([(10, 640)])
+    for name, reference in rules.references.items():
+        batch.resolve(name, reference, cursor)
+
+    assert cursor.keys == [10, 11]
+    assert batch.reference("image", "width")[0] == 640
+    assert sorted(evaluate(rules, batch)) == [1, 3]
+
+
+@pytest.fixture
+def gate(checkpoint_schema, monkeypatch):
+    monkeypatch.delenv("ETL_RUN_ID", raising=False)
+    connection, schema = checkpoint_schema
+    with open(QUARANTINE_MIGRATION) as file:
+        migration = file.read().replace("history.", f"{schema}.")
+    with connection.cursor() as cursor:
+        cursor.execute(migration)
+    checkpoints = RunCheckpoints(connection, schema, "2_history")
+    checkpoints.start_run()
+    return connection, schema, QualityGate(checkpoints, {"detections": RULES})
+
+
+def test_gate_passes_good_rows_and_quarantines_the_others_once(gate):
+    connection, schema, quality_gate = gate
+    rows = [(1, 10, 0.9, 5, b"blob"), (2, None, 0.9, 5, b"blob"), (3, 10, 0.9, -1, b"blob")]
+
+    with connection.cursor() as cursor:
+        assert quality_gate.check(cursor, "detections", rows) == [rows[0]]
+        # Failing again on the next run updates the entries instead of adding new ones.
+        assert quality_gate.check(cursor, "detections", rows + [rows[2]]) == [rows[0]]
+        cursor.execute(f"SELECT row_key, reasons, row_data FROM {schema}.etl_quarantine ORDER BY row_key;")
+        entries = cursor.fetchall()
+    connection.commit()
+
+    assert [(key, reasons) for key, reasons, _ in entries] == [("2", ["image_id is missing"]),
+                                                              ("3", ["width not positive"])]
+    assert entries[0][2] == {"detection_id": 2, "image_id": None, "confidence": 0.9, "width": 5}
+    assert quality_gate.quarantined == {"detections": 5}
+
+
+def test_disabled_gate_and_unknown_tables_pass_everything(gate):
+    connection, _, quality_gate = gate
+    rows = [(2, None, 0.9, 5, None)]
+    with connection.cursor() as cursor:
+        assert quality_gate.check(cursor, "images", rows) == rows
+        quality_gate.enabled = False
+        assert quality_gate.check(cursor, "detections", rows) == rows
+    assert quality_gate.quarantined == {}
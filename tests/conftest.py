@@ -0,0 +1,36 @@
+import os
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+# `common` is imported from the repository root, as with PYTHONPATH set for the services.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def test_dsn() -> str:
+    """libpq connection string of a scratch database, from ETL_TEST_DSN; the test is skipped without it."""
+    dsn = os.getenv("ETL_TEST_DSN")
+    if not dsn:
+        pytest.skip("Set ETL_TEST_DSN to run the tests that need PostgreSQL.")
+    return dsn
+
+
+@pytest.fixture
+def db_schema(test_dsn):
+    """A connection and a fresh schema of its own, dropped with everything in it after the test."""
+    schema = f"etl_test_{uuid.uuid4().hex[:12]}"
+    connection = psycopg2.connect(test_dsn)
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA {schema};")
+    connection.commit()
+    try:
+        yield connection, schema
+    finally:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {schema} CASCADE;")
+        connection.commit()
+        connection.close()
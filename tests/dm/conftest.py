@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of 3_DM import each other by their flat names.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "etl", "3_DM", "src", "app"))
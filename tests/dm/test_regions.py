@@ -0,0 +1,28 @@
+import shapely
+
+from regions import Region, RegionIndex
+
+
+def index(cell_degrees: float) -> RegionIndex:
+    regions = [Region("east", "county", "East"), Region("west", "county", "West"),
+               Region("east-1", "municipality", None)]
+    geometries = [shapely.box(-80.5, -0.5, -79.5, 0.5), shapely.box(-180, -0.5, -179.5, 0.5),
+                  shapely.box(-80, 0, -79.9, 0.1)]
+    shapely.prepare(geometries)
+    return RegionIndex(regions, geometries, cell_degrees)
+
+
+def test_points_take_the_region_they_lie_in():
+    codes = index(0.01).lookup([0.05, 0.2, 0.0, 10.0, float("nan")], [-79.95, -79.95, -179.8, 0.0, 0.0])
+
+    assert codes["county"].tolist() == ["east", "east", "west", None, None]
+    assert codes["municipality"].tolist() == ["east-1", None, None, None, None]
+
+
+def test_small_cells_far_apart_do_not_share_a_cached_region():
+    # With 0.0001 degree cells there are 3.6 million columns; these two cells used to get the same key.
+    regions = index(0.0001)
+    codes = regions.lookup([0.00005, 0.00015], [-79.99995, -179.99995])
+
+    assert codes["county"].tolist() == ["east", "west"]
+    assert regions.lookup([0.00015], [-179.99995])["county"].tolist() == ["west"]
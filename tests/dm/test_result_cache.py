@@ -0,0 +1,152 @@
+import os
+from contextlib import contextmanager
+
+import pytest
+
+from result_cache import WATERMARK_SELECT, CacheConfig, ResultCache, Watermark, entity_tag
+
+STAR_MIGRATIONS = os.path.join(os.path.dirname(__file__), "..", "..", "etl", "3_DM", "postgres", "sql", "migrations")
+
+
+def test_cached_results_are_reused_until_the_version_moves():
+    cache = ResultCache(CacheConfig())
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return b"body"
+
+    assert cache.get_or_compute(1, "/images", compute) == (b"body", False)
+    assert cache.get_or_compute(1, "/images", compute) == (b"body", True)
+    assert cache.get_or_compute(2, "/images", compute) == (b"body", False)
+    assert len(computed) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_results_of_an_older_version_are_neither_served_nor_kept():
+    cache = ResultCache(CacheConfig())
+    cache.put(2, "/images", b"new")
+    cache.put(1, "/images", b"old")
+
+    assert cache.get(1, "/images") is None
+    assert cache.get(2, "/images") == b"new"
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResultCache(CacheConfig(max_entries=2))
+    cache.put(1, "a", b"a")
+    cache.put(1, "b", b"b")
+    cache.get(1, "a")
+    cache.put(1, "c", b"c")
+
+    assert len(cache) == 2
+    assert cache.get(1, "b") is None
+    assert cache.get(1, "a") == b"a"
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("result_cache.time.monotonic", lambda: now[0])
+    cache = ResultCache(CacheConfig(ttl_seconds=10))
+    cache.put(1, "a", b"a")
+
+    now[0] += 9
+    assert cache.get(1, "a") == b"a"
+    now[0] += 2
+    assert cache.get(1, "a") is None
+
+
+def test_a_disabled_cache_keeps_nothing():
+    cache = ResultCache(CacheConfig(max_entries=0))
+    cache.put(1, "a", b"a")
+    assert len(cache) == 0
+
+
+def test_entity_tags_depend_on_version_and_request():
+    assert entity_tag(3, "/images?limit=10") == entity_tag(3, "/images?limit=10")
+    assert entity_tag(3, "/images?limit=10") != entity_tag(4, "/images?limit=10")
+    assert entity_tag(3, "/images?limit=10") != entity_tag(3, "/images?limit=20")
+
+
+class FakeCursor:
+    def __init__(self, reads: list, state: tuple):
+        self.reads = reads
+        self.state = state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        self.reads.append(query)
+
+    def fetchone(self):
+        return self.state
+
+
+class FakePool:
+    def __init__(self, state: tuple):
+        self.state = state
+        self.reads = []
+
+    @contextmanager
+    def connection(self):
+        pool = self
+
+        class Connection:
+            def cursor(self):
+                return FakeCursor(pool.reads, pool.state)
+
+            def rollback(self):
+                pass
+
+        yield Connection()
+
+
+def test_watermark_is_read_at_most_once_per_max_age(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("result_cache.time.monotonic", lambda: now[0])
+    pool = FakePool((5, False))
+    watermark = Watermark(pool, max_age_seconds=1)
+
+    assert watermark.current() == (5, False)
+    pool.state = (6, True)
+    assert watermark.current() == (5, False)
+    now[0] += 1
+    assert watermark.current() == (6, True)
+    assert len(pool.reads) == 2
+
+
+@pytest.fixture
+def watermark_schema(db_schema):
+    """A scratch schema with the load watermark and running loads of the star migrations."""
+    connection, schema = db_schema
+    with connection.cursor() as cursor:
+        for name in ("V007__load_watermark.sql", "V008__load_in_progress.sql", "V009__etl_control_tables.sql",
+                     "V010__running_loads.sql"):
+            with open(os.path.join(STAR_MIGRATIONS, name)) as file:
+                cursor.execute(file.read().replace("star.", f"{schema}."))
+    connection.commit()
+    return connection, schema
+
+
+def test_a_load_running_on_keeps_the_watermark_loading(watermark_schema):
+    connection, schema = watermark_schema
+    select = WATERMARK_SELECT.replace("star.", f"{schema}.")
+
+    def state():
+        with connection.cursor() as cursor:
+            cursor.execute(select)
+            return cursor.fetchone()
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {schema}.begin_load('3_dm run');")
+        cursor.execute(f"SELECT {schema}.begin_load('regions-backfill');")
+        assert state() == (2, True)
+        cursor.execute(f"SELECT {schema}.end_load('regions-backfill');")
+        assert state() == (3, True)
+        cursor.execute(f"SELECT {schema}.end_load('3_dm run');")
+        assert state() == (4, False)
+    connection.commit()
@@ -0,0 +1,51 @@
+import numpy as np
+
+from detections import classes_from_prediction, detections_from_predictions, select_valid_detections
+
+
+def box(confidence, x, y, width, height, name="solar-panel"):
+    return {"class": name, "confidence": confidence, "x": x, "y": y, "width": width, "height": height}
+
+
+def test_incomplete_predictions_are_skipped():
+    columns = detections_from_predictions([box(0.9, 10, 10, 4, 4), {"class": "solar-panel", "confidence": 0.8}])
+    assert len(columns) == 1
+    assert len(detections_from_predictions([])) == 0
+
+
+def test_select_keeps_confident_boxes_inside_the_image_by_confidence():
+    columns = detections_from_predictions([
+        box(0.6, 50, 50, 10, 10),
+        box(0.9, 20, 20, 10, 10),
+        box(0.3, 50, 50, 10, 10),          # below min_confidence
+        box(0.8, 98, 50, 10, 10),          # right edge outside the image
+        box(0.7, 50, 50, 0, 10),           # no width
+        box(float("nan"), 50, 50, 10, 10),
+        box(1.5, 50, 50, 10, 10),          # not a probability
+    ])
+    selected = select_valid_detections(columns, 100, 100, min_confidence=0.5)
+
+    assert selected.confidence.tolist() == [0.9, 0.6]
+    assert selected.x.tolist() == [20, 50]
+
+
+def test_boxes_touching_the_border_are_inside():
+    columns = detections_from_predictions([box(0.9, 5, 5, 10, 10), box(0.9, 95, 95, 10, 10)])
+    assert len(select_valid_detections(columns, 100, 100)) == 2
+
+
+def test_without_image_size_only_the_box_itself_is_checked():
+    columns = detections_from_predictions([box(0.9, 500, 500, 10, 10), box(0.9, 500, 500, -1, 10)])
+    assert len(select_valid_detections(columns, None, None)) == 1
+
+
+def test_equal_confidences_keep_their_order():
+    columns = detections_from_predictions([box(0.5, x, 50, 2, 2) for x in (10, 20, 30)])
+    assert select_valid_detections(columns, 100, 100).x.tolist() == [10, 20, 30]
+
+
+def test_classes_are_filtered_by_confidence():
+    classes = classes_from_prediction({"predictions": {"flat": {"confidence": 0.7}, "gable": {"confidence": 0.1},
+                                                       "hip": {}}}, min_confidence=0.2)
+    assert classes.class_names.tolist() == ["flat"]
+    assert np.allclose(classes.confidence, [0.7])
@@ -0,0 +1,196 @@
+from types import SimpleNamespace
+
+import pytest
+
+from model_client import (AdaptiveConcurrencyLimiter, CircuitBreaker, CircuitOpenError, ModelClientConfig,
+                          ResilientModelClient, classify_error)
+
+
+class HttpError(Exception):
+    def __init__(self, status_code: int, message: str = "", headers: dict = None):
+        super().__init__(message or f"HTTP {status_code}")
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+class FakeModel:
+    """Raises the queued errors in turn, then answers."""
+
+    def __init__(self, errors=()):
+        self.params = SimpleNamespace(project_name="fake-project")
+        self.errors = list(errors)
+        self.calls = 0
+
+    def predict(self, image_path: str) -> dict:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"image": image_path}
+
+
+@pytest.mark.parametrize("error, kind", [
+    (HttpError(429), "throttle"),
+    (HttpError(503), "retryable"),
+    (HttpError(400), "fatal"),
+    (ConnectionError("reset"), "retryable"),
+    (TimeoutError(), "retryable"),
+    (ValueError("bad input"), "fatal"),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_classify_error_ignores_the_message():
+    assert classify_error(ValueError("could not read image_500.jpg (429 bytes)")) == "fatal"
+
+
+def test_limiter_grows_additively_and_shrinks_multiplicatively():
+    config = ModelClientConfig(initial_concurrency=4, max_concurrency=8, decrease_cooldown_seconds=0)
+    limiter = AdaptiveConcurrencyLimiter(config)
+
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.limit == pytest.approx(5.0, abs=0.1)
+
+    limiter.on_throttle()
+    assert limiter.limit == pytest.approx(2.5, abs=0.1)
+
+    for _ in range(1000):
+        limiter.on_success()
+    assert limiter.limit == config.max_concurrency
+
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.limit == config.min_concurrency
+
+
+def test_limiter_counts_a_burst_of_throttles_once():
+    limiter = AdaptiveConcurrencyLimiter(ModelClientConfig(initial_concurrency=8, max_concurrency=8,
+                                                           decrease_cooldown_seconds=60))
+    for _ in range(5):
+        limiter.on_throttle()
+    assert limiter.limit == 4
+
+
+def breaker_config(**overrides) -> ModelClientConfig:
+    settings = dict(breaker_window=4, breaker_min_calls=4, breaker_error_rate=0.5, breaker_cooldown_seconds=0,
+                    max_pause_seconds=0)
+    settings.update(overrides)
+    return ModelClientConfig(**settings)
+
+
+def test_breaker_opens_at_the_error_rate():
+    breaker = CircuitBreaker("model", breaker_config())
+    for success in (True, False, True):
+        breaker.record(success)
+    assert breaker.state == "closed"
+
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.opens == 1
+
+
+def test_breaker_probe_closes_or_reopens():
+    breaker = CircuitBreaker("model", breaker_config())
+    for _ in range(4):
+        breaker.record(False)
+
+    assert breaker.wait_until_allowed() is True
+    assert breaker.state == "half_open"
+    breaker.record(False, probe=True)
+    assert breaker.state == "open"
+    assert breaker.opens == 2
+
+    assert breaker.wait_until_allowed() is True
+    breaker.record(True, probe=True)
+    assert breaker.state == "closed"
+    assert breaker.wait_until_allowed() is False
+
+
+def test_breaker_ignores_calls_that_were_in_flight_when_it_opened():
+    breaker = CircuitBreaker("model", breaker_config())
+    for _ in range(4):
+        breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == "open"
+
+
+def test_open_breaker_gives_up_after_the_pause_limit():
+    breaker = CircuitBreaker("model", breaker_config(breaker_cooldown_seconds=60))
+    for _ in range(4):
+        breaker.record(False)
+    with pytest.raises(CircuitOpenError):
+        breaker.wait_until_allowed()
+
+
+def test_client_retries_retryable_errors_and_throttles(monkeypatch):
+    monkeypatch.setattr("model_client.time.sleep", lambda seconds: None)
+    model = FakeModel([HttpError(503), HttpError(429, headers={"Retry-After": "2"})])
+    client = ResilientModelClient(model, ModelClientConfig(max_retries=4))
+
+    assert client.predict("tile.jpg") == {"image": "tile.jpg"}
+    stats = client.stats()
+    assert model.calls == 3
+    assert stats["retries"] == 2
+    assert stats["throttles"] == 1
+    assert stats["successes"] == 1
+
+
+def test_client_does_not_retry_fatal_errors():
+    model = FakeModel([HttpError(400)])
+    client = ResilientModelClient(model, ModelClientConfig())
+
+    with pytest.raises(HttpError):
+        client.predict("tile.jpg")
+    assert model.calls == 1
+    assert client.stats()["failures"] == 1
+
+
+def test_backoff_respects_retry_after():
+    client = ResilientModelClient(FakeModel(), ModelClientConfig(backoff_base_seconds=0.1, backoff_max_seconds=1))
+    assert all(0 <= client._backoff_delay(attempt, None) <= 1 for attempt in range(1, 10))
+    assert client._backoff_delay(1, 5.0) == 5.0
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def test_an_interrupted_probe_lets_the_next_call_probe():
+    config = breaker_config(max_retries=0)
+    model = FakeModel([Interrupted()])
+    client = ResilientModelClient(model, config)
+    for _ in range(4):
+        client.breaker.record(False)
+
+    with pytest.raises(Interrupted):
+        client.predict("tile.jpg")
+    assert client.breaker.state == "half_open"
+
+    assert client.predict("tile.jpg") == {"image": "tile.jpg"}
+    assert client.breaker.state == "closed"
+    assert client.limiter.in_flight == 0
+
+
+class FakeModelFactory:
+    def __init__(self, config: ModelClientConfig):
+        self.config = config
+
+    def create_model(self, api_key: str, project_name: str, version_number: int) -> ResilientModelClient:
+        return ResilientModelClient(FakeModel(), self.config)
+
+
+def test_infer_workers_follow_the_limiter_ceiling():
+    from extract_image_data_service import ImageProcessService
+
+    service = ImageProcessService(
+        roboflow_model_factory=FakeModelFactory(ModelClientConfig(initial_concurrency=4, max_concurrency=12)),
+        models_config=[{"api_key": "key", "project_name": "fake-project", "version_number": 1,
+                        "model_name": "model"}],
+        repository=None,
+        image_folder_path=".",
+        pipeline_config={"concurrency": {"infer": 2, "load": 3}}
+    )
+    stages = {stage.name: stage.concurrency for stage in service._build_pipeline().stages}
+
+    assert stages["infer"] == 12
+    assert stages["load"] == 3
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def run(pipeline: Pipeline, source):
+    asyncio.run(pipeline.run(source))
+
+
+def collector(results: list):
+    def collect(item):
+        results.append(item)
+        return item
+    return collect
+
+
+def test_items_pass_through_every_stage():
+    results = []
+    pipeline = Pipeline([Stage("double", lambda item: item * 2, concurrency=3), Stage("collect", collector(results))])
+    run(pipeline, range(20))
+
+    assert sorted(results) == [item * 2 for item in range(20)]
+    assert pipeline.stats["double"].processed == 20
+    assert pipeline.stats["collect"].processed == 20
+
+
+def test_none_drops_an_item_and_errors_are_counted():
+    results = []
+
+    def check(item):
+        if item == 3:
+            raise RuntimeError("broken item")
+        return None if item % 2 else item
+
+    pipeline = Pipeline([Stage("check", check), Stage("collect", collector(results))])
+    run(pipeline, range(6))
+
+    assert sorted(results) == [0, 2, 4]
+    assert pipeline.stats["check"].failed == 1
+    assert pipeline.stats["check"].dropped == 2
+    assert pipeline.stats["check"].processed == 3
+
+
+def test_bounded_queues_hold_back_the_source():
+    fed = []
+
+    def source():
+        for item in range(50):
+            fed.append(item)
+            yield item
+
+    handled = []
+
+    def slow(item):
+        # The source runs ahead by at most the full queue, the item in hand and the one it waits to put.
+        assert len(fed) - len(handled) <= 2 + 1 + 1
+        time.sleep(0.001)
+        handled.append(item)
+        return item
+
+    pipeline = Pipeline([Stage("slow", slow)], queue_size=2)
+    run(pipeline, source())
+
+    assert pipeline.stats["slow"].processed == 50
+    assert pipeline.stats["slow"].max_queue_depth <= 2
+
+
+def test_stage_concurrency_runs_items_side_by_side():
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return item
+
+    pipeline = Pipeline([Stage("work", work, concurrency=4)])
+    run(pipeline, range(16))
+
+    assert peak[0] > 1
+    assert peak[0] <= 4
+
+
+def test_snapshot_reports_latencies_and_the_bottleneck():
+    pipeline = Pipeline([Stage("fast", lambda item: item), Stage("slow", lambda item: time.sleep(0.005) or item)])
+    run(pipeline, range(10))
+
+    snapshot = pipeline.snapshot()
+    assert snapshot["slow"]["p95_seconds"] >= 0.005
+    assert snapshot["fast"]["p50_seconds"] <= snapshot["slow"]["p50_seconds"]
+    assert pipeline.bottleneck() == "slow"
+
+
+def test_invalid_configuration_is_rejected():
+    with pytest.raises(ValueError):
+        Pipeline([])
+    with pytest.raises(ValueError):
+        Stage("none", lambda item: item, concurrency=0)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the orchestrator import each other by their flat names.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "etl", "orchestrator", "src", "app"))
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from dag import Step, StepFailedError, run_dag
+
+
+def recorder(log: list, name: str, seconds: float = 0.0):
+    def run():
+        log.append(("start", name))
+        time.sleep(seconds)
+        log.append(("end", name))
+    return run
+
+
+def test_steps_run_after_their_dependencies():
+    log = []
+    steps = [
+        Step("star", recorder(log, "star"), ["history"]),
+        Step("stage", recorder(log, "stage")),
+        Step("history", recorder(log, "history"), ["stage", "prepare"]),
+        Step("prepare", recorder(log, "prepare")),
+    ]
+    durations = run_dag(steps)
+
+    assert set(durations) == {"stage", "prepare", "history", "star"}
+    for step in steps:
+        for dependency in step.depends_on:
+            assert log.index(("end", dependency)) < log.index(("start", step.name))
+
+
+def test_independent_steps_run_side_by_side():
+    both_running = threading.Barrier(2, timeout=5)
+    steps = [Step("a", both_running.wait), Step("b", both_running.wait)]
+    run_dag(steps, max_parallel=2)
+
+
+def test_a_failed_step_stops_its_dependents():
+    log = []
+
+    def broken():
+        raise RuntimeError("no connection")
+
+    steps = [Step("prepare", broken), Step("load", recorder(log, "load"), ["prepare"])]
+    with pytest.raises(StepFailedError, match="prepare"):
+        run_dag(steps)
+    assert log == []
+
+
+def test_unknown_and_circular_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="unknown"):
+        run_dag([Step("load", lambda: None, ["missing"])])
+    with pytest.raises(ValueError, match="circular"):
+        run_dag([Step("a", lambda: None, ["b"]), Step("b", lambda: None, ["a"])])
@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+
+import reconcile
+from reconcile import KEY_BOUNDS, KEY_HASHES, Layer, ReconcileConfig, Reconciler
+
+
+class InMemoryReconciler(Reconciler):
+    """Answers the reconciliation queries from {layer: {key: hash}} the way the databases do."""
+
+    def __init__(self, data: dict, config: ReconcileConfig):
+        super().__init__({}, config)
+        self.data = data
+        self.key_hash_rows = 0
+
+    def _query(self, layer: Layer, query: str, params: dict) -> list:
+        rows = self.data[layer.database]
+        if query == KEY_BOUNDS:
+            return [(min(rows), max(rows))] if rows else [(None, None)]
+        inside = {key: value for key, value in rows.items()
+                  if any(low <= key < low + params["span"] for low in params["lows"])}
+        if query == KEY_HASHES:
+            self.key_hash_rows += len(inside)
+            return list(inside.items())
+        buckets = {}
+        for key, value in inside.items():
+            count, total = buckets.get(key // params["width"], (0, 0))
+            buckets[key // params["width"]] = (count + 1, total + value)
+        return [(bucket, count, total) for bucket, (count, total) in buckets.items()]
+
+
+@pytest.fixture
+def things(monkeypatch):
+    layers = {name: Layer(name, f"{name}_things", "id", ["name"]) for name in ("source", "copy")}
+    monkeypatch.setitem(reconcile.TABLES, "things", layers)
+
+
+def test_mismatched_ranges_are_split_down_to_the_divergent_keys(things):
+    source = {key: key * 7 for key in range(10000)}
+    copy = dict(source)
+    copy[1234] = 1
+    del copy[5000]
+    copy[12000] = 3
+    reconciler = InMemoryReconciler({"source": source, "copy": copy},
+                                    ReconcileConfig(range_size=1000, fanout=10, leaf_size=10, workers=2))
+    try:
+        report = reconciler.reconcile("things", ["copy"])
+    finally:
+        reconciler.close()
+
+    assert report["rows"] == {"source": 10000, "copy": 10000}
+    assert report["mismatched_ranges"] == [{"width": 1000, "ranges": 3}, {"width": 100, "ranges": 3},
+                                           {"width": 10, "ranges": 3}]
+    assert report["divergent_keys"] == [{"key": 1234, "layer": "copy", "status": "different"},
+                                        {"key": 5000, "layer": "copy", "status": "missing"},
+                                        {"key": 12000, "layer": "copy", "status": "extra"}]
+    assert not report["truncated"]
+    # Only the three leaf ranges were compared key by key, in both layers.
+    assert reconciler.key_hash_rows <= 2 * 3 * 10
+
+
+def test_matching_layers_stop_after_the_first_pass(things):
+    data = {key: key for key in range(500)}
+    reconciler = InMemoryReconciler({"source": data, "copy": dict(data)}, ReconcileConfig(range_size=100))
+    try:
+        report = reconciler.reconcile("things", ["copy"])
+    finally:
+        reconciler.close()
+
+    assert report["mismatched_ranges"] == [{"width": 100, "ranges": 0}]
+    assert report["divergent_keys"] == []
+    assert reconciler.key_hash_rows == 0
+
+
+def test_divergent_keys_are_capped(things):
+    reconciler = InMemoryReconciler({"source": {key: key for key in range(100)}, "copy": {}},
+                                    ReconcileConfig(range_size=10, leaf_size=10, max_keys=5))
+    try:
+        report = reconciler.reconcile("things", ["copy"])
+    finally:
+        reconciler.close()
+
+    assert len(report["divergent_keys"]) == 5
+    assert report["truncated"]
+
+
+def test_range_starts_are_spread_over_the_workers_in_order():
+    reconciler = Reconciler({}, ReconcileConfig(workers=3))
+    try:
+        assert reconciler._split([0, 10, 20, 30, 40, 50, 60]) == [[0, 10, 20], [30, 40, 50], [60]]
+        assert reconciler._split([5]) == [[5]]
+    finally:
+        reconciler.close()
+
+
+class DsnPool:
+    """A connection per checkout, enough for the reconciler's `pool.connection()`."""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+
+    @contextmanager
+    def connection(self):
+        connection = psycopg2.connect(self.dsn)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+
+def test_reconcile_against_postgres(db_schema, test_dsn, monkeypatch):
+    connection, schema = db_schema
+    with connection.cursor() as cursor:
+        for table in ("source_things", "copy_things"):
+            cursor.execute(f"CREATE TABLE {schema}.{table} (id BIGINT PRIMARY KEY, name TEXT);")
+            cursor.execute(f"INSERT INTO {schema}.{table} SELECT n, 'thing ' || n FROM generate_series(1, 5000) AS n;")
+        cursor.execute(f"UPDATE {schema}.copy_things SET name = 'changed' WHERE id = 4321;")
+        cursor.execute(f"DELETE FROM {schema}.copy_things WHERE id = 17;")
+    connection.commit()
+    monkeypatch.setitem(reconcile.TABLES, "things", {
+        name: Layer(name, f"{schema}.{name}_things", "id", ["name"]) for name in ("source", "copy")})
+
+    pool = DsnPool(test_dsn)
+    reconciler = Reconciler({"source": pool, "copy": pool},
+                            ReconcileConfig(range_size=1000, fanout=10, leaf_size=10, workers=2))
+    try:
+        report = reconciler.reconcile("things", ["copy"])
+    finally:
+        reconciler.close()
+
+    assert report["rows"] == {"source": 5000, "copy": 4999}
+    assert report["divergent_keys"] == [{"key": 17, "layer": "copy", "status": "missing"},
+                                        {"key": 4321, "layer": "copy", "status": "different"}]